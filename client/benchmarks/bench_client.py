@@ -0,0 +1,286 @@
+"""
+Throughput benchmarks for the desktop client's hot paths.
+
+pyautogui is replaced by a no-op module, so the numbers measure the client's
+own dispatch cost rather than OS input latency. Run from the client folder:
+
+    python benchmarks/bench_client.py
+    python benchmarks/bench_client.py --save-baseline
+    python benchmarks/bench_client.py --baseline benchmarks/baseline.json --fail-on-regression
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import threading
+import time
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import client  # noqa: E402
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_OUTPUT = os.path.join(BENCH_DIR, 'latest.json')
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, 'baseline.json')
+DEFAULT_TOLERANCE = 0.20
+STREAM_SEED = 1234
+
+
+def make_stub_pyautogui():
+    stub = types.ModuleType('pyautogui')
+    stub.PAUSE = 0
+    stub.KEY_NAMES = ['backspace', 'enter', 'space', 'tab', 'esc', 'up', 'down', 'left', 'right']
+    stub.write = lambda text, interval=0.0: None
+    stub.press = lambda key, presses=1, interval=0.0: None
+    stub.hotkey = lambda *keys, **kwargs: None
+    return stub
+
+
+class NullSocket:
+    def __init__(self):
+        self.emitted = 0
+
+    async def emit(self, *args, **kwargs):
+        self.emitted += 1
+
+
+def mixed_stream(count, seed=STREAM_SEED):
+    rng = random.Random(seed)
+    letters = 'abcdefghijklmnopqrstuvwxyz '
+    specials = ['Backspace', 'Enter', 'ArrowLeft', 'Tab']
+    stream = []
+    for _ in range(count):
+        roll = rng.random()
+        if roll < 0.80:
+            stream.append(('letter', rng.choice(letters)))
+        elif roll < 0.90:
+            stream.append(('letter', rng.choice(specials)))
+        elif roll < 0.98:
+            stream.append(('word', ''.join(rng.choice(letters) for _ in range(rng.randint(2, 9))) + ' '))
+        else:
+            stream.append(('block', ''.join(rng.choice(letters) for _ in range(rng.randint(200, 2000)))))
+    return stream
+
+
+def bench_type_text(ops):
+    for _ in range(ops):
+        client.KeyboardController.type_text('hello ')
+
+
+def bench_press_key(ops):
+    keys = ['a', 'Enter', 'Backspace', 'ArrowLeft', 'x']
+    for index in range(ops):
+        client.KeyboardController.press_key(keys[index % len(keys)])
+
+
+def bench_on_keystroke(ops):
+    async def deliver():
+        runtime = client.InjectionRuntime()
+        runtime.start()
+        with patch.object(client, 'injection_runtime', runtime):
+            for index in range(ops):
+                # Paced like a sender waiting on acks, so no event overflows the unpaused queue.
+                while runtime.sequencer.depth('internet') >= client.UNPAUSED_SENDER_QUEUE_SIZE:
+                    await asyncio.sleep(0)
+                await client.on_keystroke({
+                    'type': 'letter',
+                    'payload': 'a',
+                    'roomCode': 'bench',
+                    'eventId': index + 1,
+                    'clientEventId': index + 1
+                })
+            await runtime.drain()
+        await runtime.stop()
+
+    with patch.object(client, 'sio', NullSocket()), patch.object(client, 'executed_events', client.ExecutedEventIndex()):
+        asyncio.run(deliver())
+
+
+def bench_handle_keystroke_mixed(ops):
+    for msg_type, payload in mixed_stream(ops):
+        client.handle_keystroke(msg_type, payload)
+
+
+def bench_local_ws(ops):
+    from fastapi.testclient import TestClient
+
+    with TestClient(client.create_local_app()) as test_client:
+        with test_client.websocket_connect('/ws') as ws:
+            for index in range(ops):
+                ws.send_json({'type': 'letter', 'payload': 'a', 'clientEventId': index + 1})
+            for _ in range(ops * 2):
+                ws.receive_json()
+
+
+class StubPollingServer:
+    def __init__(self, events, page_size=50):
+        self.events = events
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                since = int(parse_qs(urlparse(self.path).query).get('since', ['0'])[0])
+                page = stub.events[since:since + page_size]
+                body = json.dumps({
+                    'events': page,
+                    'nextSince': page[-1]['id'] if page else since,
+                    'longPoll': True
+                }).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def bench_polling_loop(ops):
+    events = [
+        {'id': index + 1, 'type': msg_type, 'payload': payload}
+        for index, (msg_type, payload) in enumerate(mixed_stream(ops))
+    ]
+    server = StubPollingServer(events)
+
+    async def poll_all():
+        runtime = client.InjectionRuntime()
+        runtime.start()
+        poller = client.EventPoller(server.url, 'bench', wait_seconds=0)
+        try:
+            while poller.since_id < ops:
+                await client.process_polled_events(runtime, await poller.poll())
+            await runtime.drain()
+        finally:
+            await poller.close()
+            await runtime.stop()
+
+    try:
+        with patch.object(client, 'executed_events', client.ExecutedEventIndex()):
+            asyncio.run(poll_all())
+    finally:
+        server.close()
+
+
+BENCHMARKS = {
+    'keyboard_type_text': (bench_type_text, 20000),
+    'keyboard_press_key': (bench_press_key, 20000),
+    'on_keystroke_with_ack': (bench_on_keystroke, 10000),
+    'handle_keystroke_mixed': (bench_handle_keystroke_mixed, 10000),
+    'local_ws_endpoint': (bench_local_ws, 500),
+    'polling_loop': (bench_polling_loop, 2000)
+}
+
+
+def run_benchmarks(names=None, repeat=5, scale=1.0):
+    stub = make_stub_pyautogui()
+    with patch.dict(sys.modules, {'pyautogui': stub}):
+        backend = client.PyAutoGuiBackend()
+    previous_backend = client.KeyboardController.backend
+    client.KeyboardController.use_backend(backend)
+
+    results = {}
+    try:
+        for name in names or BENCHMARKS:
+            func, ops = BENCHMARKS[name]
+            ops = max(1, int(ops * scale))
+            func(max(1, ops // 10))
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                func(ops)
+                timings.append(time.perf_counter() - started)
+            best = min(timings)
+            results[name] = {
+                'ops': ops,
+                'best_seconds': best,
+                'median_seconds': statistics.median(timings),
+                'ops_per_sec': ops / best,
+                'us_per_op': best / ops * 1e6
+            }
+            print(f"{name:28s} {ops / best:14,.0f} ops/s  {best / ops * 1e6:9.2f} us/op")
+    finally:
+        client.KeyboardController.use_backend(previous_backend)
+
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'repeat': repeat,
+            'scale': scale
+        },
+        'results': results
+    }
+
+
+def compare(current, baseline, tolerance=DEFAULT_TOLERANCE):
+    regressions = []
+    for name, result in current['results'].items():
+        previous = baseline.get('results', {}).get(name)
+        if not previous:
+            print(f"{name:28s} (no baseline)")
+            continue
+        ratio = result['ops_per_sec'] / previous['ops_per_sec']
+        flag = ''
+        if ratio < 1 - tolerance:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print(f"{name:28s} {ratio:6.2f}x baseline{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the remote keyboard client hot paths.')
+    parser.add_argument('names', nargs='*', help=f"benchmarks to run (default: all of {', '.join(BENCHMARKS)})")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--scale', type=float, default=1.0, help='multiply the per-benchmark operation counts')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT)
+    parser.add_argument('--baseline', default=None, help='compare against this results file')
+    parser.add_argument('--save-baseline', action='store_true', help=f'also write results to {DEFAULT_BASELINE}')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument('--fail-on-regression', action='store_true')
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmark(s): {', '.join(unknown)}")
+
+    current = run_benchmarks(args.names or None, repeat=args.repeat, scale=args.scale)
+    with open(args.output, 'w', encoding='utf-8') as handle:
+        json.dump(current, handle, indent=2)
+    print(f"[*] Results written to {args.output}")
+
+    if args.save_baseline:
+        with open(DEFAULT_BASELINE, 'w', encoding='utf-8') as handle:
+            json.dump(current, handle, indent=2)
+        print(f"[*] Baseline written to {DEFAULT_BASELINE}")
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as handle:
+            regressions = compare(current, json.load(handle), args.tolerance)
+        if regressions and args.fail_on_regression:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
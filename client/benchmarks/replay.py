@@ -0,0 +1,468 @@
+"""
+Session replay load harness for the desktop client.
+
+Sessions are JSON-lines files of {"t", "type", "payload"} records, as written
+by `client.py --record-events` (or by --generate below). A session is played
+back at its recorded pace, N times faster, or as fast as possible into one of:
+
+    local      local mode's /ws endpoint (JSON protocol)
+    websocket  a stand-in for the Node server, received by run_websocket_client
+    polling    the same stand-in, received by run_polling_client
+
+The receiver runs in-process with the recording injection backend, so no
+display or outside network is needed. Run from the client folder:
+
+    python benchmarks/replay.py --generate 2000 --output session.jsonl
+    python benchmarks/replay.py session.jsonl --target local --speed max
+    python benchmarks/replay.py session.jsonl --target websocket --speed 4 --json report.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import client  # noqa: E402
+
+TARGETS = ('local', 'websocket', 'polling')
+ROOM_CODE = 'replay'
+DEFAULT_DRAIN_TIMEOUT = 10.0
+GENERATE_SEED = 1234
+
+
+def load_session(path):
+    """Return [(t, type, payload), ...] sorted by time; skips malformed lines."""
+    records = []
+    with open(path, encoding='utf-8') as handle:
+        for line in handle:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if not isinstance(record, dict) or record.get('type') is None or record.get('payload') is None:
+                continue
+            records.append((float(record.get('t') or 0), record['type'], record['payload']))
+    records.sort(key=lambda record: record[0])
+    return records
+
+
+def generate_session(count, seed=GENERATE_SEED, events_per_second=12.0):
+    """A synthetic typing session: mostly letters at typing pace, with pauses and pasted blocks."""
+    rng = random.Random(seed)
+    letters = 'abcdefghijklmnopqrstuvwxyz '
+    specials = ['Backspace', 'Enter', 'ArrowLeft', 'Tab']
+    records = []
+    t = 0.0
+    for _ in range(count):
+        t += rng.expovariate(events_per_second)
+        if rng.random() < 0.02:
+            t += rng.uniform(0.5, 2.0)
+        roll = rng.random()
+        if roll < 0.80:
+            records.append((t, 'letter', rng.choice(letters)))
+        elif roll < 0.90:
+            records.append((t, 'letter', rng.choice(specials)))
+        elif roll < 0.98:
+            records.append((t, 'word', ''.join(rng.choice(letters) for _ in range(rng.randint(2, 9))) + ' '))
+        else:
+            records.append((t, 'block', ''.join(rng.choice(letters) for _ in range(rng.randint(200, 2000)))))
+    return records
+
+
+def write_session(path, records):
+    with open(path, 'w', encoding='utf-8') as handle:
+        for t, msg_type, payload in records:
+            handle.write(json.dumps({'t': round(t, 6), 'type': msg_type, 'payload': payload}) + '\n')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class ExecutionProbe:
+    """
+    Tracks when each replayed event was sent and executed. Doubles as the
+    receiver's cursor store: the client advances a cursor exactly when an
+    event has been injected, which is the execution signal for the internet
+    transports.
+    """
+
+    def __init__(self):
+        self.sent = {}
+        self.executed = {}
+        self.duplicates = 0
+        self.server = None
+        self.all_executed = asyncio.Event()
+
+    def send(self, client_event_id):
+        self.sent[client_event_id] = time.perf_counter()
+        self.all_executed.clear()
+
+    def execute(self, client_event_id):
+        if client_event_id not in self.sent:
+            return
+        if client_event_id in self.executed:
+            self.duplicates += 1
+            return
+        self.executed[client_event_id] = time.perf_counter()
+        if len(self.executed) == len(self.sent):
+            self.all_executed.set()
+
+    # EventCursorStore interface
+    def get(self, server_url, room_code):
+        return None, 0
+
+    def advance(self, server_url, room_code, event_id, epoch=None):
+        self.execute(self.server.client_event_id(room_code, event_id))
+
+    def report(self, target, speed, started, finished, backend):
+        latencies = sorted(self.executed[key] - self.sent[key] for key in self.executed)
+        histogram = client.LatencyHistogram(sample_size=max(1, len(latencies)))
+        for latency in latencies:
+            histogram.observe(latency)
+        duration = finished - started
+        return {
+            'target': target,
+            'speed': speed or 'max',
+            'sent': len(self.sent),
+            'executed': len(self.executed),
+            'dropped': len(self.sent) - len(self.executed),
+            'duplicates': self.duplicates,
+            'duration_seconds': duration,
+            'events_per_second': len(self.executed) / duration if duration else 0.0,
+            'typed_chars': backend.chars,
+            'latency_ms': {
+                'p50': histogram.percentile(0.50) * 1000,
+                'p95': histogram.percentile(0.95) * 1000,
+                'p99': histogram.percentile(0.99) * 1000,
+                'max': (latencies[-1] if latencies else 0.0) * 1000,
+                'mean': (histogram.total / histogram.count if histogram.count else 0.0) * 1000
+            }
+        }
+
+
+class StandInServer:
+    """
+    Python stand-in for the Node server: the REST polling API and the
+    Socket.IO room protocol (join-room, keystroke, delivery-ack, execution
+    acks, heartbeat), served by uvicorn on a thread of its own.
+    """
+
+    def __init__(self):
+        import socketio
+        import uvicorn
+        from fastapi import FastAPI, Request
+        from fastapi.responses import JSONResponse
+
+        self.epoch = os.urandom(6).hex()
+        self.rooms = {}
+        self.sio = socketio.AsyncServer(async_mode='asgi')
+        api = FastAPI()
+        stand_in = self
+
+        @api.get('/api/health')
+        async def health():
+            return {'ok': True}
+
+        @api.post('/api/rooms/{room_code}/events')
+        async def post_event(room_code: str, request: Request):
+            body = await request.json()
+            if body.get('type') is None or body.get('payload') is None:
+                return JSONResponse({'error': 'roomCode, type and payload are required'}, status_code=400)
+            event = await stand_in.queue_event(room_code, body['type'], body['payload'], body.get('clientEventId'))
+            return JSONResponse({'accepted': True, 'eventId': event['id']}, status_code=202)
+
+        @api.get('/api/rooms/{room_code}/events')
+        async def get_events(room_code: str, since: int = 0, wait: int = 0):
+            room = stand_in.room(room_code)
+            wait_seconds = min(max(wait, 0), 30000) / 1000
+            async with room['changed']:
+                if wait_seconds:
+                    try:
+                        await asyncio.wait_for(
+                            room['changed'].wait_for(lambda: room['events'] and room['events'][-1]['id'] > since),
+                            wait_seconds
+                        )
+                    except asyncio.TimeoutError:
+                        pass
+                events = [stand_in.public(event) for event in room['events'] if event['id'] > since]
+            return {
+                'events': events,
+                'nextSince': events[-1]['id'] if events else since,
+                'epoch': stand_in.epoch,
+                'longPoll': wait_seconds > 0
+            }
+
+        @self.sio.event
+        async def connect(sid, environ):
+            await stand_in.sio.emit('server-features', {'executionAckBatch': True, 'heartbeat': True}, to=sid)
+
+        @self.sio.on('join-room')
+        async def join_room(sid, room_code, role=None):
+            await stand_in.sio.enter_room(sid, room_code)
+
+        @self.sio.on('keystroke')
+        async def keystroke(sid, data):
+            room_code = data.get('roomCode')
+            if not room_code or data.get('type') is None or data.get('payload') is None:
+                return
+            event = await stand_in.queue_event(room_code, data['type'], data['payload'], data.get('clientEventId'))
+            await stand_in.sio.emit('delivery-ack', {
+                'roomCode': room_code, 'clientEventId': data.get('clientEventId'), 'eventId': event['id']
+            }, to=sid)
+            await stand_in.sio.emit('keystroke', {
+                **stand_in.public(event), 'roomCode': room_code, 'eventId': event['id'], 'epoch': stand_in.epoch
+            }, room=room_code, skip_sid=sid)
+
+        @self.sio.on('heartbeat')
+        async def heartbeat(sid, data=None):
+            return {'ts': time.time()}
+
+        @self.sio.on('*')
+        async def ignore(event, sid, data=None):
+            # execution-ack, execution-ack-batch and execution-progress: the
+            # probe learns about executions from cursor advances instead.
+            pass
+
+        port = free_port()
+        self.url = f"http://127.0.0.1:{port}"
+        self.server = uvicorn.Server(uvicorn.Config(socketio.ASGIApp(self.sio, other_asgi_app=api),
+                                                    host='127.0.0.1', port=port, log_level='error'))
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+
+    def room(self, room_code):
+        if room_code not in self.rooms:
+            self.rooms[room_code] = {'events': [], 'by_id': {}, 'changed': asyncio.Condition()}
+        return self.rooms[room_code]
+
+    @staticmethod
+    def public(event):
+        return {'id': event['id'], 'type': event['type'], 'payload': event['payload'], 'ts': event['ts']}
+
+    async def queue_event(self, room_code, msg_type, payload, client_event_id=None):
+        room = self.room(room_code)
+        async with room['changed']:
+            event = {
+                'id': len(room['events']) + 1,
+                'type': msg_type,
+                'payload': payload,
+                'ts': int(time.time() * 1000),
+                'clientEventId': client_event_id
+            }
+            room['events'].append(event)
+            room['by_id'][event['id']] = event
+            room['changed'].notify_all()
+        return event
+
+    def client_event_id(self, room_code, event_id):
+        event = self.rooms.get(room_code, {}).get('by_id', {}).get(event_id)
+        return event['clientEventId'] if event else None
+
+    def close(self):
+        self.server.should_exit = True
+        self.thread.join(5)
+
+
+async def paced(records, speed):
+    """Yield (index, type, payload) at the session's pace divided by `speed` (None: no pacing)."""
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    for index, (t, msg_type, payload) in enumerate(records, start=1):
+        if speed:
+            delay = started + t / speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        yield index, msg_type, payload
+
+
+async def wait_until_ready(predicate, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise RuntimeError('receiver did not come up in time')
+        await asyncio.sleep(0.01)
+
+
+async def replay_local(records, speed, probe, drain_timeout):
+    import aiohttp
+    import uvicorn
+
+    app = client.create_local_app(client.injection_runtime)
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=port, log_level='error'))
+    serving = asyncio.create_task(server.serve())
+    try:
+        await wait_until_ready(lambda: server.started)
+        async with aiohttp.ClientSession() as session:
+            async with session.ws_connect(f'http://127.0.0.1:{port}/ws') as ws:
+                async def read_acks():
+                    async for message in ws:
+                        frames = json.loads(message.data)
+                        for frame in frames if isinstance(frames, list) else [frames]:
+                            if frame.get('kind') == 'execution-ack':
+                                probe.execute(frame.get('clientEventId'))
+
+                reader = asyncio.create_task(read_acks())
+                started = time.perf_counter()
+                async for index, msg_type, payload in paced(records, speed):
+                    probe.send(index)
+                    await ws.send_str(json.dumps({'type': msg_type, 'payload': payload, 'clientEventId': index}))
+                await drain(probe, drain_timeout)
+                finished = time.perf_counter()
+                reader.cancel()
+    finally:
+        server.should_exit = True
+        await serving
+    return started, finished
+
+
+async def replay_internet(records, speed, probe, drain_timeout, transport):
+    import aiohttp
+    import socketio
+
+    stand_in = StandInServer()
+    probe.server = stand_in
+    if transport == 'websocket':
+        receiver = asyncio.create_task(client.run_websocket_client(stand_in.url, ROOM_CODE, probe))
+        await wait_until_ready(lambda: client.sio is not None and client.sio.connected)
+    else:
+        receiver = asyncio.create_task(client.run_polling_client(client.injection_runtime, stand_in.url, ROOM_CODE, probe))
+    sender = socketio.AsyncClient()
+    session = aiohttp.ClientSession()
+    try:
+        if transport == 'websocket':
+            await sender.connect(stand_in.url)
+            await sender.emit('join-room', (ROOM_CODE, 'sender'))
+            # Let the receiver join the room before the first keystroke.
+            await asyncio.sleep(0.2)
+        url = f"{stand_in.url}/api/rooms/{ROOM_CODE}/events"
+        started = time.perf_counter()
+        async for index, msg_type, payload in paced(records, speed):
+            probe.send(index)
+            if transport == 'websocket':
+                await sender.emit('keystroke', {'roomCode': ROOM_CODE, 'type': msg_type, 'payload': payload,
+                                                'clientEventId': index})
+            else:
+                async with session.post(url, json={'type': msg_type, 'payload': payload, 'clientEventId': index}) as response:
+                    await response.read()
+        await drain(probe, drain_timeout)
+        finished = time.perf_counter()
+    finally:
+        receiver.cancel()
+        try:
+            await receiver
+        except asyncio.CancelledError:
+            pass
+        if sender.connected:
+            await sender.disconnect()
+        await session.close()
+        stand_in.close()
+    return started, finished
+
+
+async def drain(probe, timeout):
+    if len(probe.executed) == len(probe.sent):
+        return
+    try:
+        await asyncio.wait_for(probe.all_executed.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+
+
+async def run_replay(records, target, speed=None, drain_timeout=DEFAULT_DRAIN_TIMEOUT, interval=0.0):
+    """Replay `records` into `target` and return the report dict."""
+    backend = client.RecordingBackend(interval=interval)
+    previous_backend = client.KeyboardController.backend
+    client.KeyboardController.use_backend(backend)
+    previous_index = client.executed_events
+    client.executed_events = client.ExecutedEventIndex()
+    # The Socket.IO client is bound to the loop it first ran on.
+    previous_sio, client.sio = client.sio, None
+    runtime = client.InjectionRuntime()
+    client.injection_runtime = runtime
+    runtime.start()
+    probe = ExecutionProbe()
+    try:
+        if target == 'local':
+            started, finished = await replay_local(records, speed, probe, drain_timeout)
+        else:
+            started, finished = await replay_internet(records, speed, probe, drain_timeout, target)
+    finally:
+        await runtime.stop()
+        client.injection_runtime = None
+        client.executed_events = previous_index
+        client.sio = previous_sio
+        client.KeyboardController.use_backend(previous_backend)
+    return probe.report(target, speed, started, finished, backend)
+
+
+def print_report(report):
+    latency = report['latency_ms']
+    speed = report['speed'] if report['speed'] == 'max' else f"{report['speed']:g}x"
+    print(f"[*] {report['target']} @ {speed}: sent {report['sent']}, executed {report['executed']}, "
+          f"dropped {report['dropped']}, duplicates {report['duplicates']}")
+    print(f"[*] {report['events_per_second']:,.0f} events/s over {report['duration_seconds']:.2f}s, "
+          f"{report['typed_chars']:,} chars typed")
+    print(f"[*] latency ms: p50 {latency['p50']:.2f}  p95 {latency['p95']:.2f}  p99 {latency['p99']:.2f}  "
+          f"max {latency['max']:.2f}")
+
+
+def parse_speed(value):
+    if value in ('max', '0'):
+        return None
+    speed = float(value.rstrip('x'))
+    if speed <= 0:
+        raise argparse.ArgumentTypeError('speed must be positive or "max"')
+    return speed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay recorded typing sessions into the remote keyboard client.')
+    parser.add_argument('session', nargs='?', help='JSON-lines session file (from --record-events or --generate)')
+    parser.add_argument('--target', choices=TARGETS, default='local')
+    parser.add_argument('--speed', type=parse_speed, default=1.0, help='1 (recorded pace), N (N times faster) or max')
+    parser.add_argument('--interval-ms', type=float, default=0.0,
+                        help='per-character pacing of the recording backend, to mimic a real injector')
+    parser.add_argument('--drain-timeout', type=float, default=DEFAULT_DRAIN_TIMEOUT,
+                        help='seconds to wait for outstanding executions after the last send')
+    parser.add_argument('--generate', type=int, metavar='EVENTS', help='write a synthetic session instead of replaying')
+    parser.add_argument('--output', help='where --generate writes the session')
+    parser.add_argument('--json', help='also write the report to this file')
+    args = parser.parse_args(argv)
+
+    if args.generate:
+        if not args.output:
+            parser.error('--generate needs --output')
+        write_session(args.output, generate_session(args.generate))
+        print(f"[*] Wrote {args.generate} events to {args.output}")
+        return 0
+    if not args.session:
+        parser.error('a session file is required')
+
+    records = load_session(args.session)
+    if not records:
+        print(f"[!] No events in {args.session}")
+        return 1
+    report = asyncio.run(run_replay(records, args.target, args.speed, args.drain_timeout, args.interval_ms / 1000))
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as handle:
+            json.dump(report, handle, indent=2)
+        print(f"[*] Report written to {args.json}")
+    return 0 if report['dropped'] == 0 and report['duplicates'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
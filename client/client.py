@@ -1,169 +1,4309 @@
+import argparse
+import asyncio
+import functools
+import gzip
+import hashlib
+import inspect
+import json
+import math
+import os
+import random
+import re
+import shutil
+import socket
+import struct
+import subprocess
 import sys
+import threading
 import time
-from urllib.parse import quote
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from urllib.parse import parse_qsl, quote
 
-import pyautogui
-import requests
-import socketio
-import uvicorn
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
-from fastapi.responses import HTMLResponse
+# Transport libraries (socketio, aiohttp, fastapi, uvicorn) and the injection
+# backends are imported inside the functions that need them, so each mode only
+# pays for what it uses.
 
-sio = socketio.Client()
+sio = None
+DEFAULT_SERVER_URL = "http://localhost:3000"
 POLL_INTERVAL_SECONDS = 0.6
+POLL_MIN_INTERVAL_SECONDS = 0.05
+POLL_ERROR_RETRY_SECONDS = 2
+LONG_POLL_WAIT_SECONDS = 25
+SOCKET_CONNECT_TIMEOUT_SECONDS = 5
+HEARTBEAT_INTERVAL_SECONDS = 2
+HEARTBEAT_TIMEOUT_SECONDS = 3
+FAILOVER_BACKOFF_MIN_SECONDS = 1
+FAILOVER_BACKOFF_MAX_SECONDS = 30
 LOCAL_HOST = "0.0.0.0"
 LOCAL_PORT = 8000
+LOCAL_BINARY_SUBPROTOCOL = 'rk.bin.v1'
+LOCAL_SENDER_QUEUE_SIZE = 64
+UNPAUSED_SENDER_QUEUE_SIZE = 256
+LOCAL_SENDER_RATE_ENV = 'RK_LOCAL_SENDER_RATE'
+LOCAL_SERVICE_WORKER_ENV = 'RK_LOCAL_SERVICE_WORKER'
+LOCAL_UDP_PORT_ENV = 'RK_LOCAL_UDP_PORT'
+UDP_REORDER_WINDOW = 64
+UDP_NACK_MAX = 32
+UDP_NACK_INTERVAL_SECONDS = 0.02
+UDP_ACK_HISTORY = 256
+UDP_RETRANSMIT_SECONDS = 0.1
+UDP_EXECUTION_WAIT_SECONDS = 1.0
+UDP_SESSION_IDLE_SECONDS = 60
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+MAX_COALESCED_CHARS = 1024
+STREAM_CHUNK_CHARS = 64
+MIRROR_SESSIONS_MAX = 64
+MIRROR_DIFF_MAX_EDITS = 1000
+PLAN_CACHE_SIZE = 1024
+PLAN_CACHE_MAX_PAYLOAD = 256
+INJECTION_BACKEND_ENV = 'RK_INJECTION_BACKEND'
+KEY_INTERVAL_ENV = 'RK_KEY_INTERVAL_MS'
+CLIPBOARD_ENV = 'RK_CLIPBOARD'
+PASTE_THRESHOLD_ENV = 'RK_PASTE_THRESHOLD'
+PASTE_THRESHOLD_CHARS = 256
+PASTE_SETTLE_SECONDS = 0.15
+PASTE_KEYS = ('command', 'v') if sys.platform == 'darwin' else ('ctrl', 'v')
+UINPUT_SETTLE_SECONDS = 0.3
+INJECTOR_ENV = 'RK_INJECTOR'
+INJECTOR_RING_SLOTS = 1024
+INJECTOR_RECORD_SIZE = 256
+INJECTOR_POLL_SECONDS = 0.5
+INJECTOR_START_TIMEOUT_SECONDS = 15
+INJECTOR_RESTART_LIMIT = 5
+INJECTOR_RESTART_WINDOW_SECONDS = 60
+STATE_DIR_ENV = 'RK_STATE_DIR'
+DEFAULT_STATE_DIR = os.path.join(os.path.expanduser('~'), '.remote-keyboard')
+CURSOR_LOG_NAME = 'cursors.log'
+CURSOR_COMPACT_AFTER = 1000
+SNIPPET_LOG_NAME = 'snippets.bin'
+SNIPPET_CACHE_ENV = 'RK_SNIPPET_CACHE_MB'
+SNIPPET_CACHE_MB = 16
+SNIPPET_MIN_CHARS = 256
+SNIPPET_DIGEST_SIZE = 16
+EXECUTED_INDEX_SIZE = 4096
+ACK_BATCH_WINDOW_SECONDS = 0.02
+ACK_BATCH_MAX = 64
+METRICS_LOG_INTERVAL_SECONDS = 30
+METRICS_RATE_WINDOW_SECONDS = 10
+LATENCY_SAMPLE_SIZE = 2048
+TRACE_BUFFER_SIZE = 2048
+TRACE_FILE_ENV = 'RK_TRACE_FILE'
+CLOCK_PING_INTERVAL_SECONDS = 10
+CLOCK_SAMPLES = 8
+CLOCK_SENDERS_MAX = 64
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class InjectionBackend:
+    """
+    Turns text and pyautogui-style key names ('enter', 'backspace', 'up', ...)
+    into input events. `interval` is the pause between keystrokes, in seconds.
+    """
+
+    name = 'base'
+
+    def __init__(self, interval=0.0):
+        self.interval = interval
+
+    @classmethod
+    def is_available(cls):
+        return True
+
+    def write(self, text):
+        raise NotImplementedError
+
+    def press(self, key):
+        raise NotImplementedError
+
+    def hotkey(self, keys):
+        """Hold `keys[:-1]` (modifiers) down while tapping `keys[-1]`."""
+        raise NotImplementedError
+
+    def supports_key(self, key):
+        raise NotImplementedError
+
+    def warm_up(self):
+        """Do any one-time setup now, so the first real keystroke is not slowed by it."""
+
+
+class PyAutoGuiBackend(InjectionBackend):
+    """
+    Cross-platform backend. Types one character at a time and sleeps
+    pyautogui.PAUSE after every call; pass `pause` to change that.
+    """
+
+    name = 'pyautogui'
+
+    def __init__(self, interval=0.0, pause=None):
+        super().__init__(interval)
+        import pyautogui
+        self._pyautogui = pyautogui
+        self._key_names = frozenset(pyautogui.KEY_NAMES)
+        if pause is not None:
+            pyautogui.PAUSE = pause
+
+    @classmethod
+    def is_available(cls):
+        try:
+            import pyautogui  # noqa: F401
+        except Exception:
+            return False
+        return True
+
+    def write(self, text):
+        if self.interval:
+            self._pyautogui.write(text, interval=self.interval)
+        else:
+            self._pyautogui.write(text)
+
+    def press(self, key):
+        self._pyautogui.press(key)
+
+    def hotkey(self, keys):
+        self._pyautogui.hotkey(*keys)
+
+    def supports_key(self, key):
+        return key in self._key_names
+
+    def warm_up(self):
+        # The first calls load the platform display bindings and screen info
+        # used by the fail-safe check.
+        self._pyautogui.size()
+        self._pyautogui.position()
+
+
+XDOTOOL_KEY_NAMES = {
+    'backspace': 'BackSpace',
+    'enter': 'Return',
+    'return': 'Return',
+    'space': 'space',
+    'tab': 'Tab',
+    'esc': 'Escape',
+    'escape': 'Escape',
+    'up': 'Up',
+    'down': 'Down',
+    'left': 'Left',
+    'right': 'Right',
+    'delete': 'Delete',
+    'del': 'Delete',
+    'home': 'Home',
+    'end': 'End',
+    'pageup': 'Prior',
+    'pagedown': 'Next',
+    'insert': 'Insert',
+    'ctrl': 'ctrl',
+    'alt': 'alt',
+    'shift': 'shift',
+    'win': 'super',
+    'command': 'super',
+    **{f'f{n}': f'F{n}' for n in range(1, 13)}
+}
+
+
+class XdotoolBackend(InjectionBackend):
+    """
+    X11 backend using xdotool's XTest injection. A whole string goes out in
+    one process call instead of one pyautogui call per character.
+    """
+
+    name = 'xdotool'
+
+    def __init__(self, interval=0.0, executable=None):
+        super().__init__(interval)
+        self.executable = executable or shutil.which('xdotool') or 'xdotool'
+
+    @classmethod
+    def is_available(cls):
+        return bool(os.environ.get('DISPLAY')) and shutil.which('xdotool') is not None
+
+    def _run(self, *args):
+        delay_ms = str(int(self.interval * 1000))
+        subprocess.run([self.executable, *args[:1], '--delay', delay_ms, *args[1:]], check=True)
+
+    def write(self, text):
+        self._run('type', '--', text)
+
+    def press(self, key):
+        self._run('key', '--', XDOTOOL_KEY_NAMES[key])
+
+    def hotkey(self, keys):
+        self._run('key', '--', '+'.join(XDOTOOL_KEY_NAMES.get(key, key) for key in keys))
+
+    def supports_key(self, key):
+        # Single characters are resolved to keysyms by xdotool itself.
+        return key in XDOTOOL_KEY_NAMES or (len(key) == 1 and key.isprintable())
+
+    def warm_up(self):
+        subprocess.run([self.executable, 'version'], check=True, stdout=subprocess.DEVNULL)
+
+
+UINPUT_KEY_NAMES = {
+    'backspace': 'KEY_BACKSPACE',
+    'enter': 'KEY_ENTER',
+    'return': 'KEY_ENTER',
+    'space': 'KEY_SPACE',
+    'tab': 'KEY_TAB',
+    'esc': 'KEY_ESC',
+    'escape': 'KEY_ESC',
+    'up': 'KEY_UP',
+    'down': 'KEY_DOWN',
+    'left': 'KEY_LEFT',
+    'right': 'KEY_RIGHT',
+    'delete': 'KEY_DELETE',
+    'del': 'KEY_DELETE',
+    'home': 'KEY_HOME',
+    'end': 'KEY_END',
+    'pageup': 'KEY_PAGEUP',
+    'pagedown': 'KEY_PAGEDOWN',
+    'insert': 'KEY_INSERT',
+    'ctrl': 'KEY_LEFTCTRL',
+    'alt': 'KEY_LEFTALT',
+    'shift': 'KEY_LEFTSHIFT',
+    'win': 'KEY_LEFTMETA',
+    'command': 'KEY_LEFTMETA',
+    **{f'f{n}': f'KEY_F{n}' for n in range(1, 13)}
+}
+
+# US layout: character -> (evdev key name, needs shift)
+UINPUT_CHARS = {
+    **{c: (f'KEY_{c.upper()}', False) for c in 'abcdefghijklmnopqrstuvwxyz'},
+    **{c.upper(): (f'KEY_{c.upper()}', True) for c in 'abcdefghijklmnopqrstuvwxyz'},
+    **{d: (f'KEY_{d}', False) for d in '0123456789'},
+    **{s: (f'KEY_{d}', True) for s, d in zip(')!@#$%^&*(', '0123456789')},
+    ' ': ('KEY_SPACE', False), '\n': ('KEY_ENTER', False), '\t': ('KEY_TAB', False),
+    '-': ('KEY_MINUS', False), '_': ('KEY_MINUS', True),
+    '=': ('KEY_EQUAL', False), '+': ('KEY_EQUAL', True),
+    '[': ('KEY_LEFTBRACE', False), '{': ('KEY_LEFTBRACE', True),
+    ']': ('KEY_RIGHTBRACE', False), '}': ('KEY_RIGHTBRACE', True),
+    '\\': ('KEY_BACKSLASH', False), '|': ('KEY_BACKSLASH', True),
+    ';': ('KEY_SEMICOLON', False), ':': ('KEY_SEMICOLON', True),
+    "'": ('KEY_APOSTROPHE', False), '"': ('KEY_APOSTROPHE', True),
+    ',': ('KEY_COMMA', False), '<': ('KEY_COMMA', True),
+    '.': ('KEY_DOT', False), '>': ('KEY_DOT', True),
+    '/': ('KEY_SLASH', False), '?': ('KEY_SLASH', True),
+    '`': ('KEY_GRAVE', False), '~': ('KEY_GRAVE', True)
+}
+
+
+class UinputBackend(InjectionBackend):
+    """
+    Kernel-level backend via python-evdev's /dev/uinput device. Works under
+    Wayland and on consoles; characters are mapped through a US layout.
+    """
+
+    name = 'uinput'
+
+    def __init__(self, interval=0.0):
+        super().__init__(interval)
+        from evdev import UInput, ecodes
+        self._ecodes = ecodes
+        self._device = UInput(name='remote-keyboard')
+
+    @classmethod
+    def is_available(cls):
+        try:
+            import evdev  # noqa: F401
+        except ImportError:
+            return False
+        return os.access('/dev/uinput', os.W_OK)
+
+    def _tap(self, code, shift=False):
+        ecodes = self._ecodes
+        if shift:
+            self._device.write(ecodes.EV_KEY, ecodes.KEY_LEFTSHIFT, 1)
+        self._device.write(ecodes.EV_KEY, code, 1)
+        self._device.write(ecodes.EV_KEY, code, 0)
+        if shift:
+            self._device.write(ecodes.EV_KEY, ecodes.KEY_LEFTSHIFT, 0)
+        self._device.syn()
+        if self.interval:
+            time.sleep(self.interval)
+
+    def write(self, text):
+        for char in text:
+            mapping = UINPUT_CHARS.get(char)
+            if mapping is None:
+                print(f"Warning: Character {char!r} has no uinput mapping; skipped.")
+                continue
+            self._tap(getattr(self._ecodes, mapping[0]), mapping[1])
+
+    def press(self, key):
+        self._tap(getattr(self._ecodes, UINPUT_KEY_NAMES[key]))
+
+    def hotkey(self, keys):
+        ecodes = self._ecodes
+        codes = [
+            getattr(ecodes, UINPUT_KEY_NAMES[key] if key in UINPUT_KEY_NAMES else UINPUT_CHARS[key][0])
+            for key in keys
+        ]
+        for code in codes:
+            self._device.write(ecodes.EV_KEY, code, 1)
+        for code in reversed(codes):
+            self._device.write(ecodes.EV_KEY, code, 0)
+        self._device.syn()
+        if self.interval:
+            time.sleep(self.interval)
+
+    def supports_key(self, key):
+        return key in UINPUT_KEY_NAMES or key in UINPUT_CHARS
+
+    def warm_up(self):
+        # Input stacks drop events sent before they finish enumerating a new device.
+        time.sleep(UINPUT_SETTLE_SECONDS)
+
+
+class RecordingBackend(InjectionBackend):
+    """
+    Display-free backend that records what would have been typed. Used by
+    tests and benchmarks to measure dispatch throughput.
+    """
+
+    name = 'recording'
+
+    def __init__(self, interval=0.0):
+        super().__init__(interval)
+        self.actions = []
+        self.chars = 0
+        self.started_at = None
+        self.finished_at = None
+
+    def _record(self, action, value, chars):
+        now = time.perf_counter()
+        if self.started_at is None:
+            self.started_at = now
+        if self.interval:
+            time.sleep(self.interval * chars)
+            now = time.perf_counter()
+        self.actions.append((action, value))
+        self.chars += chars
+        self.finished_at = now
+
+    def write(self, text):
+        self._record('write', text, len(text))
+
+    def press(self, key):
+        self._record('press', key, 1)
+
+    def hotkey(self, keys):
+        self._record('hotkey', keys, 1)
+
+    def supports_key(self, key):
+        return True
+
+    @property
+    def typed_text(self):
+        return ''.join(value for action, value in self.actions if action == 'write')
+
+    def chars_per_second(self):
+        if self.started_at is None or self.finished_at == self.started_at:
+            return 0.0
+        return self.chars / (self.finished_at - self.started_at)
+
+    def reset(self):
+        self.actions.clear()
+        self.chars = 0
+        self.started_at = None
+        self.finished_at = None
+
+
+INJECTION_BACKENDS = {
+    backend.name: backend
+    for backend in (PyAutoGuiBackend, XdotoolBackend, UinputBackend, RecordingBackend)
+}
+
+
+def select_injection_backend(name=None, interval=None):
+    """
+    Build the backend named by `name` (or RK_INJECTION_BACKEND), or pick the
+    fastest available one for this session when the name is empty or 'auto'.
+    """
+    name = (name or os.environ.get(INJECTION_BACKEND_ENV) or 'auto').strip().lower()
+    if interval is None:
+        interval = float(os.environ.get(KEY_INTERVAL_ENV) or 0) / 1000
+
+    if name != 'auto':
+        if name not in INJECTION_BACKENDS:
+            raise ValueError(f"Unknown injection backend '{name}'. Use one of: auto, {', '.join(INJECTION_BACKENDS)}")
+        return INJECTION_BACKENDS[name](interval=interval)
+
+    if os.environ.get('XDG_SESSION_TYPE') == 'wayland':
+        candidates = (UinputBackend, XdotoolBackend, PyAutoGuiBackend)
+    else:
+        candidates = (XdotoolBackend, PyAutoGuiBackend, UinputBackend)
+    for backend in candidates:
+        if backend.is_available():
+            try:
+                return backend(interval=interval)
+            except Exception as error:
+                print(f"[!] Injection backend '{backend.name}' failed to start: {error}")
+
+    print("[!] No keyboard injection backend available; keystrokes will only be recorded.")
+    return RecordingBackend(interval=interval)
+
+
+class ClipboardError(Exception):
+    """The clipboard could not be read or written."""
+
+
+class Clipboard:
+    """Plain-text clipboard used to paste large text instead of typing it."""
+
+    name = 'base'
+
+    @classmethod
+    def is_available(cls):
+        return True
+
+    def get(self):
+        raise NotImplementedError
+
+    def set(self, text):
+        raise NotImplementedError
+
+
+class SystemClipboard(Clipboard):
+    """
+    The desktop clipboard via pyperclip (installed with pyautogui), which
+    shells out to pbcopy, xclip/xsel or wl-clipboard, or uses the Windows API.
+    """
+
+    name = 'system'
+
+    def __init__(self):
+        import pyperclip
+        self._pyperclip = pyperclip
+
+    @classmethod
+    def is_available(cls):
+        try:
+            import pyperclip  # noqa: F401
+        except Exception:
+            return False
+        return True
+
+    def get(self):
+        try:
+            return self._pyperclip.paste()
+        except Exception as error:
+            raise ClipboardError(str(error)) from error
+
+    def set(self, text):
+        try:
+            self._pyperclip.copy(text)
+        except Exception as error:
+            raise ClipboardError(str(error)) from error
+
+
+class MemoryClipboard(Clipboard):
+    """
+    In-process stand-in for headless runs and tests. `history` lists every
+    value set; `broken` makes every call fail like an unreachable clipboard.
+    """
+
+    name = 'memory'
+
+    def __init__(self, text='', broken=False):
+        self.text = text
+        self.broken = broken
+        self.history = []
+
+    def get(self):
+        if self.broken:
+            raise ClipboardError('clipboard unavailable')
+        return self.text
+
+    def set(self, text):
+        if self.broken:
+            raise ClipboardError('clipboard unavailable')
+        self.text = text
+        self.history.append(text)
+
+
+CLIPBOARDS = {clipboard.name: clipboard for clipboard in (SystemClipboard, MemoryClipboard)}
+
+
+def select_clipboard(name=None):
+    """
+    Build the clipboard named by `name` (or RK_CLIPBOARD): 'system' (the
+    default, when pyperclip is importable), 'memory', or 'off' for none.
+    """
+    name = (name or os.environ.get(CLIPBOARD_ENV) or 'auto').strip().lower()
+    if name in ('off', 'none'):
+        return None
+    if name == 'auto':
+        name = 'system'
+        if not SystemClipboard.is_available():
+            return None
+    if name not in CLIPBOARDS:
+        raise ValueError(f"Unknown clipboard '{name}'. Use one of: auto, off, {', '.join(CLIPBOARDS)}")
+    return CLIPBOARDS[name]()
+
+
+# Browser KeyboardEvent.key values -> pyautogui-style key names.
+BROWSER_KEY_NAMES = {
+    'Backspace': 'backspace',
+    'Enter': 'enter',
+    'Space': 'space',
+    'Tab': 'tab',
+    'Escape': 'esc',
+    'ArrowUp': 'up',
+    'ArrowDown': 'down',
+    'ArrowLeft': 'left',
+    'ArrowRight': 'right'
+}
+
+MODIFIER_KEY_NAMES = {
+    'ctrl': 'ctrl',
+    'control': 'ctrl',
+    'alt': 'alt',
+    'option': 'alt',
+    'shift': 'shift',
+    'meta': 'win',
+    'super': 'win',
+    'win': 'win',
+    'cmd': 'command',
+    'command': 'command'
+}
+
+TEXT_CONTROL_KEYS = {'\n': 'enter', '\r': 'enter', '\t': 'tab'}
+
+
+def compile_text(text):
+    """
+    Split text into ('write', run) actions for printable runs and ('press', key)
+    actions for newlines and tabs. Other control characters are dropped.
+    """
+    if text.isprintable():
+        return (('write', text),) if text else ()
+
+    actions = []
+    run = []
+    previous = ''
+    for char in text:
+        if char.isprintable():
+            run.append(char)
+        else:
+            if run:
+                actions.append(('write', ''.join(run)))
+                run = []
+            key = TEXT_CONTROL_KEYS.get(char)
+            # '\r\n' is one line break.
+            if key is not None and not (char == '\n' and previous == '\r'):
+                actions.append(('press', key))
+        previous = char
+    if run:
+        actions.append(('write', ''.join(run)))
+    return tuple(actions)
+
+
+def parse_key_combo(combo):
+    """
+    Parse 'Ctrl+Shift+T' into ('ctrl', 'shift', 't'). Returns None when
+    `combo` is not a modifier combo.
+    """
+    if combo.endswith('++'):
+        head, key = combo[:-2], '+'
+    else:
+        head, _, key = combo.rpartition('+')
+    key = key.strip()
+    if not head or not key:
+        return None
+
+    modifiers = []
+    for part in head.split('+'):
+        modifier = MODIFIER_KEY_NAMES.get(part.strip().lower())
+        if modifier is None:
+            return None
+        if modifier not in modifiers:
+            modifiers.append(modifier)
+    key = BROWSER_KEY_NAMES.get(key, key).lower()
+    return (*modifiers, key)
+
+
+class KeyPlanCompiler:
+    """
+    Compiles (msg_type, payload) into an action plan: a tuple of ('write', text),
+    ('press', key) and ('hotkey', keys) steps that a backend replays without
+    re-parsing. Plans for short payloads are kept in an LRU cache.
+    """
+
+    def __init__(self, supports_key, cache_size=PLAN_CACHE_SIZE):
+        self._supports_key = supports_key
+        self._cached = functools.lru_cache(maxsize=cache_size)(self._compile)
+
+    def compile(self, msg_type, payload):
+        if len(payload) > PLAN_CACHE_MAX_PAYLOAD:
+            return self._compile(msg_type, payload)
+        return self._cached(msg_type, payload)
+
+    def cache_info(self):
+        return self._cached.cache_info()
+
+    def _compile(self, msg_type, payload):
+        if msg_type != 'letter' or len(payload) == 1:
+            return compile_text(payload)
+
+        if '+' in payload:
+            keys = parse_key_combo(payload)
+            if keys is not None and all(self._supports_key(key) for key in keys):
+                return (('hotkey', keys),)
+
+        key = BROWSER_KEY_NAMES.get(payload, payload)
+        if self._supports_key(key):
+            return (('press', key),)
+        if self._supports_key(key.lower()):
+            return (('press', key.lower()),)
+
+        print(f"Warning: Unrecognized key '{payload}' ignored.")
+        return ()
 
 
 class KeyboardController:
     """
-    Handles the actual simulation of keystrokes on the host machine.
+    Handles the actual simulation of keystrokes on the host machine.
+    """
+
+    backend = None
+    compiler = None
+    clipboard = None
+    paste_threshold = PASTE_THRESHOLD_CHARS
+    paste_keys = PASTE_KEYS
+    paste_settle = PASTE_SETTLE_SECONDS
+
+    @classmethod
+    def get_backend(cls):
+        if cls.backend is None:
+            cls.use_backend(PyAutoGuiBackend())
+        return cls.backend
+
+    @classmethod
+    def use_backend(cls, backend):
+        # Plans are checked against the backend's key names, so each backend
+        # gets its own cache.
+        cls.backend = backend
+        cls.compiler = KeyPlanCompiler(backend.supports_key) if backend is not None else None
+
+    @classmethod
+    def warm_up(cls):
+        cls.get_backend().warm_up()
+
+    @classmethod
+    def compile(cls, msg_type, payload):
+        cls.get_backend()
+        return cls.compiler.compile(msg_type, payload)
+
+    @classmethod
+    def run_plan(cls, plan):
+        backend = cls.get_backend()
+        for action, value in plan:
+            getattr(backend, action)(value)
+
+    @classmethod
+    def use_clipboard(cls, clipboard, threshold=None):
+        """Paste text of at least `threshold` characters through `clipboard` (None: always type)."""
+        cls.clipboard = clipboard
+        if threshold is not None:
+            cls.paste_threshold = threshold
+
+    @classmethod
+    def paste_text(cls, text):
+        """
+        Put `text` on the clipboard, send the paste shortcut, then put the
+        previous clipboard contents back. Raises ClipboardError, before
+        anything is pasted, when the clipboard cannot be used.
+        """
+        backend = cls.get_backend()
+        previous = cls.clipboard.get()
+        cls.clipboard.set(text)
+        try:
+            backend.hotkey(cls.paste_keys)
+            # Applications read the clipboard after the shortcut arrives, not during it.
+            time.sleep(cls.paste_settle)
+        finally:
+            try:
+                cls.clipboard.set(previous)
+            except ClipboardError as error:
+                print(f"[!] Could not restore the clipboard: {error}")
+
+    @classmethod
+    def long_enough_to_paste(cls, text):
+        return bool(cls.paste_threshold) and len(text) >= cls.paste_threshold
+
+    @classmethod
+    def try_paste(cls, text, must_type=False):
+        """
+        Paste `text` when it is at least `paste_threshold` characters long.
+        Returns False when it has to be typed instead: it is short, marked
+        `must_type`, there is no clipboard, or the clipboard failed.
+        """
+        if not cls.long_enough_to_paste(text):
+            return False
+        if must_type or cls.clipboard is None:
+            metrics.count_text_path('type')
+            return False
+        try:
+            cls.paste_text(text)
+        except ClipboardError as error:
+            print(f"[!] Clipboard unavailable ({error}); typing instead.")
+            metrics.count_text_path('paste_fallback')
+            return False
+        metrics.count_text_path('paste')
+        return True
+
+    @staticmethod
+    def type_text(text: str, must_type=False):
+        if text and not KeyboardController.try_paste(text, must_type):
+            KeyboardController.run_plan(KeyboardController.compile('word', text))
+
+    @staticmethod
+    def press_key(key: str):
+        KeyboardController.run_plan(KeyboardController.compile('letter', key))
+
+
+def get_sio():
+    global sio
+    if sio is None:
+        import socketio
+
+        sio = socketio.AsyncClient()
+        sio.on('connect', connect)
+        sio.on('disconnect', disconnect)
+        sio.on('keystroke', on_keystroke)
+        sio.on('server-features', on_server_features)
+        sio.on('clock-pong', on_clock_pong)
+    return sio
+
+
+async def connect():
+    print("\n[+] Connected to the server successfully!")
+    if hasattr(sio, 'room_code'):
+        await sio.emit('join-room', (sio.room_code, 'receiver'))
+        print(f"[+] Joined room: {sio.room_code}")
+        print("[*] Waiting for keystrokes... (Press Ctrl+C to exit)")
+
+
+def disconnect():
+    print("\n[-] Disconnected from server.")
+    # The server re-advertises its features on the next connection.
+    ack_batcher.reset()
+    sio.features = {}
+    clock_pings = getattr(sio, 'clock_pings', None)
+    if clock_pings is not None:
+        clock_pings.cancel()
+        sio.clock_pings = None
+    failover = getattr(sio, 'failover', None)
+    if failover is not None:
+        failover.lost()
+
+
+async def on_server_features(features):
+    sio.features = features or {}
+    failover = getattr(sio, 'failover', None)
+    if failover is not None:
+        failover.features_received()
+    await ack_batcher.configure(features)
+    if sio.features.get('clockSync') and getattr(sio, 'clock_pings', None) is None:
+        sio.clock_pings = asyncio.create_task(ping_sender_clocks())
+
+
+async def ping_sender_clocks():
+    """While connected, ask the room's senders for their clocks every CLOCK_PING_INTERVAL_SECONDS."""
+    while sio is not None and sio.connected:
+        room_code = getattr(sio, 'room_code', None)
+        if room_code:
+            try:
+                await sio.emit('clock-ping', {'roomCode': room_code, 't0': wall_ms()})
+            except Exception as error:
+                print(f"[!] Clock ping error: {error}")
+        await asyncio.sleep(CLOCK_PING_INTERVAL_SECONDS)
+
+
+async def on_clock_pong(data):
+    data = data or {}
+    if data.get('senderId') and isinstance(data.get('t0'), (int, float)) and isinstance(data.get('t1'), (int, float)):
+        sender_clock(data['senderId']).add(data['t0'], data['t1'])
+
+
+class LatencyHistogram:
+    """
+    Cumulative Prometheus-style buckets, plus a bounded window of recent
+    samples used for the p50/p95/p99 estimates.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS, sample_size=LATENCY_SAMPLE_SIZE):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.total = 0.0
+        self.samples = deque(maxlen=sample_size)
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        self.samples.append(value)
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[index] += 1
+
+    def percentile(self, fraction):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))]
+
+
+class PipelineMetrics:
+    """
+    Per-event stage timestamps rolled up into latency histograms, event
+    counters, an events/sec rate and queue depth gauges. Thread-safe.
+
+    Stages, in order: sent, received, dequeued, injection_start,
+    injection_end, ack_sent. Each trace is a dict of stage ->
+    time.perf_counter(), plus 'args' describing the event; 'sent' is only
+    there when the sender's clock offset is known (see ClockOffset). The
+    last TRACE_BUFFER_SIZE finished traces are kept for chrome_trace().
+    """
+
+    STAGES = ('sent', 'received', 'dequeued', 'injection_start', 'injection_end', 'ack_sent')
+    INTERVALS = {
+        'network': ('sent', 'received'),
+        'queue_wait': ('received', 'dequeued'),
+        'dispatch': ('dequeued', 'injection_start'),
+        'injection': ('injection_start', 'injection_end'),
+        'ack': ('injection_end', 'ack_sent'),
+        'total': ('received', None),
+        'end_to_end': ('sent', None)
+    }
+    QUANTILES = (0.5, 0.95, 0.99)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queues = {}
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {name: LatencyHistogram() for name in self.INTERVALS}
+            self.received = 0
+            self.executed = 0
+            self.failed = 0
+            self.text_paths = {'type': 0, 'paste': 0, 'paste_fallback': 0}
+            self.traces = deque(maxlen=TRACE_BUFFER_SIZE)
+            self._finished_at = deque()
+
+    def track_queue(self, name, depth):
+        """Register a zero-argument callable reporting a queue's current depth."""
+        self._queues[name] = depth
+
+    def untrack_queue(self, name):
+        self._queues.pop(name, None)
+
+    def queue_depths(self):
+        depths = {}
+        for name, depth in list(self._queues.items()):
+            try:
+                depths[name] = depth()
+            except Exception:
+                continue
+        return depths
+
+    def count_text_path(self, path):
+        """Count how a text write long enough to paste was injected: type, paste or paste_fallback."""
+        with self._lock:
+            self.text_paths[path] += 1
+
+    def start_trace(self, sent=None, **args):
+        """
+        Start a trace at 'received'. `sent` is when the sender sent the event,
+        as a perf_counter() time; `args` (sender, type, ...) label the trace.
+        """
+        with self._lock:
+            self.received += 1
+        now = time.perf_counter()
+        trace = {'received': now, 'args': args}
+        if sent is not None:
+            # An offset estimate is only good to half a round trip; never let the network look negative.
+            trace['sent'] = min(sent, now)
+        return trace
+
+    @staticmethod
+    def mark(trace, stage):
+        if trace is not None:
+            trace[stage] = time.perf_counter()
+
+    def finish(self, trace, ok=True):
+        if trace is None:
+            return
+        last = next(stage for stage in reversed(self.STAGES) if stage in trace)
+        now = time.perf_counter()
+        with self._lock:
+            for name, (start, end) in self.INTERVALS.items():
+                end = end or last
+                if start in trace and end in trace:
+                    self.histograms[name].observe(trace[end] - trace[start])
+            if ok:
+                self.executed += 1
+            else:
+                self.failed += 1
+            trace['ok'] = ok
+            self.traces.append(trace)
+            self._finished_at.append(now)
+            self._trim_rate_window(now)
+
+    def _trim_rate_window(self, now):
+        while self._finished_at and now - self._finished_at[0] > METRICS_RATE_WINDOW_SECONDS:
+            self._finished_at.popleft()
+
+    def events_per_second(self):
+        with self._lock:
+            self._trim_rate_window(time.perf_counter())
+            return len(self._finished_at) / METRICS_RATE_WINDOW_SECONDS
+
+    def render_prometheus(self):
+        rate = self.events_per_second()
+        depths = self.queue_depths()
+        lines = [
+            '# HELP rk_stage_latency_seconds Time spent in each keystroke pipeline stage.',
+            '# TYPE rk_stage_latency_seconds histogram'
+        ]
+        with self._lock:
+            for name, histogram in self.histograms.items():
+                for bound, count in zip(histogram.buckets, histogram.bucket_counts):
+                    lines.append(f'rk_stage_latency_seconds_bucket{{stage="{name}",le="{bound}"}} {count}')
+                lines.append(f'rk_stage_latency_seconds_bucket{{stage="{name}",le="+Inf"}} {histogram.count}')
+                lines.append(f'rk_stage_latency_seconds_sum{{stage="{name}"}} {histogram.total:.6f}')
+                lines.append(f'rk_stage_latency_seconds_count{{stage="{name}"}} {histogram.count}')
+
+            lines.append('# HELP rk_stage_latency_quantile_seconds Recent-window latency percentiles per stage.')
+            lines.append('# TYPE rk_stage_latency_quantile_seconds gauge')
+            for name, histogram in self.histograms.items():
+                for quantile in self.QUANTILES:
+                    value = histogram.percentile(quantile)
+                    lines.append(f'rk_stage_latency_quantile_seconds{{stage="{name}",quantile="{quantile}"}} {value:.6f}')
+
+            lines.extend([
+                '# HELP rk_events_received_total Keystroke events received.',
+                '# TYPE rk_events_received_total counter',
+                f'rk_events_received_total {self.received}',
+                '# HELP rk_events_executed_total Keystroke events executed, by result.',
+                '# TYPE rk_events_executed_total counter',
+                f'rk_events_executed_total{{result="ok"}} {self.executed}',
+                f'rk_events_executed_total{{result="error"}} {self.failed}',
+                '# HELP rk_text_injections_total Text writes of at least the paste threshold, by injection path.',
+                '# TYPE rk_text_injections_total counter'
+            ])
+            for path, count in self.text_paths.items():
+                lines.append(f'rk_text_injections_total{{path="{path}"}} {count}')
+
+        lines.extend([
+            '# HELP rk_events_per_second Executed events per second over the recent window.',
+            '# TYPE rk_events_per_second gauge',
+            f'rk_events_per_second {rate:.3f}',
+            '# HELP rk_queue_depth Events waiting for injection.',
+            '# TYPE rk_queue_depth gauge'
+        ])
+        for name, depth in depths.items():
+            lines.append(f'rk_queue_depth{{queue="{name}"}} {depth}')
+        return '\n'.join(lines) + '\n'
+
+    def chrome_trace(self):
+        """
+        The buffered traces in Chrome trace-event format (load in
+        chrome://tracing or Perfetto): one async slice per event, with a
+        nested slice per stage interval.
+        """
+        with self._lock:
+            traces = list(self.traces)
+        labels = {interval: name for name, interval in self.INTERVALS.items() if interval[1] is not None}
+        events = []
+        for number, trace in enumerate(traces, start=1):
+            args = dict(trace.get('args') or {}, ok=trace.get('ok', True))
+            stages = [(stage, trace[stage] * 1e6) for stage in self.STAGES if stage in trace]
+            common = {'cat': 'keystroke', 'id': number, 'pid': 1, 'tid': str(args.get('sender', 'receiver'))}
+            name = str(args.get('type') or 'event')
+            events.append({**common, 'name': name, 'ph': 'b', 'ts': stages[0][1], 'args': args})
+            for (start, started), (end, ended) in zip(stages, stages[1:]):
+                label = labels.get((start, end), f'{start}-{end}')
+                events.append({**common, 'name': label, 'ph': 'b', 'ts': started})
+                events.append({**common, 'name': label, 'ph': 'e', 'ts': ended})
+            events.append({**common, 'name': name, 'ph': 'e', 'ts': stages[-1][1]})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def summary_line(self):
+        rate = self.events_per_second()
+        depth = sum(self.queue_depths().values())
+        with self._lock:
+            total = self.histograms['total']
+            queue_wait = self.histograms['queue_wait']
+            injection = self.histograms['injection']
+            end_to_end = self.histograms['end_to_end']
+            paths = self.text_paths
+            return (
+                f"[metrics] events ok={self.executed} error={self.failed} rate={rate:.1f}/s queue={depth} "
+                f"total p50/p95/p99={total.percentile(0.5) * 1000:.1f}/{total.percentile(0.95) * 1000:.1f}/"
+                f"{total.percentile(0.99) * 1000:.1f}ms "
+                f"queue_wait p95={queue_wait.percentile(0.95) * 1000:.1f}ms "
+                f"injection p95={injection.percentile(0.95) * 1000:.1f}ms "
+                f"end_to_end p95={end_to_end.percentile(0.95) * 1000:.1f}ms "
+                f"large text type/paste/fallback={paths['type']}/{paths['paste']}/{paths['paste_fallback']}"
+            )
+
+
+metrics = PipelineMetrics()
+
+
+def wall_ms():
+    return time.time() * 1000
+
+
+class ClockOffset:
+    """
+    NTP-style estimate of a sender's clock against this host's. The host
+    sends a ping stamped t0, the sender answers with its own clock t1, and
+    the answer arrives at t3 (all milliseconds since the epoch). Then
+    offset = t1 - (t0 + t3) / 2, accurate to within half the round trip.
+    The sample with the shortest round trip among the last CLOCK_SAMPLES is
+    used.
+    """
+
+    def __init__(self, samples=CLOCK_SAMPLES):
+        self.samples = deque(maxlen=samples)
+
+    def add(self, t0, t1, t3=None):
+        t3 = wall_ms() if t3 is None else t3
+        if t3 >= t0:
+            self.samples.append((t3 - t0, t1 - (t0 + t3) / 2))
+
+    @property
+    def offset(self):
+        return min(self.samples)[1] if self.samples else None
+
+    @property
+    def round_trip(self):
+        return min(self.samples)[0] if self.samples else None
+
+    def to_host(self, sent_at):
+        """The time.perf_counter() time of `sent_at` on the sender's clock, or None if not synced yet."""
+        if sent_at is None or not self.samples:
+            return None
+        try:
+            host_ms = float(sent_at) - self.offset
+        except (TypeError, ValueError):
+            return None
+        return host_ms / 1000 - (time.time() - time.perf_counter())
+
+
+# Internet senders' clocks, by the Socket.IO id the server reports.
+sender_clocks = OrderedDict()
+
+
+def sender_clock(sender_id):
+    clock = sender_clocks.get(sender_id)
+    if clock is None:
+        clock = sender_clocks[sender_id] = ClockOffset()
+        while len(sender_clocks) > CLOCK_SENDERS_MAX:
+            sender_clocks.popitem(last=False)
+    return clock
+
+
+class MetricsReporter:
+    """
+    Prints metrics.summary_line() periodically while events are flowing.
+    Run it as a task; cancel the task to stop it.
+    """
+
+    def __init__(self, interval=METRICS_LOG_INTERVAL_SECONDS, pipeline_metrics=None):
+        self.interval = interval
+        self.metrics = pipeline_metrics or metrics
+        self._last_reported = None
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            seen = (self.metrics.received, self.metrics.executed + self.metrics.failed)
+            if seen != self._last_reported:
+                print(self.metrics.summary_line())
+                self._last_reported = seen
+
+
+class EventCursorStore:
+    """
+    Last executed event id per server+room, persisted across restarts.
+
+    Updates are appended to a log as one small JSON line and flushed, so an
+    update costs one write() instead of rewriting the file, and a crash can
+    at worst lose a torn final line. Once the log holds `compact_after`
+    records it is rewritten with one line per room via a temp file and
+    os.replace(). Thread-safe.
+    """
+
+    def __init__(self, path, compact_after=CURSOR_COMPACT_AFTER):
+        self.path = path
+        self.compact_after = compact_after
+        self._lock = threading.Lock()
+        self._cursors = {}
+        self._records = 0
+        self._file = None
+        self._load()
+
+    @classmethod
+    def open_default(cls, state_dir=None):
+        state_dir = state_dir or os.environ.get(STATE_DIR_ENV) or DEFAULT_STATE_DIR
+        os.makedirs(state_dir, exist_ok=True)
+        return cls(os.path.join(state_dir, CURSOR_LOG_NAME))
+
+    @staticmethod
+    def _key(server_url, room_code):
+        return f"{server_url}#{room_code}"
+
+    def _load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as handle:
+                for line in handle:
+                    try:
+                        record = json.loads(line)
+                        self._cursors[record['key']] = (record.get('epoch'), int(record['id']))
+                    except (ValueError, KeyError, TypeError):
+                        # Torn write from a crash; everything before it is intact.
+                        continue
+                    self._records += 1
+        except FileNotFoundError:
+            pass
+
+    def get(self, server_url, room_code):
+        """Return (epoch, last_event_id); (None, 0) for a room never seen."""
+        with self._lock:
+            return self._cursors.get(self._key(server_url, room_code), (None, 0))
+
+    def advance(self, server_url, room_code, event_id, epoch=None):
+        """Record `event_id` as executed. Ignores ids at or behind the cursor of the same epoch."""
+        key = self._key(server_url, room_code)
+        with self._lock:
+            current_epoch, current_id = self._cursors.get(key, (None, 0))
+            if epoch == current_epoch and event_id <= current_id:
+                return False
+            self._cursors[key] = (epoch, event_id)
+            if self._records >= self.compact_after:
+                self._compact()
+            else:
+                self._append({'key': key, 'epoch': epoch, 'id': event_id})
+            return True
+
+    def _append(self, record):
+        if self._file is None:
+            self._file = open(self.path, 'a', encoding='utf-8')
+        self._file.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self._file.flush()
+        self._records += 1
+
+    def _compact(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as handle:
+            for key, (epoch, event_id) in self._cursors.items():
+                handle.write(json.dumps({'key': key, 'epoch': epoch, 'id': event_id}, separators=(',', ':')) + '\n')
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.replace(temp_path, self.path)
+        self._records = len(self._cursors)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._file.close()
+                self._file = None
+
+
+class EventRecorder:
+    """
+    Writes every event the receiver queues to a JSON-lines session file, one
+    {"t", "sender", "type", "payload"} record per line, where `t` is seconds
+    since recording started. benchmarks/replay.py plays these files back.
+    """
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.count = 0
+        self._file = open(path, 'w', encoding='utf-8', buffering=1)
+        self._started = time.monotonic()
+
+    def record(self, sender, msg_type, payload):
+        self._file.write(json.dumps({
+            't': round(time.monotonic() - self._started, 6),
+            'sender': sender,
+            'type': msg_type,
+            'payload': payload
+        }) + '\n')
+        self.count += 1
+
+    def close(self):
+        self._file.close()
+
+
+class ExecutedEventIndex:
+    """
+    Bounded set of recently executed event keys, oldest evicted first, used to
+    drop events that are delivered twice. Thread-safe.
+    """
+
+    def __init__(self, capacity=EXECUTED_INDEX_SIZE):
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._order = deque()
+        self._keys = set()
+
+    def claim(self, key):
+        """Mark `key` as executed; False when it already was."""
+        with self._lock:
+            if key in self._keys:
+                return False
+            self._keys.add(key)
+            self._order.append(key)
+            if len(self._order) > self.capacity:
+                self._keys.discard(self._order.popleft())
+            return True
+
+    def release(self, key):
+        """Forget `key` again, for an event that was claimed but never ran."""
+        with self._lock:
+            if key in self._keys:
+                self._keys.discard(key)
+                self._order.remove(key)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._keys
+
+    def __len__(self):
+        with self._lock:
+            return len(self._keys)
+
+
+executed_events = ExecutedEventIndex()
+
+
+SNIPPET_RECORD = struct.Struct('<16sI')
+SNIPPET_USED = 0xFFFFFFFF
+SNIPPET_PLACEHOLDER = re.compile(r'\{\{\s*([\w.-]+)\s*\}\}')
+
+
+class SnippetMissing(Exception):
+    """A 'snippet' event named text this receiver does not hold; the sender should send it in full."""
+
+    def __init__(self, digest):
+        super().__init__(f"unknown snippet {digest}")
+        self.digest = digest
+
+
+def snippet_digest(text):
+    """Leading SNIPPET_DIGEST_SIZE bytes of the SHA-256 of `text`, in hex; the web pages compute the same."""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:SNIPPET_DIGEST_SIZE * 2]
+
+
+def _open_private(path, mode):
+    """Open `path` for binary writing ('ab' or 'wb') as a file only this user can read."""
+    flags = os.O_WRONLY | os.O_CREAT | (os.O_APPEND if mode == 'ab' else os.O_TRUNC) | getattr(os, 'O_BINARY', 0)
+    fd = os.open(path, flags, 0o600)
+    if hasattr(os, 'fchmod'):
+        # The mode above only applies to new files.
+        os.fchmod(fd, 0o600)
+    return os.fdopen(fd, mode)
+
+
+def parse_snippet_payload(payload):
+    """Split a 'snippet' payload, "<digest>" or "<digest>?name=value&...", into (digest, params)."""
+    digest, _, query = (payload or '').partition('?')
+    return digest.strip().lower(), dict(parse_qsl(query, keep_blank_values=True))
+
+
+def fill_snippet(text, params):
+    """Replace each {{name}} in `text` with params[name]; unknown names are left as they are."""
+    if not params:
+        return text
+    return SNIPPET_PLACEHOLDER.sub(lambda match: params.get(match.group(1), match.group(0)), text)
+
+
+class SnippetStore:
+    """
+    Block texts the receiver has typed, by content digest, so a sender can
+    repeat one by digest instead of sending it again. The least recently used
+    are evicted once their stored size passes `max_bytes`.
+
+    On disk this is an append-only log: each record is a 16-byte digest and a
+    u32 length followed by that many bytes of zlib-compressed UTF-8, or, with
+    length 0xFFFFFFFF and no body, a note that the snippet was used. Loading
+    replays the log through the same LRU, so evictions and recency come back
+    without being written. Only the index is held in memory; texts are read
+    back on use. The log is rewritten, oldest first, once it is more than
+    twice the size of what it still holds.
+
+    The texts are whatever senders typed, so the log is readable only by
+    this user and its directory is created private. Thread-safe, so its
+    disk I/O can run off the event loop.
+    """
+
+    def __init__(self, path, max_bytes=SNIPPET_CACHE_MB * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._index = OrderedDict()
+        self._bytes = 0
+        self._end = 0
+        self._file = None
+        self._load()
+
+    @classmethod
+    def open_default(cls, state_dir=None, max_bytes=SNIPPET_CACHE_MB * 1024 * 1024):
+        state_dir = state_dir or os.environ.get(STATE_DIR_ENV) or DEFAULT_STATE_DIR
+        os.makedirs(state_dir, mode=0o700, exist_ok=True)
+        return cls(os.path.join(state_dir, SNIPPET_LOG_NAME), max_bytes)
+
+    def _load(self):
+        try:
+            handle = open(self.path, 'rb')
+        except FileNotFoundError:
+            return
+        with handle:
+            size = os.fstat(handle.fileno()).st_size
+            while self._end + SNIPPET_RECORD.size <= size:
+                digest, length = SNIPPET_RECORD.unpack(handle.read(SNIPPET_RECORD.size))
+                offset = self._end + SNIPPET_RECORD.size
+                if length == SNIPPET_USED:
+                    if digest in self._index:
+                        self._index.move_to_end(digest)
+                elif offset + length <= size:
+                    handle.seek(length, os.SEEK_CUR)
+                    self._insert(digest, offset, length)
+                    offset += length
+                else:
+                    # Torn write from a crash; everything before it is intact.
+                    break
+                self._end = offset
+
+    def _insert(self, digest, offset, length):
+        self._index[digest] = (offset, length)
+        self._bytes += length
+        while self._bytes > self.max_bytes and len(self._index) > 1:
+            _, (_, evicted) = self._index.popitem(last=False)
+            self._bytes -= evicted
+
+    def _append(self, digest, body=None):
+        if self._file is None:
+            self._file = _open_private(self.path, 'ab')
+            # Drop a torn record so new ones start on a record boundary.
+            self._file.truncate(self._end)
+        length = SNIPPET_USED if body is None else len(body)
+        self._file.write(SNIPPET_RECORD.pack(digest, length) + (body or b''))
+        self._file.flush()
+        offset = self._end + SNIPPET_RECORD.size
+        self._end = offset + (len(body) if body is not None else 0)
+        return offset
+
+    def __contains__(self, digest):
+        try:
+            return bytes.fromhex(digest) in self._index
+        except (TypeError, ValueError):
+            return False
+
+    def __len__(self):
+        return len(self._index)
+
+    def put(self, text):
+        """Keep `text` and return its digest."""
+        digest = snippet_digest(text)
+        key = bytes.fromhex(digest)
+        body = None if key in self._index else zlib.compress(text.encode('utf-8'))
+        with self._lock:
+            if body is None or key in self._index:
+                self._index.move_to_end(key)
+                self._append(key)
+            elif len(body) <= self.max_bytes:
+                self._insert(key, self._append(key, body), len(body))
+            self._maybe_compact()
+        return digest
+
+    def get(self, digest):
+        """The text stored under `digest`, or None."""
+        try:
+            key = bytes.fromhex(digest)
+        except (TypeError, ValueError):
+            return None
+        with self._lock:
+            return self._get(digest, key)
+
+    def _get(self, digest, key):
+        if key not in self._index:
+            return None
+        offset, length = self._index[key]
+        try:
+            with open(self.path, 'rb') as handle:
+                handle.seek(offset)
+                text = zlib.decompress(handle.read(length)).decode('utf-8')
+        except (OSError, zlib.error, UnicodeDecodeError):
+            text = None
+        if text is None or snippet_digest(text) != digest:
+            print(f"[!] Snippet {digest} is damaged; it will be fetched again.")
+            del self._index[key]
+            self._bytes -= length
+            return None
+        self._index.move_to_end(key)
+        self._append(key)
+        self._maybe_compact()
+        return text
+
+    def resolve(self, payload):
+        """The text a 'snippet' payload stands for, with its parameters filled in."""
+        digest, params = parse_snippet_payload(payload)
+        text = self.get(digest)
+        if text is None:
+            raise SnippetMissing(digest)
+        return fill_snippet(text, params)
+
+    def _maybe_compact(self):
+        live = self._bytes + SNIPPET_RECORD.size * len(self._index)
+        if self._end > 2 * live + 64 * 1024:
+            self._compact()
+
+    def _compact(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        temp_path = self.path + '.tmp'
+        index = OrderedDict()
+        end = 0
+        with open(self.path, 'rb') as source, _open_private(temp_path, 'wb') as handle:
+            for key, (offset, length) in self._index.items():
+                source.seek(offset)
+                handle.write(SNIPPET_RECORD.pack(key, length) + source.read(length))
+                end += SNIPPET_RECORD.size
+                index[key] = (end, length)
+                end += length
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.replace(temp_path, self.path)
+        self._index = index
+        self._end = end
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._file.close()
+                self._file = None
+
+
+def handle_keystroke(msg_type, payload, must_type=False):
+    if msg_type == 'letter':
+        KeyboardController.press_key(payload)
+    elif msg_type in ['word', 'block'] and must_type:
+        KeyboardController.type_text(payload, must_type=True)
+    elif msg_type in ['word', 'block']:
+        KeyboardController.type_text(payload)
+
+
+# Keys that jump ahead of queued text and stop a streaming block.
+PRIORITY_KEYS = frozenset({'Escape', 'Esc', 'esc'})
+
+
+def is_priority_event(msg_type, payload):
+    return msg_type == 'cancel' or (msg_type == 'letter' and payload in PRIORITY_KEYS)
+
+
+def split_text_chunks(text, size=STREAM_CHUNK_CHARS):
+    """Yield `text` in pieces of about `size` characters, never splitting a '\\r\\n'."""
+    start = 0
+    while start < len(text):
+        end = start + size
+        if end < len(text) and text[end - 1] == '\r' and text[end] == '\n':
+            end += 1
+        yield text[start:end]
+        start = end
+
+
+class SenderBacklogFull(Exception):
+    """An event was dropped because its sender, which cannot be paused, already had too many queued."""
+
+    def __init__(self, sender, limit):
+        super().__init__(f"dropped: {sender} already has {limit} events queued")
+        self.sender = sender
+        self.limit = limit
+
+
+class InjectionInterrupted(Exception):
+    """A text event stopped early; `typed` of its `total` characters were injected."""
+
+    def __init__(self, typed, total, reason='cancelled'):
+        super().__init__(f"{reason} after {typed} of {total} characters")
+        self.typed = typed
+        self.total = total
+        self.reason = reason
+
+    @property
+    def cancelled(self):
+        return self.reason == 'cancelled'
+
+
+def execution_status(error, snippet=None):
+    """
+    The ok/error fields of an execution ack, plus partial progress for
+    interrupted text, the digest a block was kept under, or a snippet miss.
+    """
+    status = {'ok': error is None}
+    if error is not None:
+        status['error'] = str(error)
+    if isinstance(error, InjectionInterrupted):
+        status.update(typed=error.typed, total=error.total, cancelled=error.cancelled)
+    if isinstance(error, SnippetMissing):
+        status['snippetMiss'] = True
+    if snippet is not None:
+        status['snippet'] = snippet
+    return status
+
+
+def is_coalescable(msg_type, payload):
+    if not isinstance(payload, str) or not payload:
+        return False
+    if msg_type == 'letter':
+        return len(payload) == 1 and payload.isprintable()
+    return msg_type in ('word', 'block')
+
+
+def is_batchable(item):
+    """Whether a queued item may share one write with its neighbours (see LocalSequencer.get_batch)."""
+    return is_coalescable(item[0], item[1]) and len(item[1]) <= STREAM_CHUNK_CHARS
+
+
+BACKSPACE_KEYS = frozenset({'Backspace', 'backspace'})
+
+
+def compact_backlog(events):
+    """
+    Fold a backlog of polled events into fewer injections. A run of text
+    events (printable letters, words, blocks) becomes one write, and a
+    Backspace that deletes a character typed earlier in the run cancels it
+    instead of being pressed; a '\r\n' line break counts as one character. Any other key ends the run and stays as it is.
+
+    Returns [(msg_type, payload, covered), ...] in order, where `covered`
+    lists the original events that action stands for.
+    """
+    actions = []
+    text = []
+    covered = []
+
+    def flush():
+        if len(covered) == 1 and text == list(covered[0]['payload']):
+            actions.append((covered[0]['type'], covered[0]['payload'], covered[:]))
+        elif covered:
+            actions.append(('word', ''.join(text), covered[:]))
+        text.clear()
+        covered.clear()
+
+    for event in events:
+        msg_type = event.get('type')
+        payload = event.get('payload')
+        if is_coalescable(msg_type, payload):
+            text.extend(payload)
+            covered.append(event)
+        elif msg_type == 'letter' and payload in BACKSPACE_KEYS and text:
+            # '\r\n' is typed as one Enter, so one Backspace takes both.
+            del text[-2 if text[-2:] == ['\r', '\n'] else -1:]
+            covered.append(event)
+        else:
+            flush()
+            actions.append((msg_type, payload, [event]))
+    flush()
+    return actions
+
+
+MIRROR_EVENT_TYPES = frozenset({'mirror', 'mirror-base'})
+
+
+def diff_text(old, new, max_edits=MIRROR_DIFF_MAX_EDITS):
+    """
+    A shortest edit script from `old` to `new` as hunks (start, deleted,
+    inserted), `start` indexing `old` in ascending order. Uses Myers' O(ND)
+    algorithm on whatever is left once the common prefix and suffix are
+    trimmed; beyond `max_edits` edits the differing middle becomes one hunk.
+    """
+    prefix = 0
+    limit = min(len(old), len(new))
+    while prefix < limit and old[prefix] == new[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and old[-1 - suffix] == new[-1 - suffix]:
+        suffix += 1
+    a = old[prefix:len(old) - suffix]
+    b = new[prefix:len(new) - suffix]
+    if not a and not b:
+        return []
+    if not a or not b:
+        return [(prefix, len(a), b)]
+
+    n, m = len(a), len(b)
+    frontier = {1: 0}
+    trace = []
+    for d in range(min(n + m, max_edits) + 1):
+        trace.append(dict(frontier))
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and frontier[k - 1] < frontier[k + 1]):
+                x = frontier[k + 1]
+            else:
+                x = frontier[k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[x] == b[y]:
+                x += 1
+                y += 1
+            frontier[k] = x
+            if x >= n and y >= m:
+                return _myers_hunks(trace, a, b, prefix, d)
+    return [(prefix, n, b)]
+
+
+def _myers_hunks(trace, a, b, offset, d):
+    # Walk the saved frontiers back from (len(a), len(b)), collecting single-character edits.
+    x, y = len(a), len(b)
+    edits = []
+    for depth in range(d, 0, -1):
+        frontier = trace[depth]
+        k = x - y
+        if k == -depth or (k != depth and frontier[k - 1] < frontier[k + 1]):
+            previous_k = k + 1
+        else:
+            previous_k = k - 1
+        previous_x = frontier[previous_k]
+        previous_y = previous_x - previous_k
+        while x > previous_x and y > previous_y:
+            x -= 1
+            y -= 1
+        if x == previous_x:
+            edits.append((x, None, b[previous_y]))
+        else:
+            edits.append((previous_x, a[previous_x], None))
+        x, y = previous_x, previous_y
+    edits.reverse()
+
+    hunks = []
+    for position, deleted, inserted in edits:
+        if hunks and hunks[-1][0] + hunks[-1][1] == position:
+            start, count, text = hunks[-1]
+            hunks[-1] = (start, count + (deleted is not None), text + (inserted or ''))
+        else:
+            hunks.append((position, int(deleted is not None), inserted or ''))
+    return [(start + offset, count, text) for start, count, text in hunks]
+
+
+def mirror_plan(old, new, caret):
+    """
+    Keystrokes that turn a field holding `old`, with the caret at `caret`,
+    into one holding `new`: arrow moves, Backspace or Delete (whichever needs
+    fewer moves) and typed inserts. Returns (plan, caret afterwards).
+    """
+    plan = []
+
+    def move(target):
+        steps = target - caret
+        plan.extend((('press', 'right'),) * steps if steps > 0 else (('press', 'left'),) * -steps)
+        return target
+
+    shift = 0
+    for start, deleted, inserted in diff_text(old, new):
+        position = start + shift
+        if deleted and abs(caret - (position + deleted)) <= abs(caret - position):
+            move(position + deleted)
+            plan.extend((('press', 'backspace'),) * deleted)
+        else:
+            move(position)
+            plan.extend((('press', 'delete'),) * deleted)
+        plan.extend(compile_text(inserted))
+        caret = position + len(inserted)
+        shift += len(inserted) - deleted
+    return tuple(plan), caret
+
+
+class MirrorSnapshot:
+    """A queued mirror event: the sender's whole text field at `version`, a (generation, version) pair."""
+
+    __slots__ = ('sender', 'version', 'text', 'base')
+
+    def __init__(self, sender, version, text, base=False):
+        self.sender = sender
+        self.version = version
+        self.text = text
+        self.base = base
+
+
+class MirrorTracker:
+    """
+    What each mirroring sender's text field last looked like on this
+    machine, and where the caret was left.
+
+    A 'mirror-base' event says the target already holds the text (the sender
+    just switched to mirror mode or reconnected); a 'mirror' event asks for
+    the target to be edited to match. offer() drops events older than the
+    newest one seen, so late snapshots never undo newer ones; plan() skips
+    snapshots that a newer queued one supersedes, so a burst of edits is
+    typed as one diff. Events without a version are numbered on arrival.
+    Versions are only compared within one `epoch`: a sender seen under a new
+    one (the server restarted and numbers its events from 1 again) starts a
+    new generation, which is newer than anything from the old epoch.
+    """
+
+    def __init__(self, max_sessions=MIRROR_SESSIONS_MAX):
+        self.max_sessions = max_sessions
+        self._latest = OrderedDict()
+        self._fields = {}
+
+    def offer(self, sender, msg_type, text, version=None, epoch=None):
+        """A MirrorSnapshot to queue, or None when `version` is stale."""
+        latest_epoch, generation, latest = self._latest.get(sender, (epoch, 0, 0))
+        if epoch != latest_epoch:
+            generation, latest = generation + 1, 0
+        version = latest + 1 if version is None else version
+        if version <= latest:
+            return None
+        self._latest[sender] = (epoch, generation, version)
+        self._latest.move_to_end(sender)
+        while len(self._latest) > self.max_sessions:
+            forgotten, _ = self._latest.popitem(last=False)
+            self._fields.pop(forgotten, None)
+        return MirrorSnapshot(sender, (generation, version), text or '', base=msg_type == 'mirror-base')
+
+    def plan(self, snapshot):
+        """(keystrokes, caret afterwards) for `snapshot`, or None when a newer one supersedes it."""
+        if snapshot.base:
+            return (), len(snapshot.text)
+        _, generation, latest = self._latest.get(snapshot.sender, (None, 0, 0))
+        if snapshot.version < (generation, latest):
+            return None
+        text, caret = self._fields.get(snapshot.sender, ('', 0))
+        return mirror_plan(text, snapshot.text, caret)
+
+    def commit(self, snapshot, caret):
+        """Record that the target now holds `snapshot`, once its plan has been typed."""
+        self._fields[snapshot.sender] = (snapshot.text, caret)
+
+    def text(self, sender):
+        return self._fields.get(sender, ('', 0))[0]
+
+
+class _SenderQueue:
+
+    def __init__(self, rate, burst):
+        self.items = deque()
+        self.priority = deque()
+        self.rate = rate
+        self.tokens = burst
+        self.burst = burst
+        self.refilled_at = None
+        self.closed = False
+
+    def take_token(self, now):
+        """Spend one rate-limit token; returns 0, or seconds until one is available."""
+        if not self.rate:
+            return 0
+        if self.refilled_at is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.refilled_at) * self.rate)
+        self.refilled_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class LocalSequencer:
+    """
+    The single feed from every sender (local /ws connections and internet
+    transports alike) into the injector.
+
+    Each sender gets its own bounded FIFO, so its events stay in order and a
+    full queue only blocks that sender. get() serves senders round-robin,
+    skipping senders that are over their `rate` (events/sec, 0 for no limit)
+    and, while a sender holds the focus lock, everyone but that sender.
+    Events queued with put_priority() are served before any queued text and
+    are not rate limited. Must be used from a single event loop.
+    """
+
+    def __init__(self, max_per_sender=LOCAL_SENDER_QUEUE_SIZE, rate=0.0, burst=None):
+        self.max_per_sender = max_per_sender
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self.focus_owner = None
+        self._senders = {}
+        self._order = deque()
+        self._ready = asyncio.Event()
+        self._space = asyncio.Event()
+
+    def register(self, sender):
+        if sender not in self._senders:
+            self._senders[sender] = _SenderQueue(self.rate, self.burst)
+            self._order.append(sender)
+
+    def unregister(self, sender):
+        """
+        Forget a sender once its queued events have been injected, and free
+        the focus lock if it held it.
+        """
+        state = self._senders.get(sender)
+        if state is None:
+            return
+        state.closed = True
+        if not state.items and not state.priority:
+            self._drop(sender)
+        if self.focus_owner == sender:
+            self.focus_owner = None
+        self._ready.set()
+
+    def _drop(self, sender):
+        del self._senders[sender]
+        self._order.remove(sender)
+
+    async def put(self, sender, item):
+        state = self._senders[sender]
+        while len(state.items) >= self.max_per_sender:
+            self._space.clear()
+            await self._space.wait()
+        self.put_nowait(sender, item)
+
+    def put_nowait(self, sender, item, limit=None):
+        """
+        Queue without waiting for room, for transports that cannot be paused.
+        Returns False, queueing nothing, when the sender already has `limit`
+        events waiting.
+        """
+        state = self._senders[sender]
+        if limit is not None and len(state.items) >= limit:
+            return False
+        state.items.append(item)
+        self._ready.set()
+        return True
+
+    def put_priority(self, sender, item):
+        self._senders[sender].priority.append(item)
+        self._ready.set()
+
+    def discard(self, sender):
+        """Remove and return the sender's queued (non-priority) events."""
+        state = self._senders.get(sender)
+        if state is None:
+            return []
+        items = list(state.items)
+        state.items.clear()
+        if state.closed and not state.priority:
+            self._drop(sender)
+        self._space.set()
+        return items
+
+    async def get(self):
+        """Return (sender, item) for the next event to inject."""
+        sender, batch = await self.get_batch(0)
+        return sender, batch[0]
+
+    async def get_batch(self, max_chars=MAX_COALESCED_CHARS):
+        """
+        Like get(), but when the chosen event is short plain text, also take
+        that sender's following short text events, up to `max_chars` in all,
+        as one batch. Text longer than STREAM_CHUNK_CHARS is never batched, so
+        it is still streamed with progress and can be stopped.
+        Returns (sender, [item, ...]); items are (msg_type, payload, ...) tuples.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            for sender in self._order:
+                state = self._senders[sender]
+                if state.priority and self.focus_owner in (None, sender):
+                    item = state.priority.popleft()
+                    if state.closed and not state.items and not state.priority:
+                        self._drop(sender)
+                    return sender, [item]
+
+            retry_in = None
+            for _ in range(len(self._order)):
+                sender = self._order[0]
+                self._order.rotate(-1)
+                state = self._senders[sender]
+                if not state.items or self.focus_owner not in (None, sender):
+                    continue
+                delay = state.take_token(loop.time())
+                if delay:
+                    retry_in = delay if retry_in is None else min(retry_in, delay)
+                    continue
+                batch = [state.items.popleft()]
+                if max_chars and not state.rate and is_batchable(batch[0]):
+                    size = len(batch[0][1])
+                    while (state.items and is_batchable(state.items[0])
+                           and size + len(state.items[0][1]) <= max_chars):
+                        batch.append(state.items.popleft())
+                        size += len(batch[-1][1])
+                if state.closed and not state.items and not state.priority:
+                    self._drop(sender)
+                self._space.set()
+                return sender, batch
+            self._ready.clear()
+            try:
+                await asyncio.wait_for(self._ready.wait(), retry_in)
+            except asyncio.TimeoutError:
+                pass
+
+    def acquire_focus(self, sender):
+        """Take the exclusive focus lock; False when another sender holds it."""
+        if self.focus_owner not in (None, sender):
+            return False
+        self.focus_owner = sender
+        return True
+
+    def release_focus(self, sender):
+        if self.focus_owner == sender:
+            self.focus_owner = None
+            self._ready.set()
+
+    def depth(self, sender):
+        state = self._senders.get(sender)
+        return len(state.items) + len(state.priority) if state is not None else 0
+
+    def depths(self):
+        return {sender: len(state.items) + len(state.priority) for sender, state in list(self._senders.items())}
+
+    def qsize(self):
+        return sum(self.depths().values())
+
+
+class SharedRing:
+    """
+    Single-producer, single-consumer ring of fixed-size records in shared
+    memory. The block starts with two u64 counters, records written (head)
+    and records read (tail), followed by `slots` slots. Only the producer
+    writes head and only the consumer writes tail, so neither side takes a
+    lock. Each slot starts with a stamp, the record's position plus one and
+    the CRC-32 of its bytes, written after the record and before head. Weakly
+    ordered CPUs can make head visible before the record lands; the consumer
+    then finds a stale stamp or checksum and leaves the slot for a later get.
+    """
+
+    COUNTERS = struct.Struct('<QQ')
+    STAMP = struct.Struct('<QI4x')
+    DATA_OFFSET = 64
+
+    def __init__(self, name=None, slots=INJECTOR_RING_SLOTS, record_size=INJECTOR_RECORD_SIZE):
+        from multiprocessing import shared_memory
+
+        self.slots = slots
+        self.record_size = record_size
+        self.slot_size = self.STAMP.size + record_size
+        if name is None:
+            self._shm = shared_memory.SharedMemory(create=True, size=self.DATA_OFFSET + slots * self.slot_size)
+            self.COUNTERS.pack_into(self._shm.buf, 0, 0, 0)
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+        self.name = self._shm.name
+        self._owner = name is None
+
+    def __len__(self):
+        head, tail = self.COUNTERS.unpack_from(self._shm.buf, 0)
+        return head - tail
+
+    def put(self, record):
+        """Append one record (at most record_size bytes); False when the ring is full."""
+        buf = self._shm.buf
+        head, tail = self.COUNTERS.unpack_from(buf, 0)
+        if head - tail >= self.slots:
+            return False
+        offset = self.DATA_OFFSET + (head % self.slots) * self.slot_size
+        start = offset + self.STAMP.size
+        record = bytes(record).ljust(self.record_size, b'\0')
+        buf[start:start + self.record_size] = record
+        self.STAMP.pack_into(buf, offset, head + 1, zlib.crc32(record))
+        struct.pack_into('<Q', buf, 0, head + 1)
+        return True
+
+    def get(self):
+        """Remove and return the oldest record, or None when the ring is empty or it has not landed yet."""
+        buf = self._shm.buf
+        head, tail = self.COUNTERS.unpack_from(buf, 0)
+        if head == tail:
+            return None
+        offset = self.DATA_OFFSET + (tail % self.slots) * self.slot_size
+        position, checksum = self.STAMP.unpack_from(buf, offset)
+        start = offset + self.STAMP.size
+        record = bytes(buf[start:start + self.record_size])
+        if position != tail + 1 or zlib.crc32(record) != checksum:
+            return None
+        struct.pack_into('<Q', buf, 8, tail + 1)
+        return record
+
+    def close(self):
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+# Injector messages are split across ring records of
+#   u32 seq, u8 op (requests) or status (results), u8 flags, u8 code, u32 length, data
+# Requests: flags 1 must type, 2 more records follow; code is the event type.
+# Results: status 0 ok or 1 error (data is the message); flags 2 more records
+# follow, upper four bits the text path taken (see INJECTOR_TEXT_PATHS);
+# code is the return value (0 None, 1 False, 2 True).
+INJECTOR_RECORD = struct.Struct('<IBBBxI')
+INJECTOR_OPS = {'type_text': 1, 'try_paste': 2, 'handle_keystroke': 3, 'run_plan': 4}
+INJECTOR_STOP = 255
+INJECTOR_MUST_TYPE = 1
+INJECTOR_MORE = 2
+INJECTOR_TEXT_PATHS = {1: 'type', 2: 'paste', 3: 'paste_fallback'}
+INJECTOR_RESULT_VALUES = {0: None, 1: False, 2: True}
+
+
+def encode_injector_message(seq, op, code=0, data=b'', flags=0, record_size=INJECTOR_RECORD_SIZE):
+    """Split one message into ring records, setting INJECTOR_MORE on all but the last."""
+    room = record_size - INJECTOR_RECORD.size
+    records = []
+    start = 0
+    while True:
+        part = data[start:start + room]
+        start += room
+        more = INJECTOR_MORE if start < len(data) else 0
+        records.append(INJECTOR_RECORD.pack(seq, op, flags | more, code, len(part)) + part)
+        if not more:
+            return records
+
+
+def decode_injector_record(record):
+    """Return (seq, op, flags, code, data) for one ring record."""
+    seq, op, flags, code, length = INJECTOR_RECORD.unpack_from(record)
+    start = INJECTOR_RECORD.size
+    return seq, op, flags, code, record[start:start + length]
+
+
+class InjectorCrashed(Exception):
+    """The injector process exited while an event was being injected."""
+
+
+def run_injector(requests_name, results_name, wake_requests, wake_results, settings, parent_pid):
+    """
+    Entry point of the injector process: set up KeyboardController like the
+    parent did, then execute requests from the ring until told to stop or
+    the parent goes away.
+    """
+    import gc
+    import signal
+
+    # Ctrl+C is the parent's to handle; it stops this process in turn.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    requests = SharedRing(requests_name, settings['slots'], settings['record_size'])
+    results = SharedRing(results_name, settings['slots'], settings['record_size'])
+
+    def reply(seq, error=None, value=None, path=0):
+        status, data = (0, b'') if error is None else (1, str(error).encode('utf-8'))
+        code = {None: 0, False: 1, True: 2}.get(value, 0)
+        for record in encode_injector_message(seq, status, code, data, path << 4, settings['record_size']):
+            while not results.put(record):
+                time.sleep(0.001)
+        wake_results.set()
+
+    try:
+        KeyboardController.use_backend(select_injection_backend(settings['backend'], settings['interval']))
+        KeyboardController.use_clipboard(select_clipboard(settings['clipboard']), settings['paste_threshold'])
+        KeyboardController.warm_up()
+    except Exception as error:
+        reply(0, error)
+        return
+    # Nothing allocated so far needs collecting; keep it out of later GC passes.
+    gc.collect()
+    gc.freeze()
+    reply(0)
+
+    functions = {
+        INJECTOR_OPS['type_text']: lambda msg_type, text, must_type: KeyboardController.type_text(text, must_type),
+        INJECTOR_OPS['try_paste']: lambda msg_type, text, must_type: KeyboardController.try_paste(text, must_type),
+        INJECTOR_OPS['handle_keystroke']: handle_keystroke,
+        INJECTOR_OPS['run_plan']: lambda msg_type, text, must_type: KeyboardController.run_plan(json.loads(text))
+    }
+    pending = {}
+    while True:
+        wake_requests.clear()
+        record = requests.get()
+        if record is None:
+            if not wake_requests.wait(INJECTOR_POLL_SECONDS) and os.getppid() != parent_pid:
+                return
+            continue
+        seq, op, flags, code, data = decode_injector_record(record)
+        if op == INJECTOR_STOP:
+            return
+        pending[seq] = pending.get(seq, b'') + data
+        if flags & INJECTOR_MORE:
+            continue
+        text = pending.pop(seq).decode('utf-8')
+        before = dict(metrics.text_paths)
+        try:
+            value = functions[op](LOCAL_EVENT_TYPES.get(code), text, bool(flags & INJECTOR_MUST_TYPE))
+            error = None
+        except Exception as exc:
+            value, error = None, exc
+        path = next((code for code, name in INJECTOR_TEXT_PATHS.items()
+                     if metrics.text_paths[name] != before[name]), 0)
+        reply(seq, error, value if isinstance(value, bool) else None, path)
+
+
+class InjectorProcess:
+    """
+    Runs KeyboardController in a separate process, so network handling, JSON
+    parsing and garbage collection in this one never delay a keystroke.
+
+    Requests go over one SharedRing and results come back over another, each
+    with an Event as the wake-up signal. A reader thread resolves the
+    callers' futures. If the process dies, calls in flight fail with
+    InjectorCrashed and it is restarted; after INJECTOR_RESTART_LIMIT
+    restarts within INJECTOR_RESTART_WINDOW_SECONDS it is abandoned and
+    `running` turns False. The process exits on its own when this one does.
+    """
+
+    def __init__(self, backend=None, interval=0.0, clipboard='off', paste_threshold=PASTE_THRESHOLD_CHARS,
+                 slots=INJECTOR_RING_SLOTS, record_size=INJECTOR_RECORD_SIZE):
+        self.settings = {
+            'backend': backend, 'interval': interval, 'clipboard': clipboard, 'paste_threshold': paste_threshold,
+            'slots': slots, 'record_size': record_size
+        }
+        self.process = None
+        self.restarts = 0
+        self.gave_up = False
+        self._restart_times = deque()
+        self._generation = 0
+        self._seq = 0
+        self._pending = {}
+        self._partial = {}
+        self._ready = None
+        self._loop = None
+        self._closing = False
+        self._requests = self._results = None
+        self._reader = None
+
+    @classmethod
+    def like_controller(cls):
+        """An injector set up with KeyboardController's current backend and clipboard."""
+        backend = KeyboardController.backend
+        clipboard = KeyboardController.clipboard
+        return cls(
+            backend=backend.name if backend is not None else None,
+            interval=backend.interval if backend is not None else 0.0,
+            clipboard=clipboard.name if clipboard is not None else 'off',
+            paste_threshold=KeyboardController.paste_threshold
+        )
+
+    @property
+    def running(self):
+        return self._ready is not None and not self.gave_up and not self._closing
+
+    async def start(self):
+        """Start the process and wait until its backend is warmed up. Returns False if it could not start."""
+        self._loop = asyncio.get_running_loop()
+        self._ready = asyncio.Event()
+        if not await self._spawn():
+            self.gave_up = True
+            return False
+        return True
+
+    async def _spawn(self):
+        import multiprocessing
+
+        context = multiprocessing.get_context('spawn')
+        self._generation += 1
+        self._requests = SharedRing(slots=self.settings['slots'], record_size=self.settings['record_size'])
+        self._results = SharedRing(slots=self.settings['slots'], record_size=self.settings['record_size'])
+        self._wake_requests = context.Event()
+        self._wake_results = context.Event()
+        started = self._loop.create_future()
+        self._pending = {0: started}
+        self._partial = {}
+        self.process = context.Process(
+            target=run_injector, name='rk-injector', daemon=True,
+            args=(self._requests.name, self._results.name, self._wake_requests, self._wake_results,
+                  self.settings, os.getpid())
+        )
+        self.process.start()
+        self._reader = threading.Thread(target=self._read_results, args=(self._generation,),
+                                        name='rk-injector-results', daemon=True)
+        self._reader.start()
+        try:
+            await asyncio.wait_for(started, INJECTOR_START_TIMEOUT_SECONDS)
+        except Exception as error:
+            print(f"[!] Injector process failed to start: {error or 'timed out'}")
+            await self._shut_down()
+            return False
+        print(f"[+] Injector process {self.process.pid} ready.")
+        self._ready.set()
+        return True
+
+    def _read_results(self, generation):
+        results, wake, process = self._results, self._wake_results, self.process
+        while not self._closing:
+            wake.wait(INJECTOR_POLL_SECONDS)
+            wake.clear()
+            while True:
+                record = results.get()
+                if record is None:
+                    break
+                self._loop.call_soon_threadsafe(self._on_record, generation, record)
+            if not process.is_alive() and not len(results):
+                self._loop.call_soon_threadsafe(self._on_exit, generation, process.exitcode)
+                return
+
+    def _on_record(self, generation, record):
+        if generation != self._generation:
+            return
+        seq, status, flags, code, data = decode_injector_record(record)
+        data = self._partial.pop(seq, b'') + data
+        if flags & INJECTOR_MORE:
+            self._partial[seq] = data
+            return
+        future = self._pending.pop(seq, None)
+        path = flags >> 4
+        if path in INJECTOR_TEXT_PATHS:
+            metrics.count_text_path(INJECTOR_TEXT_PATHS[path])
+        if future is None or future.done():
+            return
+        if status:
+            future.set_exception(RuntimeError(data.decode('utf-8', errors='replace')))
+        else:
+            future.set_result(INJECTOR_RESULT_VALUES.get(code))
+
+    def _on_exit(self, generation, exitcode):
+        if generation != self._generation or self._closing:
+            return
+        error = InjectorCrashed(f"injector process exited with code {exitcode}")
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self._pending = {}
+        if not self._ready.is_set():
+            # Still starting; _spawn reports the failure.
+            return
+        print(f"[!] {error}.")
+        # Later reports about the same process are stale.
+        self._generation += 1
+        self._ready.clear()
+        self._loop.create_task(self._restart())
+
+    async def _restart(self):
+        now = time.monotonic()
+        while self._restart_times and now - self._restart_times[0] > INJECTOR_RESTART_WINDOW_SECONDS:
+            self._restart_times.popleft()
+        await self._release()
+        if len(self._restart_times) >= INJECTOR_RESTART_LIMIT:
+            print("[!] Injector process keeps exiting; injecting in this process from now on.")
+            self.gave_up = True
+            self._ready.set()
+            return
+        self._restart_times.append(now)
+        self.restarts += 1
+        await asyncio.sleep(min(0.1 * 2 ** len(self._restart_times), 5))
+        if self._closing:
+            return
+        if not await self._spawn():
+            self.gave_up = True
+            self._ready.set()
+
+    async def call(self, func_name, *args):
+        """
+        Run KeyboardController.type_text/try_paste(text[, must_type]),
+        KeyboardController.run_plan(plan) or handle_keystroke(msg_type,
+        payload[, must_type]) in the injector process and return its result.
+        """
+        if func_name == 'handle_keystroke':
+            msg_type, text, must_type = args[0], args[1], args[2] if len(args) > 2 else False
+        elif func_name == 'run_plan':
+            msg_type, text, must_type = None, json.dumps(args[0]), False
+        else:
+            msg_type, text, must_type = None, args[0], args[1] if len(args) > 1 else False
+        await self._ready.wait()
+        if self.gave_up:
+            raise InjectorCrashed('injector process is not running')
+        if not self.process.is_alive():
+            # It died since the last call; wait for the restart instead of writing to a dead ring.
+            self._on_exit(self._generation, self.process.exitcode)
+            return await self.call(func_name, *args)
+        self._seq = self._seq % 0xFFFFFFFF + 1
+        seq = self._seq
+        future = self._loop.create_future()
+        self._pending[seq] = future
+        records = encode_injector_message(
+            seq, INJECTOR_OPS[func_name], LOCAL_EVENT_CODES.get(msg_type, 0), (text or '').encode('utf-8'),
+            INJECTOR_MUST_TYPE if must_type else 0, self.settings['record_size']
+        )
+        requests = self._requests
+        for record in records:
+            while not requests.put(record):
+                await asyncio.sleep(0.001)
+            self._wake_requests.set()
+        return await future
+
+    async def stop(self):
+        self._closing = True
+        if self._ready is not None:
+            self._ready.set()
+        await self._shut_down()
+
+    async def _shut_down(self):
+        if self.process is not None and self.process.is_alive():
+            self._requests.put(encode_injector_message(0, INJECTOR_STOP)[0])
+            self._wake_requests.set()
+            await asyncio.to_thread(self.process.join, 2)
+            if self.process.is_alive():
+                self.process.terminate()
+        await self._release()
+
+    async def _release(self):
+        # The reader thread must be done with the rings before they are unmapped.
+        if self._reader is not None and self._reader is not threading.current_thread():
+            self._generation += 1
+            await asyncio.to_thread(self._reader.join)
+            self._reader = None
+        for ring in (self._requests, self._results):
+            if ring is not None:
+                ring.close()
+        self._requests = self._results = None
+
+
+class InjectionRuntime:
+    """
+    The one injection pipeline every mode feeds. Senders queue events on a
+    shared LocalSequencer; a single consumer coroutine takes them in fair
+    order, merges runs of plain text into one write, and runs the blocking
+    keyboard call on a one-thread executor so the event loop keeps serving
+    the network. Given a started InjectorProcess, keyboard calls run in that
+    process instead, falling back to the executor if it is abandoned.
+
+    `on_done(error)` is called for each event once its batch has run, with
+    `error` None on success; it may be a coroutine function. Before start(),
+    submit() runs events inline.
+
+    A block of at least KeyboardController.paste_threshold characters is
+    pasted through the clipboard unless marked `must_type`; batched and
+    compacted keystrokes are always typed. Other text events longer
+    than STREAM_CHUNK_CHARS are typed chunk by chunk, with
+    `on_progress(typed, total)` called after each chunk. A 'cancel' event
+    takes the priority lane, stops the stream at the next chunk boundary and
+    drops the sender's queued events; the stopped event's `on_done` then gets
+    an InjectionInterrupted error. An Escape stops the stream the same way
+    when it comes from the sender whose text is streaming, and is then
+    pressed in its turn; otherwise it waits in order like any other key.
+
+    'mirror' and 'mirror-base' events carry a sender's whole text field and
+    are typed as a diff against what it held before (see MirrorTracker).
+
+    Given a SnippetStore in `snippets`, blocks of at least SNIPPET_MIN_CHARS
+    are kept in it and their `on_done` gets `snippet=<digest>` as well; a
+    'snippet' event is typed as the block it names, and fails with
+    SnippetMissing when the store does not hold it. The store is read and
+    written on worker threads when the event runs, never during submit().
+    """
+
+    def __init__(self, sender_rate=0.0, max_chars=MAX_COALESCED_CHARS, max_per_sender=LOCAL_SENDER_QUEUE_SIZE,
+                 injector=None, max_unpaused=UNPAUSED_SENDER_QUEUE_SIZE):
+        self.sequencer = LocalSequencer(max_per_sender=max_per_sender, rate=sender_rate)
+        self.max_chars = max_chars
+        self.max_unpaused = max_unpaused
+        self.injector = injector
+        self.executor = None
+        self._consumer = None
+        self._unfinished = 0
+        self._idle = asyncio.Event()
+        self._streaming = False
+        self._stop_stream = False
+        self._active_sender = None
+        self.mirrors = MirrorTracker()
+        self.snippets = None
+        self.recorder = None
+
+    @property
+    def running(self):
+        return self._consumer is not None and not self._consumer.done()
+
+    def start(self):
+        if self.running:
+            return
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='injection')
+        self._consumer = asyncio.create_task(self._consume())
+        metrics.track_queue('injection', self.sequencer.qsize)
+
+    async def stop(self):
+        if self._consumer is not None:
+            self._consumer.cancel()
+            try:
+                await self._consumer
+            except asyncio.CancelledError:
+                pass
+            self._consumer = None
+        metrics.untrack_queue('injection')
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    async def submit(self, sender, msg_type, payload, on_done=None, trace=None, wait=True, on_progress=None,
+                     must_type=False, version=None, epoch=None):
+        """
+        Queue an event from `sender`. Waits while that sender's queue is full,
+        unless `wait` is False: then the event is queued as long as fewer than
+        `max_unpaused` are waiting, and otherwise fails at once with
+        SenderBacklogFull. Text marked `must_type` is never pasted.
+        `version` orders mirror events within the server `epoch` they came
+        from; stale ones are acked without typing.
+        """
+        # The snippet store is read and written when the event runs, off the loop.
+        keep = (msg_type == 'block' and self.snippets is not None and isinstance(payload, str)
+                and len(payload) >= SNIPPET_MIN_CHARS)
+        if self.recorder is not None:
+            self.recorder.record(sender, msg_type, payload)
+        if msg_type in MIRROR_EVENT_TYPES:
+            payload = self.mirrors.offer(sender, msg_type, payload, version, epoch)
+            if payload is None:
+                await self._finish((msg_type, None, on_done, trace), None)
+                return
+        item = (msg_type, payload, on_done, trace, on_progress, bool(must_type), keep)
+        if not self.running:
+            await self._execute([item])
+            return
+        self.sequencer.register(sender)
+        self._unfinished += 1
+        if msg_type == 'cancel':
+            await self._interrupt(sender, discard_queued=True)
+            self.sequencer.put_priority(sender, item)
+            return
+        if is_priority_event(msg_type, payload) and self._active_sender == sender:
+            # Only this sender's own streaming text; queued events keep their order.
+            await self._interrupt(sender)
+        if wait:
+            await self.sequencer.put(sender, item)
+        elif not self.sequencer.put_nowait(sender, item, self.max_unpaused):
+            print(f"[!] Dropped an event from {sender}: {self.max_unpaused} already queued.")
+            self._unfinished -= 1
+            if not self._unfinished:
+                self._idle.set()
+            await self._finish(item, SenderBacklogFull(sender, self.max_unpaused))
+
+    async def _interrupt(self, sender, discard_queued=False):
+        # A sender locked out by another's focus lock cannot stop its typing.
+        if self._streaming and self.sequencer.focus_owner in (None, sender):
+            self._stop_stream = True
+        if not discard_queued:
+            return
+        for item in self.sequencer.discard(sender):
+            payload = item[1] if isinstance(item[1], str) else ''
+            await self._finish(item, InjectionInterrupted(0, len(payload)))
+            self._unfinished -= 1
+        if not self._unfinished:
+            self._idle.set()
+
+    async def drain(self):
+        """Wait until every queued event has been injected."""
+        while self._unfinished:
+            self._idle.clear()
+            await self._idle.wait()
+
+    async def _consume(self):
+        while True:
+            sender, batch = await self.sequencer.get_batch(self.max_chars)
+            self._active_sender = sender
+            try:
+                await self._execute(batch)
+            finally:
+                self._active_sender = None
+                self._unfinished -= len(batch)
+                if not self._unfinished:
+                    self._idle.set()
+
+    async def _run_blocking(self, func, *args):
+        if self.injector is not None and self.injector.running:
+            return await self.injector.call(func.__name__, *args)
+        if self.executor is None:
+            return func(*args)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def _execute(self, batch):
+        error = None
+        for item in batch:
+            metrics.mark(item[3], 'dequeued')
+            metrics.mark(item[3], 'injection_start')
+        msg_type, payload = batch[0][0], batch[0][1]
+        must_type = any(item[5] for item in batch)
+        keeping = snippet = None
+        try:
+            if msg_type == 'snippet':
+                if self.snippets is None:
+                    raise SnippetMissing(parse_snippet_payload(payload)[0])
+                msg_type, payload = 'block', await asyncio.to_thread(self.snippets.resolve, payload)
+            elif batch[0][6]:
+                # Kept while it is typed; long text is never batched, so this is the only item.
+                keeping = asyncio.ensure_future(asyncio.to_thread(self.snippets.put, payload))
+            text = ''.join(item[1] for item in batch) if len(batch) > 1 else payload
+            # Only a block as the sender sent it may be pasted; batched letters and
+            # compacted runs are keystrokes. The flag is passed on only when it
+            # matters, so the common path keeps its plain signature.
+            pastable = msg_type == 'block' and len(batch) == 1
+            typing_flags = (True,) if must_type or (
+                not pastable and isinstance(text, str) and KeyboardController.long_enough_to_paste(text)) else ()
+            if len(batch) > 1:
+                await self._run_blocking(KeyboardController.type_text, text, *typing_flags)
+            elif msg_type in ('word', 'block') and isinstance(payload, str) and len(payload) > STREAM_CHUNK_CHARS:
+                # Pasting is one step; only typed text is streamed chunk by chunk.
+                if not (pastable and await self._run_blocking(KeyboardController.try_paste, payload, must_type)):
+                    await self._stream_text(payload, batch[0][4], typing_flags)
+            elif msg_type in MIRROR_EVENT_TYPES:
+                edit = self.mirrors.plan(payload)
+                if edit is not None:
+                    if edit[0]:
+                        await self._run_blocking(KeyboardController.run_plan, edit[0])
+                    self.mirrors.commit(payload, edit[1])
+            else:
+                await self._run_blocking(handle_keystroke, msg_type, payload, *typing_flags)
+        except InjectionInterrupted as exc:
+            error = exc
+            print(f"[*] Text event {exc}.")
+        except SnippetMissing as exc:
+            error = exc
+            print(f"[*] Asked for {exc}; the sender will send it in full.")
+        except Exception as exc:
+            error = exc
+            print(f"[!] Keystroke execution error: {exc}")
+        if keeping is not None:
+            try:
+                snippet = await keeping
+            except OSError as exc:
+                print(f"[!] Could not keep snippet: {exc}")
+
+        for item in batch:
+            await self._finish(item, error, snippet)
+
+    async def _stream_text(self, text, on_progress=None, typing_flags=()):
+        total = len(text)
+        typed = 0
+        self._streaming = True
+        self._stop_stream = False
+        try:
+            for chunk in split_text_chunks(text):
+                if self._stop_stream:
+                    raise InjectionInterrupted(typed, total)
+                try:
+                    await self._run_blocking(KeyboardController.type_text, chunk, *typing_flags)
+                except Exception as exc:
+                    raise InjectionInterrupted(typed, total, reason=str(exc)) from exc
+                typed += len(chunk)
+                if on_progress is not None and typed < total:
+                    await self._notify(on_progress, typed, total)
+        finally:
+            self._streaming = False
+
+    async def _finish(self, item, error, snippet=None):
+        trace = item[3]
+        metrics.mark(trace, 'injection_end')
+        if item[2] is not None:
+            # Passed on only when set, so callbacks keep their plain signature.
+            await self._notify(item[2], error, **({'snippet': snippet} if snippet else {}))
+        metrics.finish(trace, ok=error is None)
+
+    @staticmethod
+    async def _notify(callback, *args, **kwargs):
+        try:
+            result = callback(*args, **kwargs)
+            if inspect.isawaitable(result):
+                await result
+        except Exception as ack_error:
+            print(f"[!] Execution ack error: {ack_error}")
+
+
+# Set by run_client() for the lifetime of its event loop.
+injection_runtime = None
+
+
+class AckBatcher:
+    """
+    Sends execution acks to the server. Once the server advertises
+    `executionAckBatch` in its 'server-features' event, acks are collected and
+    sent as one 'execution-ack-batch' frame per room every `window` seconds,
+    or as soon as `max_batch` are waiting. Otherwise each ack is emitted on
+    its own as 'execution-ack'. `send(event, data)` must return an awaitable.
+    """
+
+    def __init__(self, send, window=ACK_BATCH_WINDOW_SECONDS, max_batch=ACK_BATCH_MAX):
+        self.send = send
+        self.window = window
+        self.max_batch = max_batch
+        self.enabled = False
+        self._pending = []
+        self._flush_task = None
+
+    async def configure(self, features):
+        enabled = bool((features or {}).get('executionAckBatch'))
+        if not enabled:
+            await self.flush()
+        self.enabled = enabled
+
+    def reset(self):
+        """Disable batching and drop queued acks; they cannot reach a closed connection."""
+        self.enabled = False
+        self._pending = []
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+
+    async def add(self, ack):
+        if not self.enabled:
+            await self.send('execution-ack', ack)
+            return
+
+        self._pending.append(ack)
+        if len(self._pending) >= self.max_batch:
+            await self.flush()
+        elif self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def flush(self):
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+        rooms = {}
+        for ack in pending:
+            ack = dict(ack)
+            rooms.setdefault(ack.pop('roomCode'), []).append(ack)
+        for room_code, acks in rooms.items():
+            await self.send('execution-ack-batch', {'roomCode': room_code, 'acks': acks})
+
+    def pending(self):
+        return len(self._pending)
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        self._flush_task = None
+        try:
+            await self.flush()
+        except Exception as error:
+            print(f"[!] Execution ack error: {error}")
+
+
+ack_batcher = AckBatcher(lambda event, data: sio.emit(event, data))
+
+
+async def emit_execution_ack(room_code, event_id, client_event_id, error=None, snippet=None, duplicate=False):
+    if not (room_code and event_id):
+        return False
+    ack = {
+        'roomCode': room_code,
+        'eventId': event_id,
+        'clientEventId': client_event_id,
+        **execution_status(error, snippet)
+    }
+    if duplicate:
+        ack['duplicate'] = True
+    await ack_batcher.add(ack)
+    return True
+
+
+async def emit_execution_progress(room_code, event_id, client_event_id, typed, total):
+    if not (room_code and event_id):
+        return
+    await sio.emit('execution-progress', {
+        'roomCode': room_code,
+        'eventId': event_id,
+        'clientEventId': client_event_id,
+        'typed': typed,
+        'total': total
+    })
+
+
+async def on_keystroke(data):
+    if socket_resync.skipping:
+        # An earlier event was dropped; the resync fetches this one again, in order.
+        return
+    msg_type = data.get('type')
+    payload = data.get('payload')
+    room_code = data.get('roomCode') or getattr(sio, 'room_code', None)
+    event_id = data.get('eventId')
+    epoch = data.get('epoch')
+    client_event_id = data.get('clientEventId')
+    failover = getattr(sio, 'failover', None)
+    if failover is not None and event_id:
+        failover.saw(epoch, event_id)
+    if event_id and not executed_events.claim((epoch, room_code, event_id)):
+        # Already run, typically re-sent after a reconnect: ack it again so
+        # the sender's ack timeout doesn't fire for an event that ran.
+        await emit_execution_ack(room_code, event_id, client_event_id, duplicate=True)
+        return
+    clock = sender_clocks.get(data.get('senderId'))
+    trace = metrics.start_trace(clock.to_host(data.get('sentAt')) if clock is not None else None,
+                                sender='internet', type=msg_type, eventId=event_id)
+    cursors = getattr(sio, 'cursors', None)
+    runtime = injection_runtime or InjectionRuntime()
+
+    async def ack(error, snippet=None):
+        if isinstance(error, SenderBacklogFull) and event_id:
+            # Never ran: leave the cursor behind it and fetch it again rather than type past it.
+            executed_events.release((epoch, room_code, event_id))
+            socket_resync.start(runtime, sio, epoch, event_id - 1)
+            return
+        if cursors is not None and event_id:
+            cursors.advance(sio.server_url, room_code, event_id, epoch)
+        if await emit_execution_ack(room_code, event_id, client_event_id, error, snippet):
+            metrics.mark(trace, 'ack_sent')
+
+    async def progress(typed, total):
+        await emit_execution_progress(room_code, event_id, client_event_id, typed, total)
+
+    # Socket.IO runs each event handler as its own task; queueing without
+    # awaiting keeps events in arrival order.
+    await runtime.submit('internet', msg_type, payload, ack, trace, wait=False, on_progress=progress,
+                         must_type=data.get('mustType'), version=event_id, epoch=epoch)
+
+
+async def fetch_events(session, server_url, room_code, since_id, wait_seconds=0):
+    import aiohttp
+
+    url = f"{server_url}/api/rooms/{quote(room_code)}/events"
+    params = {'since': since_id}
+    if wait_seconds:
+        params['wait'] = int(wait_seconds * 1000)
+    timeout = aiohttp.ClientTimeout(total=wait_seconds + 20)
+    async with session.get(url, params=params, timeout=timeout) as response:
+        response.raise_for_status()
+        return await response.json()
+
+
+class EventPoller:
+    """
+    Pulls room events over one keep-alive HTTP session. Servers that support
+    long-polling hold each request open until events arrive; against servers
+    that answer immediately, idle polls back off up to POLL_INTERVAL_SECONDS
+    and drop back to immediate re-polls as soon as events flow again.
+
+    `since_id` and `epoch` resume from a stored cursor. When the server reports
+    a different epoch (it restarted and its ids began again at 1), the cursor
+    is rewound to 0 and the next poll goes out immediately.
+    """
+
+    def __init__(self, server_url, room_code, since_id=0, wait_seconds=LONG_POLL_WAIT_SECONDS,
+                 min_interval=POLL_MIN_INTERVAL_SECONDS, max_interval=POLL_INTERVAL_SECONDS, session=None,
+                 epoch=None):
+        self.server_url = server_url
+        self.room_code = room_code
+        self.since_id = since_id
+        self.epoch = epoch
+        self._epoch_checked = since_id == 0
+        self.wait_seconds = wait_seconds
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.session = session
+        self.idle_delay = 0
+
+    def _session(self):
+        if self.session is None:
+            import aiohttp
+
+            self.session = aiohttp.ClientSession()
+        return self.session
+
+    def resume(self, since_id, epoch):
+        """Continue from another source's cursor, e.g. the last event seen on a socket."""
+        self.since_id = since_id
+        self.epoch = epoch
+        self._epoch_checked = since_id == 0
+        self.idle_delay = 0
+
+    async def warm_up(self):
+        """Open the keep-alive connection ahead of the first poll."""
+        import aiohttp
+
+        try:
+            async with self._session().get(f"{self.server_url}/api/health",
+                                           timeout=aiohttp.ClientTimeout(total=5)) as response:
+                await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            pass
+
+    async def poll(self, wait_seconds=None):
+        self._session()
+        # A stale cursor from a previous server run would make the first
+        # long-poll wait for ids that may never come, so check the epoch first.
+        if wait_seconds is None:
+            wait_seconds = self.wait_seconds if self._epoch_checked else 0
+        payload = await fetch_events(self.session, self.server_url, self.room_code, self.since_id,
+                                     wait_seconds=wait_seconds)
+        epoch = payload.get('epoch')
+        self._epoch_checked = True
+        if epoch != self.epoch:
+            rewind = self.since_id != 0
+            self.epoch = epoch
+            if rewind:
+                print(f"[*] Server restarted; reading room {self.room_code} from its first event.")
+                self.since_id = 0
+                self.idle_delay = 0
+                return []
+
+        events = payload.get('events', [])
+        self.since_id = payload.get('nextSince', self.since_id)
+
+        if events or payload.get('longPoll'):
+            # Either work is flowing or the server already waited for us.
+            self.idle_delay = 0
+        else:
+            self.idle_delay = min(max(self.idle_delay * 2, self.min_interval), self.max_interval)
+        return events
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+
+async def process_polled_events(runtime, events, on_executed=None, epoch=None, room_code=None, sender='polling'):
+    """
+    Queue polled events for injection in order, skipping any already in
+    `executed_events`. A batch of several events is compacted first (see
+    compact_backlog). `on_executed(event)` runs for each original event once
+    the action covering it has been injected, so a cursor can follow along.
+    Waits while `sender`'s queue is full.
+    """
+    fresh = [
+        event for event in events
+        if event.get('id') is None or executed_events.claim((epoch, room_code, event['id']))
+    ]
+    if len(fresh) > 1:
+        actions = compact_backlog(fresh)
+    else:
+        actions = [(event.get('type'), event.get('payload'), [event]) for event in fresh]
+
+    for msg_type, payload, covered in actions:
+        def done(error, covered=covered, snippet=None):
+            if on_executed is not None:
+                for event in covered:
+                    on_executed(event)
+
+        # Traced from the earliest keypress the action covers, when that sender's clock is known.
+        first = covered[0]
+        clock = sender_clocks.get(first.get('senderId'))
+        trace = metrics.start_trace(clock.to_host(first.get('sentAt')) if clock is not None else None,
+                                    sender=sender, type=msg_type)
+        await runtime.submit(sender, msg_type, payload, done, trace,
+                             must_type=any(event.get('mustType') for event in covered),
+                             version=covered[-1].get('id'), epoch=epoch)
+
+
+def cursor_recorder(cursors, poller):
+    """on_executed callback that moves the stored cursor along with `poller`."""
+    def record(event):
+        if cursors is not None and event.get('id') is not None:
+            cursors.advance(poller.server_url, poller.room_code, event['id'], poller.epoch)
+    return record
+
+
+async def pump_polled_events(runtime, poller, cursors=None):
+    """Poll forever, queueing each batch for injection. Retries after network errors."""
+    import aiohttp
+
+    record = cursor_recorder(cursors, poller)
+    while True:
+        try:
+            events = await poller.poll()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            print(f"[!] Polling error: {error}")
+            await asyncio.sleep(POLL_ERROR_RETRY_SECONDS)
+            continue
+
+        # Polled events are already claimed in executed_events, so cancelling
+        # this loop must not drop them half-way through queueing.
+        await asyncio.shield(process_polled_events(runtime, events, record, poller.epoch, poller.room_code))
+        if poller.idle_delay:
+            await asyncio.sleep(poller.idle_delay)
+
+
+class SocketResync:
+    """
+    Recovers from a socket event dropped with SenderBacklogFull. Typing the
+    events after it would leave a hole, so from then on socket events are
+    skipped and the room is read again over HTTP from just before the
+    dropped one. Those events go into the same 'internet' queue behind what
+    is already there, pausing while it is full. Once a poll comes back empty
+    the socket is trusted again, and one last poll collects events skipped
+    while the resync was ending.
+    """
+
+    def __init__(self):
+        self.skipping = False
+        self._task = None
+
+    def start(self, runtime, client, epoch, since_id):
+        if self.skipping:
+            return
+        self.skipping = True
+        failover = getattr(client, 'failover', None)
+        if failover is not None:
+            failover.rewind(epoch, since_id)
+        print(f"[!] Internet backlog full; re-reading room {client.room_code} from event {since_id}.")
+        self._task = asyncio.ensure_future(self._run(runtime, client, epoch, since_id))
+
+    async def _run(self, runtime, client, epoch, since_id):
+        import aiohttp
+
+        poller = EventPoller(client.server_url, client.room_code, since_id=since_id, epoch=epoch)
+        record = cursor_recorder(client.cursors, poller)
+        try:
+            while True:
+                before = (poller.epoch, poller.since_id)
+                try:
+                    events = await poller.poll(wait_seconds=0)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                    print(f"[!] Polling error: {error}")
+                    await asyncio.sleep(POLL_ERROR_RETRY_SECONDS)
+                    continue
+                await process_polled_events(runtime, events, record, poller.epoch, poller.room_code,
+                                            sender='internet')
+                if not self.skipping:
+                    break
+                if not events and (poller.epoch, poller.since_id) == before:
+                    self.skipping = False
+            failover = getattr(client, 'failover', None)
+            if failover is not None:
+                failover.saw(poller.epoch, poller.since_id)
+            print(f"[+] Room {poller.room_code} resynced at event {poller.since_id}.")
+        finally:
+            self.skipping = False
+            await poller.close()
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is not None and not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+
+socket_resync = SocketResync()
+
+
+async def run_polling_client(runtime, server_url, room_code, cursors=None, on_started=None):
+    epoch, since_id = cursors.get(server_url, room_code) if cursors is not None else (None, 0)
+    if since_id:
+        print(f"[*] Polling {server_url} room {room_code} from event {since_id}...")
+    else:
+        print(f"[*] Polling {server_url} room {room_code}...")
+    poller = EventPoller(server_url, room_code, since_id=since_id, epoch=epoch)
+    try:
+        await poller.warm_up()
+        if on_started is not None:
+            on_started()
+        await pump_polled_events(runtime, poller, cursors)
+    finally:
+        await poller.close()
+
+
+async def run_websocket_client(server_url, room_code, cursors=None, on_started=None):
+    import socketio
+
+    client = get_sio()
+    client.room_code = room_code
+    client.server_url = server_url
+    client.cursors = cursors
+    print(f"[*] Connecting to {server_url} using WebSocket...")
+    try:
+        await client.connect(server_url)
+        if on_started is not None:
+            on_started()
+        await client.wait()
+    except socketio.exceptions.ConnectionError as error:
+        print(f"[!] Connection failed: {error}")
+        return False
+    finally:
+        if client.connected:
+            await ack_batcher.flush()
+            await client.disconnect()
+    return True
+
+
+class HybridTransport:
+    """
+    WebSocket as the primary transport, with HTTP polling as a warm standby.
+
+    While the socket is up it is checked every `heartbeat_interval` seconds
+    with a 'heartbeat' call that must be acknowledged within
+    `heartbeat_timeout` (for servers that advertise `heartbeat`). A missed
+    heartbeat or a disconnect fails over to polling on the already-open HTTP
+    session, resuming from the last event id seen on the socket, so failover
+    takes at most about interval + timeout. The socket is retried with
+    jittered exponential backoff; once it is healthy again, one last poll
+    picks up events queued while it was rejoining and polling stops.
+    Events that arrive on both paths are dropped by `executed_events`.
+    """
+
+    def __init__(self, runtime, server_url, room_code, cursors=None,
+                 heartbeat_interval=HEARTBEAT_INTERVAL_SECONDS, heartbeat_timeout=HEARTBEAT_TIMEOUT_SECONDS,
+                 backoff_min=FAILOVER_BACKOFF_MIN_SECONDS, backoff_max=FAILOVER_BACKOFF_MAX_SECONDS,
+                 poll_wait=LONG_POLL_WAIT_SECONDS):
+        self.runtime = runtime
+        self.server_url = server_url
+        self.room_code = room_code
+        self.cursors = cursors
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.epoch, self.last_event_id = cursors.get(server_url, room_code) if cursors is not None else (None, 0)
+        self.active = None
+        self.failovers = 0
+        self.poller = EventPoller(server_url, room_code, wait_seconds=poll_wait)
+        self._poll_task = None
+        self._lost = asyncio.Event()
+        self._features = asyncio.Event()
+
+    def saw(self, epoch, event_id):
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.last_event_id = event_id
+        elif event_id > self.last_event_id:
+            self.last_event_id = event_id
+
+    def rewind(self, epoch, event_id):
+        """Resume from `event_id` again, for events seen on the socket but never run."""
+        self.epoch = epoch
+        self.last_event_id = event_id
+
+    def lost(self):
+        self._lost.set()
+
+    def features_received(self):
+        self._features.set()
+
+    async def run(self, on_started=None):
+        """Receive until cancelled; `on_started()` runs once the socket is up or polling has taken over."""
+        import socketio
+
+        client = get_sio()
+        client.room_code = self.room_code
+        client.server_url = self.server_url
+        client.cursors = self.cursors
+        client.failover = self
+        # Reconnects are ours to schedule, with polling covering the gap.
+        reconnection, client.reconnection = client.reconnection, False
+        await self.poller.warm_up()
+        backoff = self.backoff_min
+        try:
+            while True:
+                if await self._connect(client, socketio):
+                    backoff = self.backoff_min
+                    await self._stop_polling()
+                    self.active = 'websocket'
+                    print(f"[+] Receiving over WebSocket from {self.server_url}.")
+                    if on_started is not None:
+                        on_started()
+                        on_started = None
+                    reason = await self._watch(client, socketio)
+                    print(f"[!] WebSocket {reason}; failing over to HTTP polling.")
+                await self._start_polling()
+                if on_started is not None:
+                    on_started()
+                    on_started = None
+                await self._disconnect(client)
+                await asyncio.sleep(random.uniform(backoff / 2, backoff))
+                backoff = min(backoff * 2, self.backoff_max)
+        finally:
+            await self._stop_polling(catch_up=False)
+            await self._disconnect(client)
+            client.failover = None
+            client.reconnection = reconnection
+            await self.poller.close()
+
+    async def _connect(self, client, socketio):
+        self._lost.clear()
+        self._features.clear()
+        try:
+            await asyncio.wait_for(client.connect(self.server_url, wait_timeout=SOCKET_CONNECT_TIMEOUT_SECONDS),
+                                   SOCKET_CONNECT_TIMEOUT_SECONDS)
+        except (socketio.exceptions.ConnectionError, asyncio.TimeoutError) as error:
+            if self.active != 'polling':
+                print(f"[!] WebSocket connection failed: {error}")
+            return False
+        # Features come right after the handshake; servers too old to send
+        # them are treated as having no heartbeat.
+        try:
+            await asyncio.wait_for(self._features.wait(), self.heartbeat_timeout)
+        except asyncio.TimeoutError:
+            pass
+        return await self._heartbeat(client, socketio)
+
+    async def _heartbeat(self, client, socketio):
+        if not client.connected or self._lost.is_set():
+            return False
+        if not getattr(client, 'features', {}).get('heartbeat'):
+            return True
+        try:
+            await client.call('heartbeat', {}, timeout=self.heartbeat_timeout)
+        except (socketio.exceptions.TimeoutError, socketio.exceptions.BadNamespaceError):
+            return False
+        return True
+
+    async def _watch(self, client, socketio):
+        """Return once the socket is no longer healthy, with the reason."""
+        while True:
+            try:
+                await asyncio.wait_for(self._lost.wait(), self.heartbeat_interval)
+                return 'disconnected'
+            except asyncio.TimeoutError:
+                pass
+            if not await self._heartbeat(client, socketio):
+                return 'disconnected' if self._lost.is_set() else 'missed a heartbeat'
+
+    async def _disconnect(self, client):
+        if client.connected:
+            await ack_batcher.flush()
+            await client.disconnect()
+
+    async def _start_polling(self):
+        if self._poll_task is not None:
+            return
+        self.active = 'polling'
+        self.failovers += 1
+        self.poller.resume(self.last_event_id, self.epoch)
+        print(f"[*] Polling {self.server_url} room {self.room_code} from event {self.last_event_id}...")
+        self._poll_task = asyncio.create_task(pump_polled_events(self.runtime, self.poller, self.cursors))
+
+    async def _stop_polling(self, catch_up=True):
+        import aiohttp
+
+        task, self._poll_task = self._poll_task, None
+        if task is None:
+            return
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        if not catch_up:
+            return
+        try:
+            events = await self.poller.poll(wait_seconds=0)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            print(f"[!] Polling error: {error}")
+            return
+        await process_polled_events(self.runtime, events, cursor_recorder(self.cursors, self.poller),
+                                    self.poller.epoch, self.room_code)
+        self.saw(self.poller.epoch, self.poller.since_id)
+
+
+def normalize_url(server_url):
+    return server_url.rstrip('/')
+
+
+# Local /ws binary protocol (subprotocol rk.bin.v1). Each frame is a run of
+# little-endian records, so one frame can carry several events or acks.
+#   event: u8 type, u32 clientEventId, u32 payload length, UTF-8 payload
+#   ack:   u8 kind, u8 flags, u32 eventId, u32 clientEventId, u16 text length, UTF-8 text
+# The event type's high bit marks text that must be typed, never pasted. Bit
+# 0x40 means an f64 follows the header: when the sender sent the event, in
+# milliseconds since the epoch on its own clock.
+# Ack flags: 1 ok, 2 text starts with "<typed>/<total>" (then a space and the
+# error, if any), 4 cancelled. The text is otherwise the error message.
+LOCAL_EVENT_HEADER = struct.Struct('<BII')
+LOCAL_ACK_HEADER = struct.Struct('<BBIIH')
+LOCAL_EVENT_TYPES = {
+    1: 'letter', 2: 'word', 3: 'block', 4: 'focus-lock', 5: 'focus-release', 6: 'cancel', 7: 'mirror', 8: 'mirror-base',
+    9: 'snippet'
+}
+LOCAL_EVENT_CODES = {name: code for code, name in LOCAL_EVENT_TYPES.items()}
+LOCAL_EVENT_MUST_TYPE = 0x80
+LOCAL_EVENT_SENT_AT = 0x40
+LOCAL_EVENT_SENT_AT_FIELD = struct.Struct('<d')
+LOCAL_ACK_KINDS = {1: 'delivery-ack', 2: 'execution-ack', 3: 'focus', 4: 'progress'}
+LOCAL_ACK_CODES = {name: code for code, name in LOCAL_ACK_KINDS.items()}
+LOCAL_ACK_OK = 1
+LOCAL_ACK_COUNTS = 2
+LOCAL_ACK_CANCELLED = 4
+LOCAL_ACK_SNIPPET = 8
+LOCAL_ACK_SNIPPET_MISS = 16
+
+
+def encode_local_events(events):
+    parts = []
+    for event in events:
+        payload = (event.get('payload') or '').encode('utf-8')
+        code = LOCAL_EVENT_CODES[event['type']]
+        if event.get('mustType'):
+            code |= LOCAL_EVENT_MUST_TYPE
+        if event.get('sentAt') is not None:
+            code |= LOCAL_EVENT_SENT_AT
+        parts.append(LOCAL_EVENT_HEADER.pack(code, event.get('clientEventId') or 0, len(payload)))
+        if code & LOCAL_EVENT_SENT_AT:
+            parts.append(LOCAL_EVENT_SENT_AT_FIELD.pack(event['sentAt']))
+        parts.append(payload)
+    return b''.join(parts)
+
+
+def decode_local_events(data):
+    events = []
+    offset = 0
+    header_size = LOCAL_EVENT_HEADER.size
+    while offset + header_size <= len(data):
+        code, client_event_id, length = LOCAL_EVENT_HEADER.unpack_from(data, offset)
+        offset += header_size
+        sent_at = None
+        if code & LOCAL_EVENT_SENT_AT:
+            if offset + LOCAL_EVENT_SENT_AT_FIELD.size > len(data):
+                # Truncated: drop the record rather than fail the whole connection.
+                break
+            sent_at, = LOCAL_EVENT_SENT_AT_FIELD.unpack_from(data, offset)
+            offset += LOCAL_EVENT_SENT_AT_FIELD.size
+        event = {
+            'type': LOCAL_EVENT_TYPES.get(code & ~(LOCAL_EVENT_MUST_TYPE | LOCAL_EVENT_SENT_AT)),
+            'payload': bytes(data[offset:offset + length]).decode('utf-8', errors='replace'),
+            'clientEventId': client_event_id or None
+        }
+        if code & LOCAL_EVENT_MUST_TYPE:
+            event['mustType'] = True
+        if sent_at is not None:
+            event['sentAt'] = sent_at
+        events.append(event)
+        offset += length
+    return events
+
+
+def encode_local_acks(acks):
+    parts = []
+    for ack in acks:
+        flags = 0 if ack.get('ok') is False else LOCAL_ACK_OK
+        text = ack.get('error') or ''
+        if ack.get('total') is not None:
+            flags |= LOCAL_ACK_COUNTS
+            counts = f"{ack.get('typed') or 0}/{ack['total']}"
+            text = f"{counts} {text}" if text else counts
+        if ack.get('cancelled'):
+            flags |= LOCAL_ACK_CANCELLED
+        if ack.get('snippet'):
+            flags |= LOCAL_ACK_SNIPPET
+            text = f"{ack['snippet']} {text}" if text else ack['snippet']
+        if ack.get('snippetMiss'):
+            flags |= LOCAL_ACK_SNIPPET_MISS
+        text = text.encode('utf-8')[:0xFFFF]
+        parts.append(LOCAL_ACK_HEADER.pack(
+            LOCAL_ACK_CODES[ack['kind']], flags,
+            ack.get('eventId') or 0, ack.get('clientEventId') or 0, len(text)
+        ))
+        parts.append(text)
+    return b''.join(parts)
+
+
+def decode_local_acks(data):
+    acks = []
+    offset = 0
+    header_size = LOCAL_ACK_HEADER.size
+    while offset + header_size <= len(data):
+        code, flags, event_id, client_event_id, length = LOCAL_ACK_HEADER.unpack_from(data, offset)
+        offset += header_size
+        ack = {
+            'kind': LOCAL_ACK_KINDS.get(code),
+            'eventId': event_id,
+            'clientEventId': client_event_id or None,
+            'ok': bool(flags & LOCAL_ACK_OK)
+        }
+        text = bytes(data[offset:offset + length]).decode('utf-8', errors='replace')
+        if flags & LOCAL_ACK_SNIPPET:
+            ack['snippet'], _, text = text.partition(' ')
+        if flags & LOCAL_ACK_COUNTS:
+            counts, _, text = text.partition(' ')
+            typed, _, total = counts.partition('/')
+            ack['typed'], ack['total'] = int(typed), int(total)
+        if flags & LOCAL_ACK_CANCELLED:
+            ack['cancelled'] = True
+        if flags & LOCAL_ACK_SNIPPET_MISS:
+            ack['snippetMiss'] = True
+        if text:
+            ack['error'] = text
+        acks.append(ack)
+        offset += length
+    return acks
+
+
+def local_execution_ack(reply, event_id, client_event_id, trace):
+    async def on_done(error, snippet=None):
+        ack = {
+            'kind': 'execution-ack',
+            'eventId': event_id,
+            'clientEventId': client_event_id,
+            **execution_status(error, snippet)
+        }
+        try:
+            await reply(ack)
+            metrics.mark(trace, 'ack_sent')
+        except Exception:
+            # The sender went away while its event was being typed.
+            pass
+    return on_done
+
+
+def local_execution_progress(reply, event_id, client_event_id):
+    async def on_progress(typed, total):
+        try:
+            await reply({
+                'kind': 'progress',
+                'eventId': event_id,
+                'clientEventId': client_event_id,
+                'ok': True,
+                'typed': typed,
+                'total': total
+            })
+        except Exception:
+            pass
+    return on_progress
+
+
+# Local UDP protocol (--udp-port) for native senders. Every datagram starts
+# with u8 kind, u32 session, u32 seq.
+#   DATA (sender to receiver): seq counts the session's datagrams from 1; the
+#     body is rk.bin.v1 event records.
+#   ACKS (receiver to sender): the body is rk.bin.v1 ack records.
+#   NACK (receiver to sender): the body is the u32 seqs missing so far.
+#   PING (receiver to sender): the body is f64 t0, the receiver's clock.
+#   PONG (sender to receiver): the body is f64 t0 (echoed) and f64 t1, the sender's clock.
+# In ACKS, NACK and PING, seq is the highest seq received with no gaps before it.
+# Clocks are milliseconds since the epoch; see ClockOffset.
+UDP_HEADER = struct.Struct('<BII')
+UDP_DATA = 1
+UDP_ACKS = 2
+UDP_NACK = 3
+UDP_PING = 4
+UDP_PONG = 5
+UDP_KEEPALIVE = 6
+UDP_CLOCK = struct.Struct('<dd')
+
+
+class DatagramSession:
+    """
+    Receive state for one UDP sender session. Datagrams are released in seq
+    order; ones that arrive early wait in a window of `window` seqs, and
+    repeats are recognised so nothing is executed twice. The acks sent for
+    recent seqs are kept so a repeat can be answered with them.
+    """
+
+    def __init__(self, sender, session_id, addr, window=UDP_REORDER_WINDOW):
+        self.sender = sender
+        self.session_id = session_id
+        self.addr = addr
+        self.window = window
+        self.next_seq = 1
+        self.early = {}
+        self.acks = OrderedDict()
+        self.nacked_at = 0.0
+        self.clock = ClockOffset()
+        self.pinged_at = None
+        self.seen_at = time.monotonic()
+        self.queue = asyncio.Queue()
+        self.pump = None
+        self.submitting = False
+
+    @property
+    def received(self):
+        return self.next_seq - 1
+
+    def accept(self, seq, events):
+        """
+        Return [(seq, events), ...] that are now in order, or None when `seq`
+        was received before. Seqs beyond the window are dropped for the
+        sender to resend.
+        """
+        if seq < self.next_seq or seq in self.early:
+            return None
+        if seq >= self.next_seq + self.window:
+            return []
+        self.early[seq] = events
+        ready = []
+        while self.next_seq in self.early:
+            ready.append((self.next_seq, self.early.pop(self.next_seq)))
+            self.next_seq += 1
+        return ready
+
+    def missing(self, limit=UDP_NACK_MAX):
+        if not self.early:
+            return []
+        return [seq for seq in range(self.next_seq, max(self.early)) if seq not in self.early][:limit]
+
+    def remember(self, seq, ack):
+        self.acks.setdefault(seq, []).append(ack)
+        while len(self.acks) > UDP_ACK_HISTORY:
+            self.acks.popitem(last=False)
+
+
+class LocalDatagramProtocol(asyncio.DatagramProtocol):
+    """
+    The local-mode UDP endpoint. Each (address, session) is one sender to
+    the runtime, like a /ws connection, and gets the same delivery, progress
+    and execution acks. Gaps are answered with a NACK listing what is
+    missing (at most every UDP_NACK_INTERVAL_SECONDS); a repeated datagram
+    is answered with the acks already sent for it and is not executed again.
+    A new session from an address replaces that address's old one, and a
+    session that sends nothing for UDP_SESSION_IDLE_SECONDS is closed.
     """
 
-    @staticmethod
-    def type_text(text: str):
-        if text:
-            pyautogui.write(text)
+    def __init__(self, runtime):
+        self.runtime = runtime
+        self.transport = None
+        self.sessions = {}
+        self.next_event_id = 1
+        self.next_sender_id = 1
+        self._expirer = None
 
-    @staticmethod
-    def press_key(key: str):
-        key_map = {
-            'Backspace': 'backspace',
-            'Enter': 'enter',
-            'Space': 'space',
-            'Tab': 'tab',
-            'Escape': 'esc',
-            'ArrowUp': 'up',
-            'ArrowDown': 'down',
-            'ArrowLeft': 'left',
-            'ArrowRight': 'right'
-        }
+    def connection_made(self, transport):
+        self.transport = transport
+        self._expirer = asyncio.ensure_future(self._expire_idle())
 
-        mapped_key = key_map.get(key, key)
+    def datagram_received(self, data, addr):
+        if len(data) < UDP_HEADER.size:
+            return
+        kind, session_id, seq = UDP_HEADER.unpack_from(data)
+        session = self.sessions.get((addr, session_id))
+        if session is not None:
+            session.seen_at = time.monotonic()
+        if kind == UDP_KEEPALIVE:
+            return
+        if kind == UDP_PONG:
+            if session is not None and len(data) >= UDP_HEADER.size + UDP_CLOCK.size:
+                session.clock.add(*UDP_CLOCK.unpack_from(data, UDP_HEADER.size))
+            return
+        if kind != UDP_DATA or not seq:
+            return
+        try:
+            events = decode_local_events(data[UDP_HEADER.size:])
+        except (struct.error, UnicodeDecodeError):
+            return
+        session = session or self._open(addr, session_id)
+        ready = session.accept(seq, events)
+        if ready is None:
+            self._send(session, UDP_ACKS, encode_local_acks(session.acks.get(seq, [])))
+            return
 
-        if len(mapped_key) == 1:
-            pyautogui.write(mapped_key)
-        elif mapped_key in pyautogui.KEY_NAMES:
-            pyautogui.press(mapped_key)
-        else:
-            print(f"Warning: Unrecognized key '{key}' ignored.")
+        deliveries = []
+        sequencer = self.runtime.sequencer
+        for ready_seq, ready_events in ready:
+            for event in ready_events:
+                msg_type = event.get('type')
+                if msg_type == 'focus-lock':
+                    deliveries.append({'kind': 'focus', 'ok': sequencer.acquire_focus(session.sender)})
+                    continue
+                if msg_type == 'focus-release':
+                    sequencer.release_focus(session.sender)
+                    deliveries.append({'kind': 'focus', 'ok': False})
+                    continue
+                if msg_type is None:
+                    continue
+                event_id = self.next_event_id
+                self.next_event_id += 1
+                ack = {'kind': 'delivery-ack', 'eventId': event_id, 'clientEventId': event['clientEventId']}
+                session.remember(ready_seq, ack)
+                deliveries.append(ack)
+                trace = metrics.start_trace(session.clock.to_host(event.get('sentAt')), sender=session.sender,
+                                            type=msg_type, chars=len(event['payload']))
+                session.queue.put_nowait((ready_seq, event_id, event, trace))
+        if ready:
+            self._send(session, UDP_ACKS, encode_local_acks(deliveries))
 
+        missing = session.missing()
+        now = time.monotonic()
+        if missing and now - session.nacked_at >= UDP_NACK_INTERVAL_SECONDS:
+            session.nacked_at = now
+            self._send(session, UDP_NACK, struct.pack(f'<{len(missing)}I', *missing))
+        if session.pinged_at is None or now - session.pinged_at >= CLOCK_PING_INTERVAL_SECONDS:
+            session.pinged_at = now
+            self._send(session, UDP_PING, struct.pack('<d', wall_ms()))
 
-@sio.event
-def connect():
-    print("\n[+] Connected to the server successfully!")
-    if hasattr(sio, 'room_code'):
-        sio.emit('join-room', sio.room_code, 'receiver')
-        print(f"[+] Joined room: {sio.room_code}")
-        print("[*] Waiting for keystrokes... (Press Ctrl+C to exit)")
+    def _open(self, addr, session_id):
+        for key in [key for key in self.sessions if key[0] == addr]:
+            self._close(self.sessions.pop(key))
+        sender = f'udp-{self.next_sender_id}'
+        self.next_sender_id += 1
+        session = DatagramSession(sender, session_id, addr)
+        self.sessions[(addr, session_id)] = session
+        self.runtime.sequencer.register(sender)
+        metrics.track_queue(f'local:{sender}', lambda: self.runtime.sequencer.depth(sender))
+        session.pump = asyncio.ensure_future(self._pump(session))
+        print(f"[+] Local UDP sender connected ({sender}, {addr[0]}:{addr[1]}).")
+        return session
 
+    def _close(self, session):
+        session.pump.cancel()
+        self.runtime.sequencer.unregister(session.sender)
+        metrics.untrack_queue(f'local:{session.sender}')
 
-@sio.event
-def disconnect():
-    print("\n[-] Disconnected from server.")
+    def expire(self, now=None):
+        """Close the sessions idle for UDP_SESSION_IDLE_SECONDS whose datagrams have all been submitted."""
+        now = time.monotonic() if now is None else now
+        for key, session in list(self.sessions.items()):
+            if (now - session.seen_at >= UDP_SESSION_IDLE_SECONDS and session.queue.empty()
+                    and not session.submitting):
+                self._close(self.sessions.pop(key))
+                print(f"[*] Local UDP sender {session.sender} idle, session closed.")
 
+    async def _expire_idle(self):
+        while True:
+            await asyncio.sleep(UDP_SESSION_IDLE_SECONDS / 4)
+            self.expire()
 
-def handle_keystroke(msg_type, payload):
-    if msg_type == 'letter':
-        KeyboardController.press_key(payload)
-    elif msg_type in ['word', 'block']:
-        KeyboardController.type_text(payload)
+    async def _pump(self, session):
+        # Submitting in order, one event at a time, keeps the sender's events
+        # in seq order and leaves the backlog here while its queue is full.
+        while True:
+            seq, event_id, event, trace = await session.queue.get()
 
+            async def reply(*acks, seq=seq):
+                for ack in acks:
+                    if ack['kind'] == 'execution-ack':
+                        session.remember(seq, ack)
+                self._send(session, UDP_ACKS, encode_local_acks(acks))
 
-@sio.on('keystroke')
-def on_keystroke(data):
-    msg_type = data.get('type')
-    payload = data.get('payload')
-    room_code = data.get('roomCode') or getattr(sio, 'room_code', None)
-    event_id = data.get('eventId')
-    client_event_id = data.get('clientEventId')
+            client_event_id = event['clientEventId']
+            # Cancelling the pump now would lose the event, so expire() waits.
+            session.submitting = True
+            try:
+                await self.runtime.submit(session.sender, event['type'], event['payload'],
+                                          local_execution_ack(reply, event_id, client_event_id, trace), trace,
+                                          on_progress=local_execution_progress(reply, event_id, client_event_id),
+                                          must_type=event.get('mustType'), version=client_event_id or None)
+            finally:
+                session.submitting = False
+
+    def _send(self, session, kind, body=b''):
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.sendto(UDP_HEADER.pack(kind, session.session_id, session.received) + body, session.addr)
+
+    def close(self):
+        if self._expirer is not None:
+            self._expirer.cancel()
+        for session in self.sessions.values():
+            self._close(session)
+        self.sessions = {}
+        if self.transport is not None:
+            self.transport.close()
 
+
+class LocalDatagramSender(asyncio.DatagramProtocol):
+    """
+    Sending side of the UDP protocol, for tests and as a reference for
+    native senders. Datagrams without a delivery ack are resent every
+    UDP_RETRANSMIT_SECONDS and at once when NACKed; delivered ones whose
+    execution acks are overdue are resent after UDP_EXECUTION_WAIT_SECONDS
+    so the receiver repeats them. Events are stamped with `sentAt`, clock
+    pings are answered, and a KEEPALIVE goes out when nothing else has for a
+    third of UDP_SESSION_IDLE_SECONDS. `acks` collects every ack received.
+    """
+
+    def __init__(self, session_id=None):
+        self.session_id = session_id or random.getrandbits(32) or 1
+        self.transport = None
+        self.next_seq = 1
+        self.next_client_event_id = 1
+        self.delivered = 0
+        self.unacked = {}
+        self.executed = {}
+        self.acks = []
+        self.sent_at = time.monotonic()
+        self._changed = asyncio.Event()
+        self._retransmitter = None
+
+    @classmethod
+    async def connect(cls, host, port, **kwargs):
+        loop = asyncio.get_running_loop()
+        _, sender = await loop.create_datagram_endpoint(lambda: cls(**kwargs), remote_addr=(host, port))
+        return sender
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self._retransmitter = asyncio.ensure_future(self._retransmit())
+
+    def send(self, events):
+        """Send `events` (dicts as for encode_local_events) in one datagram; returns its seq."""
+        for event in events:
+            event.setdefault('sentAt', wall_ms())
+            if not event.get('clientEventId'):
+                event['clientEventId'] = self.next_client_event_id
+            self.next_client_event_id = max(self.next_client_event_id, event['clientEventId'] + 1)
+        seq = self.next_seq
+        self.next_seq += 1
+        datagram = UDP_HEADER.pack(UDP_DATA, self.session_id, seq) + encode_local_events(events)
+        waiting = {event['clientEventId'] for event in events
+                   if event['type'] not in ('focus-lock', 'focus-release')}
+        self.unacked[seq] = [datagram, waiting, time.monotonic()]
+        self._transmit(datagram)
+        return seq
+
+    def datagram_received(self, data, addr):
+        if len(data) < UDP_HEADER.size:
+            return
+        kind, session_id, received = UDP_HEADER.unpack_from(data)
+        if session_id != self.session_id:
+            return
+        self.delivered = max(self.delivered, received)
+        body = data[UDP_HEADER.size:]
+        if kind == UDP_ACKS:
+            for ack in decode_local_acks(body):
+                self.acks.append(ack)
+                if ack['kind'] == 'execution-ack':
+                    self.executed.setdefault(ack['clientEventId'], ack)
+        elif kind == UDP_NACK:
+            for (seq,) in struct.iter_unpack('<I', body[:len(body) // 4 * 4]):
+                self._resend(seq)
+        elif kind == UDP_PING and len(body) >= 8:
+            t0, = struct.unpack_from('<d', body)
+            self._transmit(UDP_HEADER.pack(UDP_PONG, self.session_id, 0) + UDP_CLOCK.pack(t0, wall_ms()))
+        for seq, (_, waiting, _) in list(self.unacked.items()):
+            if seq <= self.delivered and waiting <= self.executed.keys():
+                del self.unacked[seq]
+        self._changed.set()
+
+    def error_received(self, exc):
+        # ICMP errors while the receiver is not listening yet; retransmits cover them.
+        pass
+
+    def _transmit(self, datagram):
+        self.sent_at = time.monotonic()
+        self.transport.sendto(datagram)
+
+    def _resend(self, seq):
+        entry = self.unacked.get(seq)
+        if entry is not None:
+            entry[2] = time.monotonic()
+            self._transmit(entry[0])
+
+    async def _retransmit(self):
+        while True:
+            await asyncio.sleep(UDP_RETRANSMIT_SECONDS / 2)
+            now = time.monotonic()
+            for seq, entry in list(self.unacked.items()):
+                wait = UDP_RETRANSMIT_SECONDS if seq > self.delivered else UDP_EXECUTION_WAIT_SECONDS
+                if now - entry[2] >= wait:
+                    self._resend(seq)
+            if time.monotonic() - self.sent_at >= UDP_SESSION_IDLE_SECONDS / 3:
+                self._transmit(UDP_HEADER.pack(UDP_KEEPALIVE, self.session_id, 0))
+
+    async def wait_executed(self):
+        """Wait until every datagram sent so far is delivered and all its events have execution acks."""
+        while self.unacked:
+            self._changed.clear()
+            await self._changed.wait()
+
+    def close(self):
+        if self._retransmitter is not None:
+            self._retransmitter.cancel()
+        if self.transport is not None:
+            self.transport.close()
+
+
+def load_json_codec():
+    """Return (loads, dumps) backed by orjson when it is installed."""
     try:
-        handle_keystroke(msg_type, payload)
-        if room_code and event_id:
-            sio.emit('execution-ack', {
-                'roomCode': room_code,
-                'eventId': event_id,
-                'clientEventId': client_event_id,
-                'ok': True
-            })
-    except Exception as error:
-        print(f"[!] Keystroke execution error: {error}")
-        if room_code and event_id:
-            sio.emit('execution-ack', {
-                'roomCode': room_code,
-                'eventId': event_id,
-                'clientEventId': client_event_id,
-                'ok': False,
-                'error': str(error)
-            })
+        import orjson
+    except ImportError:
+        return json.loads, lambda obj: json.dumps(obj, separators=(',', ':'))
+    return orjson.loads, lambda obj: orjson.dumps(obj).decode('utf-8')
 
 
-def fetch_events(server_url, room_code, since_id):
-    url = f"{server_url}/api/rooms/{quote(room_code)}/events"
-    response = requests.get(url, params={'since': since_id}, timeout=20)
-    response.raise_for_status()
-    return response.json()
+LOCAL_PAGE_STYLE = """body { font-family: Arial, sans-serif; margin: 20px; background: #f4f4f9; }
+.container { max-width: 520px; margin: 0 auto; background: white; padding: 16px; border-radius: 10px; box-shadow: 0 6px 14px rgba(0,0,0,0.08); }
+h1 { margin-top: 0; font-size: 1.4rem; }
+.tabs { display: flex; margin-bottom: 12px; border: 1px solid #ddd; border-radius: 8px; overflow: hidden; }
+.tab-btn { flex: 1; padding: 10px; border: none; cursor: pointer; font-weight: 700; background: #f8f9fa; }
+.tab-btn.active { background: #007bff; color: #fff; }
+.mode-section { display: none; }
+.mode-section.active { display: block; }
+input[type="text"], textarea, button { width: 100%; box-sizing: border-box; padding: 10px; margin-bottom: 8px; border-radius: 8px; border: 1px solid #ccc; font-size: 16px; }
+button { border: none; background: #28a745; color: white; font-weight: 700; cursor: pointer; }
+button.stop-btn { background: #dc3545; }
+.controls { display: flex; justify-content: space-around; flex-wrap: wrap; gap: 8px 12px; margin-bottom: 10px; background: #f8f9fa; border-radius: 8px; padding: 8px; }
+.toggle-row { display: flex; align-items: center; gap: 8px; font-size: 13px; margin-bottom: 8px; }
+.toggle-row input[type="checkbox"] { width: auto; margin: 0; }
+.status { text-align: center; font-weight: 700; margin-top: 8px; }
+.delivery-status { text-align: center; font-size: 12px; margin-top: 6px; }
+.ok { color: #28a745; }
+.warn { color: #b8860b; }
+.error { color: #dc3545; }
+.connected { color: #28a745; }
+.disconnected { color: #dc3545; }
+"""
 
+LOCAL_PAGE_SCRIPT = """const scheme = window.location.protocol === "https:" ? "wss" : "ws";
+const BINARY_PROTOCOL = 'rk.bin.v1';
+const ws = new WebSocket(`${scheme}://${window.location.host}/ws`, [BINARY_PROTOCOL]);
+ws.binaryType = 'arraybuffer';
+const statusEl = document.getElementById("status");
+const deliveryStatusEl = document.getElementById("delivery-status");
+const letterInput = document.getElementById("letter-input");
+const wordInput = document.getElementById("word-input");
+const wordWrap = document.getElementById("word-wrap");
+const typewriterInput = document.getElementById("typewriter-input");
+const typewriterWrap = document.getElementById("typewriter-wrap");
+const mirrorInput = document.getElementById("mirror-input");
+const mirrorWrap = document.getElementById("mirror-wrap");
+const sanitizeToggleEl = document.getElementById("sanitize-toggle");
+const denyShortcutsToggleEl = document.getElementById("deny-shortcuts-toggle");
+const shortcutDenylistEl = document.getElementById("shortcut-denylist");
+const focusLockToggleEl = document.getElementById("focus-lock-toggle");
 
-def run_polling_client(server_url, room_code):
-    print(f"[*] Polling {server_url} room {room_code}...")
-    since_id = 0
+const COMMAND_KEYS = new Set(['Backspace', 'Delete', 'Enter', 'Tab', 'Escape', 'ArrowUp', 'ArrowDown', 'ArrowLeft', 'ArrowRight', 'Home', 'End', 'PageUp', 'PageDown']);
+const MODIFIER_ONLY_KEYS = new Set(['Shift', 'Control', 'Alt', 'Meta', 'AltGraph', 'CapsLock', 'NumLock', 'ScrollLock', 'Fn', 'ContextMenu', 'OS']);
+const DEFAULT_DENYLIST = 'Ctrl+W,Ctrl+R,Alt+F4,Meta+Q';
+const ACK_TIMEOUT_MS = 6000;
+const SNIPPETS_REMEMBERED = 256;
+const SNIPPET_MIN_CHARS = 256;
 
-    while True:
-        try:
-            payload = fetch_events(server_url, room_code, since_id)
-            for event in payload.get('events', []):
-                handle_keystroke(event.get('type'), event.get('payload'))
-            since_id = payload.get('nextSince', since_id)
-            time.sleep(POLL_INTERVAL_SECONDS)
-        except requests.RequestException as error:
-            print(f"[!] Polling error: {error}")
-            time.sleep(2)
+const EVENT_TYPE_CODES = {
+  letter: 1, word: 2, block: 3, 'focus-lock': 4, 'focus-release': 5, cancel: 6, mirror: 7, 'mirror-base': 8,
+  snippet: 9
+};
+const MUST_TYPE_FLAG = 0x80;
+const SENT_AT_FLAG = 0x40;
+const ACK_KINDS = { 1: 'delivery-ack', 2: 'execution-ack', 3: 'focus', 4: 'progress' };
+const textEncoder = new TextEncoder();
+const textDecoder = new TextDecoder();
+const outgoing = [];
+let flushScheduled = false;
+let mirrorScheduled = false;
+let mirrorSent = '';
 
+let nextClientEventId = Number.parseInt(localStorage.getItem('rk_local_next_client_event_id') || '1', 10);
+let deniedShortcuts = new Set();
+const pendingAcks = new Map();
+const snippets = loadSnippets();
 
-def run_websocket_client(server_url, room_code):
-    sio.room_code = room_code
-    print(f"[*] Connecting to {server_url} using WebSocket...")
-    sio.connect(server_url)
-    sio.wait()
+function setDeliveryStatus(text, tone = '') {
+  deliveryStatusEl.textContent = text;
+  deliveryStatusEl.className = `delivery-status ${tone}`.trim();
+}
 
+function normalizeKeyName(rawKey) {
+  if (rawKey === 'Esc') return 'Escape';
+  if (rawKey === 'Del') return 'Delete';
+  if (rawKey === 'Return') return 'Enter';
+  if (rawKey === 'Spacebar') return ' ';
+  return rawKey;
+}
 
-def normalize_url(server_url):
-    return server_url.rstrip('/')
+function normalizeModifierName(name) {
+  const key = String(name || '').trim().toLowerCase();
+  if (!key) return '';
+  if (key === 'ctrl' || key === 'control') return 'Control';
+  if (key === 'alt' || key === 'option') return 'Alt';
+  if (key === 'shift') return 'Shift';
+  if (['cmd', 'command', 'meta', 'win', 'super'].includes(key)) return 'Meta';
+  return '';
+}
+
+function normalizeShortcutMain(mainKey) {
+  const key = normalizeKeyName(mainKey).trim();
+  if (!key) return '';
+  if (key.length === 1) return key.toUpperCase();
+  return key;
+}
+
+function normalizeShortcutToken(token) {
+  const parts = token.split('+').map(part => part.trim()).filter(Boolean);
+  if (parts.length < 2) return '';
+
+  const modifiers = [];
+  for (let i = 0; i < parts.length - 1; i++) {
+    const modifier = normalizeModifierName(parts[i]);
+    if (!modifier) return '';
+    if (!modifiers.includes(modifier)) modifiers.push(modifier);
+  }
+
+  const main = normalizeShortcutMain(parts[parts.length - 1]);
+  if (!main) return '';
+  return `${modifiers.sort().join('+')}+${main}`;
+}
+
+function refreshDenylist() {
+  deniedShortcuts = new Set(
+    shortcutDenylistEl.value
+      .split(',')
+      .map(token => normalizeShortcutToken(token))
+      .filter(Boolean)
+  );
+}
+
+function keyboardEventToShortcut(event, rawKey) {
+  const modifiers = [];
+  if (event.ctrlKey) modifiers.push('Control');
+  if (event.altKey) modifiers.push('Alt');
+  if (event.shiftKey) modifiers.push('Shift');
+  if (event.metaKey) modifiers.push('Meta');
+  if (modifiers.length === 0) return '';
+
+  const main = normalizeShortcutMain(rawKey);
+  if (!main) return '';
+  return `${modifiers.sort().join('+')}+${main}`;
+}
+
+function isShortcutDenied(event, rawKey) {
+  if (!denyShortcutsToggleEl.checked) return '';
+  const shortcut = keyboardEventToShortcut(event, rawKey);
+  if (!shortcut) return '';
+  return deniedShortcuts.has(shortcut) ? shortcut : '';
+}
+
+function sanitizeLetterKey(rawKey, keyboardEvent) {
+  const key = normalizeKeyName(rawKey);
+  if (MODIFIER_ONLY_KEYS.has(key)) return null;
+  if (keyboardEvent && (keyboardEvent.ctrlKey || keyboardEvent.metaKey || keyboardEvent.altKey)) return null;
+  if (key.length === 1 || COMMAND_KEYS.has(key)) return key;
+  return null;
+}
+
+// Milliseconds since the epoch on this device's clock, with sub-millisecond precision.
+function senderClock() {
+  return performance.timeOrigin + performance.now();
+}
+
+function nextEventId() {
+  if (!Number.isFinite(nextClientEventId) || nextClientEventId < 1) nextClientEventId = 1;
+  const current = nextClientEventId;
+  nextClientEventId += 1;
+  localStorage.setItem('rk_local_next_client_event_id', String(nextClientEventId));
+  return current;
+}
+
+// Binary frames: [u8 type][u32 clientEventId][u32 length][f64 sentAt, if flagged][UTF-8 payload] per event.
+// The type's high bit marks text that must be typed, never pasted; 0x40 marks a sentAt field.
+function encodeEvents(events) {
+  const encoded = events.map(e => [
+    EVENT_TYPE_CODES[e.type] | (e.mustType ? MUST_TYPE_FLAG : 0) | (e.sentAt !== undefined ? SENT_AT_FLAG : 0),
+    e.clientEventId, e.sentAt, textEncoder.encode(e.payload)
+  ]);
+  const size = encoded.reduce((total, [code, , , bytes]) => total + 9 + (code & SENT_AT_FLAG ? 8 : 0) + bytes.length, 0);
+  const buffer = new ArrayBuffer(size);
+  const view = new DataView(buffer);
+  const bytesOut = new Uint8Array(buffer);
+  let offset = 0;
+  for (const [code, clientEventId, sentAt, bytes] of encoded) {
+    view.setUint8(offset, code);
+    view.setUint32(offset + 1, clientEventId, true);
+    view.setUint32(offset + 5, bytes.length, true);
+    offset += 9;
+    if (code & SENT_AT_FLAG) {
+      view.setFloat64(offset, sentAt, true);
+      offset += 8;
+    }
+    bytesOut.set(bytes, offset);
+    offset += bytes.length;
+  }
+  return buffer;
+}
+
+// [u8 kind][u8 flags][u32 eventId][u32 clientEventId][u16 length][UTF-8 text] per ack.
+// Flags: 1 ok, 2 text starts with "<typed>/<total>", 4 cancelled, 8 text starts with
+// the snippet digest the block was kept under (before any counts), 16 unknown snippet.
+function decodeAcks(buffer) {
+  const view = new DataView(buffer);
+  const acks = [];
+  let offset = 0;
+  while (offset + 12 <= buffer.byteLength) {
+    const flags = view.getUint8(offset + 1);
+    const textLength = view.getUint16(offset + 10, true);
+    let text = textLength ? textDecoder.decode(new Uint8Array(buffer, offset + 12, textLength)) : '';
+    const ack = {
+      kind: ACK_KINDS[view.getUint8(offset)],
+      ok: (flags & 1) === 1,
+      cancelled: (flags & 4) === 4,
+      eventId: view.getUint32(offset + 2, true),
+      clientEventId: view.getUint32(offset + 6, true),
+      snippetMiss: (flags & 16) === 16
+    };
+    if (flags & 8) {
+      const space = text.indexOf(' ');
+      ack.snippet = space === -1 ? text : text.slice(0, space);
+      text = space === -1 ? '' : text.slice(space + 1);
+    }
+    if (flags & 2) {
+      const space = text.indexOf(' ');
+      const counts = (space === -1 ? text : text.slice(0, space)).split('/');
+      ack.typed = Number(counts[0]);
+      ack.total = Number(counts[1]);
+      text = space === -1 ? '' : text.slice(space + 1);
+    }
+    ack.error = text || null;
+    acks.push(ack);
+    offset += 12 + textLength;
+  }
+  return acks;
+}
+
+function flushOutgoing() {
+  flushScheduled = false;
+  if (outgoing.length === 0 || ws.readyState !== WebSocket.OPEN) return;
+  if (ws.bufferedAmount > 0) {
+    // Socket is backed up: keep collecting events into the next frame.
+    flushScheduled = true;
+    setTimeout(flushOutgoing, 4);
+    return;
+  }
+  const events = outgoing.splice(0, outgoing.length);
+  if (ws.protocol === BINARY_PROTOCOL) {
+    ws.send(encodeEvents(events));
+  } else {
+    ws.send(JSON.stringify(events.length === 1 ? events[0] : events));
+  }
+}
+
+function queueOutgoing(event) {
+  outgoing.push(event);
+  if (!flushScheduled) {
+    flushScheduled = true;
+    queueMicrotask(flushOutgoing);
+  }
+}
+
+function sendControl(type) {
+  if (ws.readyState !== WebSocket.OPEN) return;
+  queueOutgoing({ type, payload: '', clientEventId: 0 });
+}
+
+function armAckTimer(clientEventId) {
+  return setTimeout(() => {
+    if (!pendingAcks.has(clientEventId)) return;
+    pendingAcks.delete(clientEventId);
+    setDeliveryStatus(`No execution ACK yet for client event ${clientEventId}`, 'warn');
+  }, ACK_TIMEOUT_MS);
+}
+
+// `block` is the full text behind a block or snippet event, kept until it is acked.
+function send(type, payload, options = {}, block = null) {
+  if (ws.readyState !== WebSocket.OPEN) return;
+  const clientEventId = nextEventId();
+  queueOutgoing({ type, payload, clientEventId, sentAt: senderClock(), ...options });
+
+  pendingAcks.set(clientEventId, { timer: armAckTimer(clientEventId), block, options });
+  setDeliveryStatus(`Sent client event ${clientEventId}`);
+}
+
+// SHA-256 of the text's UTF-8 bytes, first 16 bytes in hex: the digest the
+// receiver keeps a block under. crypto.subtle is only available on https
+// and localhost origins, so it is computed here.
+const SHA256_K = new Uint32Array([
+  0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
+  0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
+  0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+  0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
+  0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+  0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+  0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
+  0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2
+]);
+
+function snippetDigest(text) {
+  const bytes = textEncoder.encode(text);
+  const padded = new Uint8Array((bytes.length + 72) & ~63);
+  padded.set(bytes);
+  padded[bytes.length] = 0x80;
+  const view = new DataView(padded.buffer);
+  view.setUint32(padded.length - 8, Math.floor(bytes.length / 0x20000000));
+  view.setUint32(padded.length - 4, (bytes.length * 8) >>> 0);
+  const hash = new Uint32Array([
+    0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a, 0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19
+  ]);
+  const w = new Uint32Array(64);
+  const ror = (x, n) => (x >>> n) | (x << (32 - n));
+  for (let offset = 0; offset < padded.length; offset += 64) {
+    for (let i = 0; i < 16; i++) w[i] = view.getUint32(offset + i * 4);
+    for (let i = 16; i < 64; i++) {
+      const s0 = ror(w[i - 15], 7) ^ ror(w[i - 15], 18) ^ (w[i - 15] >>> 3);
+      const s1 = ror(w[i - 2], 17) ^ ror(w[i - 2], 19) ^ (w[i - 2] >>> 10);
+      w[i] = w[i - 16] + s0 + w[i - 7] + s1;
+    }
+    let [a, b, c, d, e, f, g, h] = hash;
+    for (let i = 0; i < 64; i++) {
+      const t1 = (h + (ror(e, 6) ^ ror(e, 11) ^ ror(e, 25)) + ((e & f) ^ (~e & g)) + SHA256_K[i] + w[i]) >>> 0;
+      const t2 = ((ror(a, 2) ^ ror(a, 13) ^ ror(a, 22)) + ((a & b) ^ (a & c) ^ (b & c))) >>> 0;
+      h = g; g = f; f = e; e = (d + t1) >>> 0; d = c; c = b; b = a; a = (t1 + t2) >>> 0;
+    }
+    [a, b, c, d, e, f, g, h].forEach((value, i) => { hash[i] += value; });
+  }
+  return Array.from(hash.subarray(0, 4), (word) => word.toString(16).padStart(8, '0')).join('');
+}
+
+// Digests of blocks the computer has kept; only digests are stored, never the text.
+function loadSnippets() {
+  let digests = [];
+  try {
+    digests = JSON.parse(localStorage.getItem('rk_local_snippets') || '[]');
+  } catch (_) {
+    // Unreadable: start over.
+  }
+  const loaded = new Set(Array.isArray(digests) ? digests.filter(digest => typeof digest === 'string') : []);
+  localStorage.setItem('rk_local_snippets', JSON.stringify([...loaded]));
+  return loaded;
+}
+
+function rememberSnippet(digest) {
+  snippets.delete(digest);
+  snippets.add(digest);
+  while (snippets.size > SNIPPETS_REMEMBERED) snippets.delete(snippets.values().next().value);
+  localStorage.setItem('rk_local_snippets', JSON.stringify([...snippets]));
+}
+
+function forgetSnippet(digest) {
+  if (snippets.delete(digest)) localStorage.setItem('rk_local_snippets', JSON.stringify([...snippets]));
+}
+
+// Stops a block that is being typed and drops this device's queued text.
+function stopTyping() {
+  send('cancel', 'stop');
+}
+
+function getInstantType() {
+  const selected = document.querySelector('input[name="instant-type"]:checked');
+  return selected ? selected.value : 'letter';
+}
+
+function applyInstantType(mode) {
+  letterInput.style.display = mode === 'letter' ? '' : 'none';
+  wordWrap.style.display = mode === 'word' ? '' : 'none';
+  typewriterWrap.style.display = mode === 'typewriter' ? '' : 'none';
+  mirrorWrap.style.display = mode === 'mirror' ? '' : 'none';
+  if (mode === 'mirror') startMirror();
+}
+
+// Mirror mode sends the whole field and the computer types only the
+// difference. 'mirror-base' tells it the target already holds the field as
+// it is now; edits then go out at most once per animation frame.
+function startMirror() {
+  mirrorSent = mirrorInput.value;
+  send('mirror-base', mirrorSent);
+}
+
+function scheduleMirror() {
+  if (mirrorScheduled) return;
+  mirrorScheduled = true;
+  requestAnimationFrame(() => {
+    mirrorScheduled = false;
+    if (mirrorInput.value === mirrorSent) return;
+    mirrorSent = mirrorInput.value;
+    send('mirror', mirrorSent);
+  });
+}
+
+ws.onopen = () => {
+  statusEl.textContent = "Connected";
+  statusEl.className = "status connected";
+  // The receiver pings this page to learn its clock offset, so events can be traced from the keypress.
+  ws.send(JSON.stringify({ type: 'clock-sync' }));
+  if (getInstantType() === 'mirror') startMirror();
+};
+
+ws.onclose = () => {
+  statusEl.textContent = "Disconnected";
+  statusEl.className = "status disconnected";
+};
+
+ws.onmessage = (event) => {
+  let frames;
+  if (typeof event.data === 'string') {
+    try {
+      frames = [].concat(JSON.parse(event.data));
+    } catch (_) {
+      return;
+    }
+  } else {
+    frames = decodeAcks(event.data);
+  }
+  frames.forEach(handleAck);
+};
+
+function handleAck(data) {
+  if (data.kind === 'clock-ping') {
+    ws.send(JSON.stringify({ type: 'clock-pong', t0: data.t0, t1: senderClock() }));
+    return;
+  }
+
+  if (data.kind === 'focus') {
+    focusLockToggleEl.checked = data.ok;
+    if (data.ok) {
+      setDeliveryStatus('Keyboard locked to this device', 'ok');
+    } else if (focusLockToggleEl.dataset.requested === '1') {
+      setDeliveryStatus('Another device holds the keyboard lock', 'warn');
+    }
+    focusLockToggleEl.dataset.requested = '0';
+    return;
+  }
+
+  const clientEventId = data.clientEventId;
+  if (!clientEventId || !pendingAcks.has(clientEventId)) return;
+
+  if (data.kind === 'delivery-ack') {
+    setDeliveryStatus(`Queued #${data.eventId}`);
+    return;
+  }
+
+  if (data.kind === 'progress') {
+    // Long blocks are typed in chunks; each chunk restarts the ACK timeout.
+    const record = pendingAcks.get(clientEventId);
+    clearTimeout(record.timer);
+    record.timer = armAckTimer(clientEventId);
+    setDeliveryStatus(`Typing #${data.eventId}: ${data.typed}/${data.total} characters`);
+    return;
+  }
+
+  if (data.kind === 'execution-ack') {
+    const record = pendingAcks.get(clientEventId);
+    clearTimeout(record.timer);
+    pendingAcks.delete(clientEventId);
+
+    if (data.snippetMiss && record.block !== null) {
+      // The computer no longer has this block: send it in full, which keeps it again.
+      forgetSnippet(snippetDigest(record.block));
+      send('block', record.block, record.options, record.block);
+      return;
+    }
+    if (data.snippet) rememberSnippet(data.snippet);
+
+    if (data.cancelled) {
+      setDeliveryStatus(`Stopped #${data.eventId} after ${data.typed}/${data.total} characters`, 'warn');
+    } else if (data.ok === false) {
+      setDeliveryStatus(`Execution failed #${data.eventId}: ${data.error || 'unknown error'}`, 'error');
+    } else {
+      setDeliveryStatus(`Executed #${data.eventId}`, 'ok');
+    }
+  }
+}
+
+function switchTab(tab) {
+  document.querySelectorAll('.mode-section').forEach(el => el.classList.remove('active'));
+  document.querySelectorAll('.tab-btn').forEach(el => el.classList.remove('active'));
+  document.getElementById(`${tab}-mode`).classList.add('active');
+  if (window.event && window.event.target) window.event.target.classList.add('active');
+}
+
+document.querySelectorAll('input[name="instant-type"]').forEach(radio => {
+  radio.addEventListener('change', (e) => applyInstantType(e.target.value));
+});
+
+letterInput.addEventListener('input', () => {
+  const val = letterInput.value;
+  if (!val) return;
+  send('letter', val[val.length - 1]);
+  letterInput.value = '';
+});
+
+letterInput.addEventListener('keydown', (e) => {
+  if (e.key === 'Backspace' || e.key === 'Enter') send('letter', e.key);
+});
+
+typewriterInput.addEventListener('keydown', (e) => {
+  const rawKey = normalizeKeyName(e.key);
+  const denied = isShortcutDenied(e, rawKey);
+
+  e.preventDefault();
+  if (denied) {
+    stopTyping();
+    setDeliveryStatus(`Blocked shortcut: ${denied}`, 'warn');
+    return;
+  }
+
+  const keyToSend = sanitizeToggleEl.checked ? sanitizeLetterKey(rawKey, e) : rawKey;
+  if (!keyToSend) return;
+
+  send('letter', keyToSend);
+  typewriterInput.value = '';
+});
+
+function sendWordContent() {
+  const val = wordInput.value.trim();
+  if (!val) return;
+  send('word', `${val} `);
+  wordInput.value = '';
+}
+
+function manualSendWord() {
+  sendWordContent();
+  wordInput.focus();
+}
+
+wordInput.addEventListener('input', () => {
+  if (wordInput.value.endsWith(' ')) sendWordContent();
+});
+
+mirrorInput.addEventListener('input', scheduleMirror);
+
+wordInput.addEventListener('keydown', (e) => {
+  if (e.key === 'Enter') {
+    e.preventDefault();
+    sendWordContent();
+  }
+});
+
+function sendBlock() {
+  const box = document.getElementById('button-input');
+  if (!box.value) return;
+  const options = document.getElementById('must-type-toggle').checked ? { mustType: true } : {};
+  const digest = box.value.length >= SNIPPET_MIN_CHARS ? snippetDigest(box.value) : null;
+  if (digest && snippets.has(digest)) {
+    send('snippet', digest, options, box.value);
+  } else {
+    send('block', box.value, options, box.value);
+  }
+  box.value = '';
+}
+
+sanitizeToggleEl.checked = localStorage.getItem('rk_local_sanitize_before_send') !== '0';
+denyShortcutsToggleEl.checked = localStorage.getItem('rk_local_deny_shortcuts_enabled') !== '0';
+shortcutDenylistEl.value = localStorage.getItem('rk_local_shortcut_denylist') || DEFAULT_DENYLIST;
+
+sanitizeToggleEl.addEventListener('change', () => {
+  localStorage.setItem('rk_local_sanitize_before_send', sanitizeToggleEl.checked ? '1' : '0');
+});
 
+denyShortcutsToggleEl.addEventListener('change', () => {
+  localStorage.setItem('rk_local_deny_shortcuts_enabled', denyShortcutsToggleEl.checked ? '1' : '0');
+});
 
-def run_local_mode():
-    app = FastAPI(title="Remote Keyboard Local Mode")
-    local_page = """<!DOCTYPE html>
+focusLockToggleEl.addEventListener('change', () => {
+  focusLockToggleEl.dataset.requested = focusLockToggleEl.checked ? '1' : '0';
+  sendControl(focusLockToggleEl.checked ? 'focus-lock' : 'focus-release');
+});
+
+shortcutDenylistEl.addEventListener('change', () => {
+  localStorage.setItem('rk_local_shortcut_denylist', shortcutDenylistEl.value.trim());
+  refreshDenylist();
+});
+
+refreshDenylist();
+applyInstantType(getInstantType());
+
+// The service worker is opt-in (--service-worker); without it, drop any left
+// from an earlier run so the page is not served from a stale cache.
+const serviceWorkerMeta = document.querySelector('meta[name="rk-service-worker"]');
+if ('serviceWorker' in navigator) {
+  if (serviceWorkerMeta) {
+    navigator.serviceWorker.register(serviceWorkerMeta.content).catch(() => {});
+  } else {
+    navigator.serviceWorker.getRegistrations()
+      .then((registrations) => registrations.forEach((registration) => registration.unregister()));
+  }
+}
+
+window.switchTab = switchTab;
+window.manualSendWord = manualSendWord;
+window.sendBlock = sendBlock;
+window.stopTyping = stopTyping;
+"""
+
+LOCAL_PAGE_HTML = """<!DOCTYPE html>
 <html lang="en">
 <head>
   <meta charset="UTF-8">
   <meta name="viewport" content="width=device-width, initial-scale=1.0">
   <title>Remote Keyboard (Local)</title>
-  <style>
-    body { font-family: Arial, sans-serif; margin: 20px; background: #f4f4f9; }
-    .container { max-width: 520px; margin: 0 auto; background: white; padding: 16px; border-radius: 10px; box-shadow: 0 6px 14px rgba(0,0,0,0.08); }
-    h1 { margin-top: 0; font-size: 1.4rem; }
-    .tabs { display: flex; margin-bottom: 12px; border: 1px solid #ddd; border-radius: 8px; overflow: hidden; }
-    .tab-btn { flex: 1; padding: 10px; border: none; cursor: pointer; font-weight: 700; background: #f8f9fa; }
-    .tab-btn.active { background: #007bff; color: #fff; }
-    .mode-section { display: none; }
-    .mode-section.active { display: block; }
-    input[type="text"], textarea, button { width: 100%; box-sizing: border-box; padding: 10px; margin-bottom: 8px; border-radius: 8px; border: 1px solid #ccc; font-size: 16px; }
-    button { border: none; background: #28a745; color: white; font-weight: 700; cursor: pointer; }
-    .controls { display: flex; justify-content: space-around; flex-wrap: wrap; gap: 8px 12px; margin-bottom: 10px; background: #f8f9fa; border-radius: 8px; padding: 8px; }
-    .toggle-row { display: flex; align-items: center; gap: 8px; font-size: 13px; margin-bottom: 8px; }
-    .toggle-row input[type="checkbox"] { width: auto; margin: 0; }
-    .status { text-align: center; font-weight: 700; margin-top: 8px; }
-    .delivery-status { text-align: center; font-size: 12px; margin-top: 6px; }
-    .ok { color: #28a745; }
-    .warn { color: #b8860b; }
-    .error { color: #dc3545; }
-    .connected { color: #28a745; }
-    .disconnected { color: #dc3545; }
-  </style>
-</head>
+  <link rel="stylesheet" href="__LOCAL_STYLE_URL__">
+__LOCAL_SERVICE_WORKER__</head>
 <body>
   <div class="container">
     <h1>Remote Keyboard (Local)</h1>
@@ -176,9 +4316,11 @@ def run_local_mode():
         <label><input type="radio" name="instant-type" value="letter" checked> Letter</label>
         <label><input type="radio" name="instant-type" value="word"> Word</label>
         <label><input type="radio" name="instant-type" value="typewriter"> Typewriter</label>
+        <label><input type="radio" name="instant-type" value="mirror"> Mirror</label>
       </div>
       <label class="toggle-row"><input id="sanitize-toggle" type="checkbox" checked>Sanitize before sending</label>
       <label class="toggle-row"><input id="deny-shortcuts-toggle" type="checkbox" checked>Block denied shortcuts</label>
+      <label class="toggle-row"><input id="focus-lock-toggle" type="checkbox">Lock keyboard to this device</label>
       <input id="shortcut-denylist" type="text" placeholder="Ctrl+W, Ctrl+R, Alt+F4, Meta+Q" autocomplete="off">
       <input id="letter-input" type="text" placeholder="Type here..." autocomplete="off">
       <div id="word-wrap" style="display:none;">
@@ -188,405 +4330,620 @@ def run_local_mode():
       <div id="typewriter-wrap" style="display:none;">
         <input id="typewriter-input" type="text" placeholder="Type naturally; keys send instantly" autocomplete="off">
       </div>
+      <div id="mirror-wrap" style="display:none;">
+        <textarea id="mirror-input" rows="4" placeholder="Edit anywhere; the computer's text field follows"></textarea>
+      </div>
     </div>
     <div id="button-mode" class="mode-section">
       <textarea id="button-input" rows="5" placeholder="Type your full message"></textarea>
+      <label class="toggle-row"><input id="must-type-toggle" type="checkbox">Type it out (don't paste)</label>
       <button onclick="sendBlock()">Send Message</button>
+      <button class="stop-btn" onclick="stopTyping()">Stop Typing</button>
     </div>
     <div id="status" class="status disconnected">Disconnected</div>
     <div id="delivery-status" class="delivery-status">No events sent yet.</div>
   </div>
-  <script>
-    const scheme = window.location.protocol === "https:" ? "wss" : "ws";
-    const ws = new WebSocket(`${scheme}://${window.location.host}/ws`);
-    const statusEl = document.getElementById("status");
-    const deliveryStatusEl = document.getElementById("delivery-status");
-    const letterInput = document.getElementById("letter-input");
-    const wordInput = document.getElementById("word-input");
-    const wordWrap = document.getElementById("word-wrap");
-    const typewriterInput = document.getElementById("typewriter-input");
-    const typewriterWrap = document.getElementById("typewriter-wrap");
-    const sanitizeToggleEl = document.getElementById("sanitize-toggle");
-    const denyShortcutsToggleEl = document.getElementById("deny-shortcuts-toggle");
-    const shortcutDenylistEl = document.getElementById("shortcut-denylist");
-
-    const COMMAND_KEYS = new Set(['Backspace', 'Delete', 'Enter', 'Tab', 'Escape', 'ArrowUp', 'ArrowDown', 'ArrowLeft', 'ArrowRight', 'Home', 'End', 'PageUp', 'PageDown']);
-    const MODIFIER_ONLY_KEYS = new Set(['Shift', 'Control', 'Alt', 'Meta', 'AltGraph', 'CapsLock', 'NumLock', 'ScrollLock', 'Fn', 'ContextMenu', 'OS']);
-    const DEFAULT_DENYLIST = 'Ctrl+W,Ctrl+R,Alt+F4,Meta+Q';
-    const ACK_TIMEOUT_MS = 6000;
-
-    let nextClientEventId = Number.parseInt(localStorage.getItem('rk_local_next_client_event_id') || '1', 10);
-    let deniedShortcuts = new Set();
-    const pendingAcks = new Map();
-
-    function setDeliveryStatus(text, tone = '') {
-      deliveryStatusEl.textContent = text;
-      deliveryStatusEl.className = `delivery-status ${tone}`.trim();
-    }
-
-    function normalizeKeyName(rawKey) {
-      if (rawKey === 'Esc') return 'Escape';
-      if (rawKey === 'Del') return 'Delete';
-      if (rawKey === 'Return') return 'Enter';
-      if (rawKey === 'Spacebar') return ' ';
-      return rawKey;
-    }
-
-    function normalizeModifierName(name) {
-      const key = String(name || '').trim().toLowerCase();
-      if (!key) return '';
-      if (key === 'ctrl' || key === 'control') return 'Control';
-      if (key === 'alt' || key === 'option') return 'Alt';
-      if (key === 'shift') return 'Shift';
-      if (['cmd', 'command', 'meta', 'win', 'super'].includes(key)) return 'Meta';
-      return '';
-    }
-
-    function normalizeShortcutMain(mainKey) {
-      const key = normalizeKeyName(mainKey).trim();
-      if (!key) return '';
-      if (key.length === 1) return key.toUpperCase();
-      return key;
-    }
-
-    function normalizeShortcutToken(token) {
-      const parts = token.split('+').map(part => part.trim()).filter(Boolean);
-      if (parts.length < 2) return '';
-
-      const modifiers = [];
-      for (let i = 0; i < parts.length - 1; i++) {
-        const modifier = normalizeModifierName(parts[i]);
-        if (!modifier) return '';
-        if (!modifiers.includes(modifier)) modifiers.push(modifier);
-      }
+  <script src="__LOCAL_SCRIPT_URL__"></script>
+</body>
+</html>"""
 
-      const main = normalizeShortcutMain(parts[parts.length - 1]);
-      if (!main) return '';
-      return `${modifiers.sort().join('+')}+${main}`;
-    }
 
-    function refreshDenylist() {
-      deniedShortcuts = new Set(
-        shortcutDenylistEl.value
-          .split(',')
-          .map(token => normalizeShortcutToken(token))
-          .filter(Boolean)
-      );
-    }
+LOCAL_SERVICE_WORKER = """const CACHE = '__CACHE_NAME__';
+const PRECACHE = __PRECACHE__;
 
-    function keyboardEventToShortcut(event, rawKey) {
-      const modifiers = [];
-      if (event.ctrlKey) modifiers.push('Control');
-      if (event.altKey) modifiers.push('Alt');
-      if (event.shiftKey) modifiers.push('Shift');
-      if (event.metaKey) modifiers.push('Meta');
-      if (modifiers.length === 0) return '';
-
-      const main = normalizeShortcutMain(rawKey);
-      if (!main) return '';
-      return `${modifiers.sort().join('+')}+${main}`;
-    }
+self.addEventListener('install', (event) => {
+  event.waitUntil(caches.open(CACHE).then((cache) => cache.addAll(PRECACHE)).then(() => self.skipWaiting()));
+});
 
-    function isShortcutDenied(event, rawKey) {
-      if (!denyShortcutsToggleEl.checked) return '';
-      const shortcut = keyboardEventToShortcut(event, rawKey);
-      if (!shortcut) return '';
-      return deniedShortcuts.has(shortcut) ? shortcut : '';
-    }
+self.addEventListener('activate', (event) => {
+  event.waitUntil(caches.keys()
+    .then((names) => Promise.all(names
+      .filter((name) => name.startsWith('rk-local-') && name !== CACHE)
+      .map((name) => caches.delete(name))))
+    .then(() => self.clients.claim()));
+});
 
-    function sanitizeLetterKey(rawKey, keyboardEvent) {
-      const key = normalizeKeyName(rawKey);
-      if (MODIFIER_ONLY_KEYS.has(key)) return null;
-      if (keyboardEvent && (keyboardEvent.ctrlKey || keyboardEvent.metaKey || keyboardEvent.altKey)) return null;
-      if (key.length === 1 || COMMAND_KEYS.has(key)) return key;
-      return null;
+// The page opens from cache and is revalidated in the background; versioned
+// assets never change. /ws, /health and /metrics always go to the network.
+self.addEventListener('fetch', (event) => {
+  const url = new URL(event.request.url);
+  if (event.request.method !== 'GET' || url.origin !== self.location.origin || !PRECACHE.includes(url.pathname)) {
+    return;
+  }
+  event.respondWith(caches.open(CACHE).then(async (cache) => {
+    const cached = await cache.match(url.pathname);
+    if (cached && url.pathname !== '/') {
+      return cached;
     }
-
-    function nextEventId() {
-      if (!Number.isFinite(nextClientEventId) || nextClientEventId < 1) nextClientEventId = 1;
-      const current = nextClientEventId;
-      nextClientEventId += 1;
-      localStorage.setItem('rk_local_next_client_event_id', String(nextClientEventId));
-      return current;
+    const refreshed = fetch(event.request).then((response) => {
+      if (response.ok) {
+        cache.put(url.pathname, response.clone());
+      }
+      return response;
+    });
+    if (cached) {
+      event.waitUntil(refreshed.catch(() => {}));
+      return cached;
     }
+    return refreshed;
+  }));
+});
+"""
 
-    function send(type, payload) {
-      if (ws.readyState !== WebSocket.OPEN) return;
-      const clientEventId = nextEventId();
-      ws.send(JSON.stringify({ type, payload, clientEventId }));
-
-      const timer = setTimeout(() => {
-        if (!pendingAcks.has(clientEventId)) return;
-        pendingAcks.delete(clientEventId);
-        setDeliveryStatus(`No execution ACK yet for client event ${clientEventId}`, 'warn');
-      }, ACK_TIMEOUT_MS);
 
-      pendingAcks.set(clientEventId, { timer });
-      setDeliveryStatus(`Sent client event ${clientEventId}`);
-    }
+def load_compressors():
+    """[(content-coding, compress)] in order of preference; brotli only when it is installed."""
+    compressors = [('gzip', lambda data: gzip.compress(data, compresslevel=9, mtime=0))]
+    try:
+        import brotli
+    except ImportError:
+        return compressors
+    return [('br', lambda data: brotli.compress(data, quality=11))] + compressors
 
-    function getInstantType() {
-      const selected = document.querySelector('input[name="instant-type"]:checked');
-      return selected ? selected.value : 'letter';
-    }
 
-    function applyInstantType(mode) {
-      if (mode === 'letter') {
-        letterInput.style.display = '';
-        wordWrap.style.display = 'none';
-        typewriterWrap.style.display = 'none';
-      } else if (mode === 'word') {
-        letterInput.style.display = 'none';
-        wordWrap.style.display = '';
-        typewriterWrap.style.display = 'none';
-      } else {
-        letterInput.style.display = 'none';
-        wordWrap.style.display = 'none';
-        typewriterWrap.style.display = '';
-      }
-    }
+def choose_encoding(accept_encoding, available):
+    """The first of `available` (in preference order) that Accept-Encoding allows, or None."""
+    accepted = {}
+    for part in (accept_encoding or '').split(','):
+        coding, _, params = part.strip().partition(';')
+        quality = 1.0
+        if params.strip().startswith('q='):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        if coding:
+            accepted[coding.strip().lower()] = quality
+    for coding in available:
+        if accepted.get(coding, accepted.get('*', 0)) > 0:
+            return coding
+    return None
 
-    ws.onopen = () => {
-      statusEl.textContent = "Connected";
-      statusEl.className = "status connected";
-    };
 
-    ws.onclose = () => {
-      statusEl.textContent = "Disconnected";
-      statusEl.className = "status disconnected";
-    };
+class StaticAsset:
+    """
+    A response built once at startup: the body, its precompressed variants
+    (kept only when smaller), a strong ETag per variant and Cache-Control.
+    """
 
-    ws.onmessage = (event) => {
-      let data;
-      try {
-        data = JSON.parse(event.data);
-      } catch (_) {
-        return;
-      }
+    def __init__(self, body, media_type, cache_control, compressors=()):
+        self.body = body.encode('utf-8') if isinstance(body, str) else body
+        self.media_type = media_type
+        self.cache_control = cache_control
+        self.etag = '"' + hashlib.sha256(self.body).hexdigest()[:24] + '"'
+        self.variants = {}
+        for coding, compress in compressors:
+            data = compress(self.body)
+            if len(data) < len(self.body):
+                self.variants[coding] = data
 
-      const clientEventId = data.clientEventId;
-      if (!clientEventId || !pendingAcks.has(clientEventId)) return;
+    def respond(self, accept_encoding='', if_none_match=''):
+        """Return (status, headers, body) for a GET carrying these request headers."""
+        coding = choose_encoding(accept_encoding, self.variants)
+        etag = self.etag if coding is None else f'{self.etag[:-1]}-{coding}"'
+        headers = {'ETag': etag, 'Cache-Control': self.cache_control, 'Vary': 'Accept-Encoding'}
+        # If-None-Match uses weak comparison, so W/ prefixes are ignored.
+        candidates = {tag.strip().removeprefix('W/') for tag in (if_none_match or '').split(',')}
+        if etag in candidates or '*' in candidates:
+            return 304, headers, b''
+        if coding is not None:
+            headers['Content-Encoding'] = coding
+        return 200, headers, self.variants.get(coding, self.body)
 
-      if (data.kind === 'delivery-ack') {
-        setDeliveryStatus(`Queued #${data.eventId}`);
-        return;
-      }
 
-      if (data.kind === 'execution-ack') {
-        const record = pendingAcks.get(clientEventId);
-        clearTimeout(record.timer);
-        pendingAcks.delete(clientEventId);
+def build_local_assets(service_worker=False):
+    """
+    The local page, its content-hashed stylesheet and script and, when
+    `service_worker` is set, /sw.js, keyed by URL path.
+    """
+    compressors = load_compressors()
 
-        if (data.ok === false) {
-          setDeliveryStatus(`Execution failed #${data.eventId}: ${data.error || 'unknown error'}`, 'error');
-        } else {
-          setDeliveryStatus(`Executed #${data.eventId}`, 'ok');
-        }
-      }
-    };
+    def versioned(source, extension, media_type):
+        url = f"/assets/local.{hashlib.sha256(source.encode('utf-8')).hexdigest()[:12]}.{extension}"
+        return url, StaticAsset(source, media_type, IMMUTABLE_CACHE_CONTROL, compressors)
 
-    function switchTab(tab) {
-      document.querySelectorAll('.mode-section').forEach(el => el.classList.remove('active'));
-      document.querySelectorAll('.tab-btn').forEach(el => el.classList.remove('active'));
-      document.getElementById(`${tab}-mode`).classList.add('active');
-      if (window.event && window.event.target) window.event.target.classList.add('active');
+    style_url, style = versioned(LOCAL_PAGE_STYLE, 'css', 'text/css; charset=utf-8')
+    script_url, script = versioned(LOCAL_PAGE_SCRIPT, 'js', 'text/javascript; charset=utf-8')
+    html = (LOCAL_PAGE_HTML
+            .replace('__LOCAL_STYLE_URL__', style_url)
+            .replace('__LOCAL_SCRIPT_URL__', script_url)
+            .replace('__LOCAL_SERVICE_WORKER__',
+                     '  <meta name="rk-service-worker" content="/sw.js">\n' if service_worker else ''))
+    assets = {
+        '/': StaticAsset(html, 'text/html; charset=utf-8', 'no-cache', compressors),
+        style_url: style,
+        script_url: script
     }
+    if service_worker:
+        worker = (LOCAL_SERVICE_WORKER
+                  .replace('__CACHE_NAME__', f"rk-local-{hashlib.sha256(html.encode('utf-8')).hexdigest()[:12]}")
+                  .replace('__PRECACHE__', json.dumps(['/', style_url, script_url])))
+        assets['/sw.js'] = StaticAsset(worker, 'text/javascript; charset=utf-8', 'no-cache', compressors)
+    return assets
 
-    document.querySelectorAll('input[name="instant-type"]').forEach(radio => {
-      radio.addEventListener('change', (e) => applyInstantType(e.target.value));
-    });
-
-    letterInput.addEventListener('input', () => {
-      const val = letterInput.value;
-      if (!val) return;
-      send('letter', val[val.length - 1]);
-      letterInput.value = '';
-    });
-
-    letterInput.addEventListener('keydown', (e) => {
-      if (e.key === 'Backspace' || e.key === 'Enter') send('letter', e.key);
-    });
-
-    typewriterInput.addEventListener('keydown', (e) => {
-      const rawKey = normalizeKeyName(e.key);
-      const denied = isShortcutDenied(e, rawKey);
 
-      e.preventDefault();
-      if (denied) {
-        setDeliveryStatus(`Blocked shortcut: ${denied}`, 'warn');
-        return;
-      }
+def create_local_app(runtime=None, sender_rate=None, service_worker=None):
+    from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
+    from fastapi.responses import JSONResponse, PlainTextResponse, Response
 
-      const keyToSend = sanitizeToggleEl.checked ? sanitizeLetterKey(rawKey, e) : rawKey;
-      if (!keyToSend) return;
+    # A shared runtime is owned by run_client(); without one the app runs its own.
+    owns_runtime = runtime is None
+    if owns_runtime:
+        if sender_rate is None:
+            sender_rate = float(os.environ.get(LOCAL_SENDER_RATE_ENV) or 0)
+        runtime = InjectionRuntime(sender_rate=sender_rate)
+    sequencer = runtime.sequencer
+    local_event_state = {'next_event_id': 1, 'next_sender_id': 1}
+    if service_worker is None:
+        service_worker = os.environ.get(LOCAL_SERVICE_WORKER_ENV, '') not in ('', '0')
+    assets = build_local_assets(service_worker)
 
-      send('letter', keyToSend);
-      typewriterInput.value = '';
-    });
+    @asynccontextmanager
+    async def lifespan(_app):
+        if owns_runtime:
+            runtime.start()
+        try:
+            yield
+        finally:
+            if owns_runtime:
+                await runtime.stop()
 
-    function sendWordContent() {
-      const val = wordInput.value.trim();
-      if (!val) return;
-      send('word', `${val} `);
-      wordInput.value = '';
-    }
+    app = FastAPI(title="Remote Keyboard Local Mode", lifespan=lifespan)
+    app.state.runtime = runtime
 
-    function manualSendWord() {
-      sendWordContent();
-      wordInput.focus();
-    }
+    @app.get("/health")
+    async def health():
+        return {
+            "ok": True,
+            "mode": "local",
+            "queueDepth": sequencer.qsize(),
+            "senders": sequencer.depths(),
+            "focusOwner": sequencer.focus_owner
+        }
 
-    wordInput.addEventListener('input', () => {
-      if (wordInput.value.endsWith(' ')) sendWordContent();
-    });
+    @app.get("/metrics", response_class=PlainTextResponse)
+    async def metrics_endpoint():
+        return PlainTextResponse(metrics.render_prometheus(), media_type='text/plain; version=0.0.4')
 
-    wordInput.addEventListener('keydown', (e) => {
-      if (e.key === 'Enter') {
-        e.preventDefault();
-        sendWordContent();
-      }
-    });
+    @app.get("/traces")
+    async def traces_endpoint():
+        return JSONResponse(metrics.chrome_trace(), headers={'Content-Disposition': 'inline; filename="rk-traces.json"'})
 
-    function sendBlock() {
-      const box = document.getElementById('button-input');
-      if (!box.value) return;
-      send('block', box.value);
-      box.value = '';
-    }
+    def serve_asset(path, request):
+        asset = assets.get(path)
+        if asset is None:
+            return PlainTextResponse('Not Found', status_code=404)
+        status, headers, body = asset.respond(request.headers.get('accept-encoding', ''),
+                                              request.headers.get('if-none-match', ''))
+        return Response(body, status_code=status, headers=headers,
+                        media_type=asset.media_type if status == 200 else None)
 
-    sanitizeToggleEl.checked = localStorage.getItem('rk_local_sanitize_before_send') !== '0';
-    denyShortcutsToggleEl.checked = localStorage.getItem('rk_local_deny_shortcuts_enabled') !== '0';
-    shortcutDenylistEl.value = localStorage.getItem('rk_local_shortcut_denylist') || DEFAULT_DENYLIST;
+    @app.get("/")
+    async def local_index(request: Request):
+        return serve_asset('/', request)
 
-    sanitizeToggleEl.addEventListener('change', () => {
-      localStorage.setItem('rk_local_sanitize_before_send', sanitizeToggleEl.checked ? '1' : '0');
-    });
+    @app.get("/assets/{name}")
+    async def local_asset(name: str, request: Request):
+        return serve_asset(f'/assets/{name}', request)
 
-    denyShortcutsToggleEl.addEventListener('change', () => {
-      localStorage.setItem('rk_local_deny_shortcuts_enabled', denyShortcutsToggleEl.checked ? '1' : '0');
-    });
+    @app.get("/sw.js")
+    async def local_service_worker(request: Request):
+        return serve_asset('/sw.js', request)
 
-    shortcutDenylistEl.addEventListener('change', () => {
-      localStorage.setItem('rk_local_shortcut_denylist', shortcutDenylistEl.value.trim());
-      refreshDenylist();
-    });
+    json_loads, json_dumps = load_json_codec()
 
-    refreshDenylist();
-    applyInstantType(getInstantType());
+    @app.websocket("/ws")
+    async def websocket_endpoint(websocket: WebSocket):
+        # Pages that offer rk.bin.v1 get binary multi-record frames; anything
+        # else (older pages included) keeps the one-JSON-object-per-message protocol.
+        binary = LOCAL_BINARY_SUBPROTOCOL in websocket.scope.get('subprotocols', [])
+        await websocket.accept(subprotocol=LOCAL_BINARY_SUBPROTOCOL if binary else None)
+        sender = f"sender-{local_event_state['next_sender_id']}"
+        local_event_state['next_sender_id'] += 1
+        sequencer.register(sender)
+        metrics.track_queue(f'local:{sender}', lambda: sequencer.depth(sender))
+        print(f"[+] Local WebSocket sender connected ({sender}).")
+        send_lock = asyncio.Lock()
+        outbox = []
 
-    window.switchTab = switchTab;
-    window.manualSendWord = manualSendWord;
-    window.sendBlock = sendBlock;
-  </script>
-</body>
-</html>"""
+        async def reply(*frames):
+            if not binary:
+                async with send_lock:
+                    for frame in frames:
+                        await websocket.send_text(json_dumps(frame))
+                return
 
-    local_event_state = {'next_event_id': 1}
+            # Acks queued while another send is in flight go out together
+            # in the next frame.
+            outbox.extend(frames)
+            async with send_lock:
+                if outbox:
+                    batch = outbox[:]
+                    outbox.clear()
+                    await websocket.send_bytes(encode_local_acks(batch))
 
-    @app.get("/health")
-    async def health():
-        return {"ok": True, "mode": "local"}
+        # Senders that stamp events with sentAt (or ask with 'clock-sync')
+        # get clock pings, JSON frames in both protocols. The first few come
+        # quickly so their events are traced from the keypress almost at once.
+        clock = ClockOffset()
+        pinger = None
 
-    @app.get("/", response_class=HTMLResponse)
-    async def local_index():
-        return local_page
+        async def ping_clock():
+            try:
+                while True:
+                    async with send_lock:
+                        await websocket.send_text(json_dumps({'kind': 'clock-ping', 't0': wall_ms()}))
+                    await asyncio.sleep(0.5 if len(clock.samples) < 4 else CLOCK_PING_INTERVAL_SECONDS)
+            except Exception:
+                # The connection closed; the receive loop handles that.
+                pass
 
-    @app.websocket("/ws")
-    async def websocket_endpoint(websocket: WebSocket):
-        await websocket.accept()
-        print("[+] Local WebSocket sender connected.")
         try:
             while True:
-                message = await websocket.receive_json()
-                msg_type = message.get('type')
-                payload = message.get('payload')
-                client_event_id = message.get('clientEventId')
+                message = await websocket.receive()
+                if message['type'] == 'websocket.disconnect':
+                    raise WebSocketDisconnect(message.get('code', 1000))
+                if message.get('bytes') is not None:
+                    events = decode_local_events(message['bytes'])
+                else:
+                    decoded = json_loads(message['text'])
+                    events = decoded if isinstance(decoded, list) else [decoded]
 
-                if msg_type is None or payload is None:
+                accepted = []
+                for event in events:
+                    if not isinstance(event, dict):
+                        continue
+                    msg_type = event.get('type')
+                    payload = event.get('payload')
+                    if pinger is None and (msg_type == 'clock-sync' or event.get('sentAt') is not None):
+                        pinger = asyncio.create_task(ping_clock())
+                    if msg_type == 'clock-sync':
+                        continue
+                    if msg_type == 'clock-pong':
+                        if isinstance(event.get('t0'), (int, float)) and isinstance(event.get('t1'), (int, float)):
+                            clock.add(event['t0'], event['t1'])
+                        continue
+                    if msg_type == 'focus-lock':
+                        await reply({'kind': 'focus', 'ok': sequencer.acquire_focus(sender)})
+                        continue
+                    if msg_type == 'focus-release':
+                        sequencer.release_focus(sender)
+                        await reply({'kind': 'focus', 'ok': False})
+                        continue
+                    if msg_type is None or payload is None:
+                        continue
+                    event_id = local_event_state['next_event_id']
+                    local_event_state['next_event_id'] += 1
+                    trace = metrics.start_trace(clock.to_host(event.get('sentAt')), sender=sender, type=msg_type,
+                                                chars=len(payload) if isinstance(payload, str) else 0)
+                    accepted.append((event_id, event.get('clientEventId'), msg_type, payload,
+                                     event.get('mustType'), trace))
+                if not accepted:
                     continue
 
-                event_id = local_event_state['next_event_id']
-                local_event_state['next_event_id'] += 1
-
-                await websocket.send_json({
+                await reply(*({
                     'kind': 'delivery-ack',
                     'eventId': event_id,
                     'clientEventId': client_event_id
-                })
+                } for event_id, client_event_id, _, _, _, _ in accepted))
 
-                try:
-                    handle_keystroke(msg_type, payload)
-                    await websocket.send_json({
-                        'kind': 'execution-ack',
-                        'eventId': event_id,
-                        'clientEventId': client_event_id,
-                        'ok': True
-                    })
-                except Exception as error:
-                    await websocket.send_json({
-                        'kind': 'execution-ack',
-                        'eventId': event_id,
-                        'clientEventId': client_event_id,
-                        'ok': False,
-                        'error': str(error)
-                    })
+                # Backpressure: when this sender's queue is full, stop reading
+                # its frames until the injector catches up. Other senders keep going.
+                for event_id, client_event_id, msg_type, payload, must_type, trace in accepted:
+                    await runtime.submit(sender, msg_type, payload,
+                                         local_execution_ack(reply, event_id, client_event_id, trace), trace,
+                                         on_progress=local_execution_progress(reply, event_id, client_event_id),
+                                         must_type=must_type, version=client_event_id or None)
         except WebSocketDisconnect:
-            print("[-] Local WebSocket sender disconnected.")
+            print(f"[-] Local WebSocket sender disconnected ({sender}).")
         except Exception as error:
             print(f"[!] Local mode message error: {error}")
+        finally:
+            if pinger is not None:
+                pinger.cancel()
+            sequencer.unregister(sender)
+            metrics.untrack_queue(f'local:{sender}')
+
+    return app
+
+
+async def run_local_mode(runtime, host=LOCAL_HOST, port=LOCAL_PORT, service_worker=False, udp_port=None,
+                         on_started=None):
+    """Serve the local page and /ws (and UDP); `on_started()` runs once they accept connections."""
+    import uvicorn
 
+    app = create_local_app(runtime, service_worker=service_worker)
     print("[*] Starting local mode server...")
-    print(f"[*] Open on your phone: http://<your-local-ip>:{LOCAL_PORT}")
+    print(f"[*] Open on your phone: http://<your-local-ip>:{port}")
     print("[*] Local mode endpoint: /ws")
-    uvicorn.run(app, host=LOCAL_HOST, port=LOCAL_PORT)
+    datagrams = None
+    if udp_port:
+        _, datagrams = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: LocalDatagramProtocol(runtime), local_addr=(host, udp_port)
+        )
+        print(f"[*] Local mode UDP endpoint: port {udp_port}")
+    server = uvicorn.Server(uvicorn.Config(app, host=host, port=port))
+    serving = asyncio.ensure_future(server.serve())
+    try:
+        while not server.started and not serving.done():
+            await asyncio.sleep(0.05)
+        if server.started and on_started is not None:
+            on_started()
+        await serving
+    finally:
+        if not serving.done():
+            serving.cancel()
+        if datagrams is not None:
+            datagrams.close()
+    return True
 
 
-def main():
-    print("=== Remote Keyboard Desktop Client ===")
-    mode = input("Mode [internet/local] (default internet): ").strip().lower()
+def write_trace_file(path):
+    try:
+        with open(path, 'w', encoding='utf-8') as trace_file:
+            json.dump(metrics.chrome_trace(), trace_file)
+        print(f"[*] Wrote {len(metrics.traces)} event traces to {path}")
+    except OSError as error:
+        print(f"[!] Could not write traces: {error}")
+
+
+async def run_client(args, cursors=None, on_ready=None, snippets=None):
+    """
+    Serve every sender source the settings ask for (the local server, an
+    internet transport, or both) from one event loop, all feeding one
+    InjectionRuntime. `on_ready()` is called once every source is taking
+    events: the local server is listening and the internet transport has
+    connected (or fallen back to polling).
+    """
+    global injection_runtime
+    injector = None
+    if args.injector == 'process':
+        injector = InjectorProcess.like_controller()
+        if not await injector.start():
+            print("[!] Injecting in this process instead.")
+            injector = None
+    runtime = InjectionRuntime(sender_rate=args.sender_rate or 0, injector=injector)
+    runtime.snippets = snippets
+    injection_runtime = runtime
+    if args.record_events:
+        try:
+            runtime.recorder = EventRecorder(args.record_events)
+            print(f"[*] Recording events to {args.record_events}")
+        except OSError as error:
+            print(f"[!] Event recording disabled: {error}")
+    runtime.start()
+
+    starting = {'local', 'internet'} if args.mode == 'both' else {args.mode}
+
+    def started(source):
+        starting.discard(source)
+        if not starting and on_ready is not None:
+            on_ready()
+
+    sources = []
+    if args.mode in ('local', 'both'):
+        sources.append(run_local_mode(runtime, args.host, args.port, args.service_worker, args.udp_port,
+                                      functools.partial(started, 'local')))
+    if args.mode in ('internet', 'both'):
+        internet_started = functools.partial(started, 'internet')
+        if args.transport == 'websocket':
+            sources.append(run_websocket_client(args.server_url, args.room, cursors, internet_started))
+        elif args.transport == 'auto':
+            sources.append(HybridTransport(runtime, args.server_url, args.room, cursors).run(internet_started))
+        else:
+            sources.append(run_polling_client(runtime, args.server_url, args.room, cursors, internet_started))
+    # Local mode exposes the same numbers at /metrics.
+    reporter = asyncio.create_task(MetricsReporter().run()) if args.mode != 'local' else None
+
+    try:
+        results = await asyncio.gather(*sources)
+    finally:
+        if reporter is not None:
+            reporter.cancel()
+        await socket_resync.stop()
+        await runtime.stop()
+        injection_runtime = None
+        if injector is not None:
+            await injector.stop()
+        if runtime.recorder is not None:
+            runtime.recorder.close()
+        if args.trace_file:
+            write_trace_file(args.trace_file)
+    return all(result is not False for result in results)
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(
+        description="Remote Keyboard desktop client. Options not given here or via RK_* "
+                    "environment variables are prompted for, unless --non-interactive is set."
+    )
+    parser.add_argument('--mode', choices=('internet', 'local', 'both'), default=os.environ.get('RK_MODE'),
+                        help='both serves local senders and an internet room from one process')
+    parser.add_argument('--server-url', default=os.environ.get('RK_SERVER_URL'))
+    parser.add_argument('--room', default=os.environ.get('RK_ROOM_CODE'))
+    parser.add_argument('--transport', choices=('websocket', 'http-polling', 'auto'), default=os.environ.get('RK_TRANSPORT'))
+    parser.add_argument('--backend', default=os.environ.get(INJECTION_BACKEND_ENV),
+                        help='keyboard injection backend (auto, pyautogui, xdotool, uinput, recording)')
+    parser.add_argument('--injector', choices=('thread', 'process'), default=os.environ.get(INJECTOR_ENV) or 'thread',
+                        help='inject keystrokes from a thread of this process or from a separate process')
+    parser.add_argument('--clipboard', default=os.environ.get(CLIPBOARD_ENV),
+                        help='clipboard for pasting large text (auto, system, memory, off)')
+    parser.add_argument('--paste-threshold', type=int,
+                        default=os.environ.get(PASTE_THRESHOLD_ENV) or PASTE_THRESHOLD_CHARS,
+                        help=f'paste text of at least this many characters; 0 always types (default {PASTE_THRESHOLD_CHARS})')
+    parser.add_argument('--host', default=os.environ.get('RK_LOCAL_HOST', LOCAL_HOST))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('RK_LOCAL_PORT', LOCAL_PORT)))
+    parser.add_argument('--udp-port', type=int, default=os.environ.get(LOCAL_UDP_PORT_ENV),
+                        help='also take events from native senders over UDP on this port (local mode)')
+    parser.add_argument('--sender-rate', type=float, default=os.environ.get(LOCAL_SENDER_RATE_ENV),
+                        help='max events/sec injected per sender (default unlimited)')
+    parser.add_argument('--service-worker', action='store_true',
+                        default=os.environ.get(LOCAL_SERVICE_WORKER_ENV, '') not in ('', '0'),
+                        help='let browsers keep the local page offline and reopen it from cache')
+    parser.add_argument('--state-dir', default=os.environ.get(STATE_DIR_ENV),
+                        help=f'where event cursors and snippets are kept (default {DEFAULT_STATE_DIR})')
+    parser.add_argument('--snippet-cache', type=float, default=os.environ.get(SNIPPET_CACHE_ENV) or 0,
+                        help=f'keep up to this many MB of large blocks on disk so senders can repeat them by '
+                             f'digest, e.g. {SNIPPET_CACHE_MB}; off by default, as it stores what was typed')
+    parser.add_argument('--ready-file', default=os.environ.get('RK_READY_FILE'),
+                        help='file to create once the client is ready for keystrokes')
+    parser.add_argument('--record-events', default=os.environ.get('RK_RECORD_EVENTS'),
+                        help='write every received event to this JSON-lines file for benchmarks/replay.py')
+    parser.add_argument('--trace-file', default=os.environ.get(TRACE_FILE_ENV),
+                        help='on exit, write recent per-event traces here as Chrome trace-event JSON')
+    parser.add_argument('--non-interactive', action='store_true',
+                        default=os.environ.get('RK_NON_INTERACTIVE', '') not in ('', '0'),
+                        help='never prompt; fail when a required option is missing')
+    return parser
+
+
+def normalize_mode(mode):
+    mode = (mode or '').strip().lower()
     if mode in ('', 'internet', 'online'):
-        mode = 'internet'
-    elif mode in ('local', 'lan'):
-        mode = 'local'
-    else:
-        print("Unknown mode. Use internet or local.")
+        return 'internet'
+    if mode in ('local', 'lan'):
+        return 'local'
+    if mode == 'both':
+        return 'both'
+    return None
+
+
+def normalize_transport(transport):
+    transport = (transport or '').strip().lower()
+    if transport in ('', 'websocket', 'ws'):
+        return 'websocket'
+    if transport in ('http-polling', 'polling', 'http'):
+        return 'http-polling'
+    if transport in ('auto', 'hybrid'):
+        return 'auto'
+    return None
+
+
+def resolve_settings(args):
+    """
+    Fill in anything missing from the command line by prompting, or with
+    defaults when running non-interactively. Exits on invalid input.
+    """
+    interactive = not args.non_interactive and sys.stdin.isatty()
+
+    def ask(value, prompt):
+        if value is None and interactive:
+            return input(prompt)
+        return value
+
+    mode = normalize_mode(ask(args.mode, "Mode [internet/local/both] (default internet): "))
+    if mode is None:
+        print("Unknown mode. Use internet, local or both.")
+        sys.exit(1)
+    args.mode = mode
+    if mode == 'local':
+        return args
+
+    server_url = (ask(args.server_url, "Enter server URL (e.g., http://localhost:3000): ") or '').strip()
+    args.server_url = normalize_url(server_url or DEFAULT_SERVER_URL)
+
+    args.room = (ask(args.room, "Enter room code to create/join: ") or '').strip()
+    if not args.room:
+        print("Room code is required.")
+        sys.exit(1)
+
+    transport = normalize_transport(ask(args.transport, "Transport [websocket/http-polling/auto] (default websocket): "))
+    if transport is None:
+        print("Unknown transport. Use websocket, http-polling or auto.")
         sys.exit(1)
+    args.transport = transport
+    return args
+
+
+def signal_ready(ready_file=None):
+    """
+    Tell a process supervisor the client can take keystrokes: writes
+    `ready_file` and sends READY=1 to systemd's NOTIFY_SOCKET when set.
+    """
+    if ready_file:
+        with open(ready_file, 'w', encoding='utf-8') as handle:
+            handle.write(f"{os.getpid()}\n")
+
+    notify_socket = os.environ.get('NOTIFY_SOCKET')
+    if notify_socket:
+        address = '\0' + notify_socket[1:] if notify_socket.startswith('@') else notify_socket
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as notifier:
+                notifier.sendto(b'READY=1', address)
+        except OSError as error:
+            print(f"[!] Could not notify supervisor: {error}")
+
+    print("[+] Ready for keystrokes.")
+
+
+def main(argv=None):
+    print("=== Remote Keyboard Desktop Client ===")
+    args = resolve_settings(build_arg_parser().parse_args(argv))
 
     try:
-        if mode == 'local':
-            run_local_mode()
-        else:
-            server_url = input("Enter server URL (e.g., http://localhost:3000): ").strip()
-            if not server_url:
-                server_url = "http://localhost:3000"
-
-            room_code = input("Enter room code to create/join: ").strip()
-            if not room_code:
-                print("Room code is required.")
-                sys.exit(1)
-
-            transport = input("Transport [websocket/http-polling] (default websocket): ").strip().lower()
-            if transport in ('', 'websocket', 'ws'):
-                transport = 'websocket'
-            elif transport in ('http-polling', 'polling', 'http'):
-                transport = 'http-polling'
-            else:
-                print("Unknown transport. Use websocket or http-polling.")
-                sys.exit(1)
+        KeyboardController.use_backend(select_injection_backend(args.backend))
+        KeyboardController.use_clipboard(select_clipboard(args.clipboard), args.paste_threshold)
+        KeyboardController.warm_up()
+    except ValueError as error:
+        print(f"[!] {error}")
+        return 1
+    except Exception as error:
+        print(f"[!] Keyboard backend warm-up failed: {error}")
+        return 1
+    print(f"[*] Keyboard injection backend: {KeyboardController.backend.name}")
+    if KeyboardController.clipboard is not None and KeyboardController.paste_threshold:
+        print(f"[*] Text of {KeyboardController.paste_threshold}+ characters is pasted via the "
+              f"{KeyboardController.clipboard.name} clipboard.")
+    # Signalled by run_client once the injector is up and every source is taking events.
+    on_ready = functools.partial(signal_ready, args.ready_file)
 
-            server_url = normalize_url(server_url)
+    cursors = None
+    if args.mode != 'local':
+        try:
+            cursors = EventCursorStore.open_default(args.state_dir)
+        except OSError as error:
+            print(f"[!] Event cursors will not persist: {error}")
 
-            if transport == 'websocket':
-                run_websocket_client(server_url, room_code)
-            else:
-                run_polling_client(server_url, room_code)
-    except socketio.exceptions.ConnectionError as error:
-        print(f"[!] Connection failed: {error}")
+    snippets = None
+    if args.snippet_cache > 0:
+        try:
+            snippets = SnippetStore.open_default(args.state_dir, int(args.snippet_cache * 1024 * 1024))
+            print(f"[*] Snippet cache holds {len(snippets)} block(s).")
+        except OSError as error:
+            print(f"[!] Snippet cache disabled: {error}")
+
+    try:
+        ok = asyncio.run(run_client(args, cursors, on_ready, snippets))
     except KeyboardInterrupt:
         print("\n[*] Exiting...")
-        if sio.connected:
-            sio.disconnect()
+        return 0
+    finally:
+        if cursors is not None:
+            cursors.close()
+        if snippets is not None:
+            snippets.close()
+    return 0 if ok is not False else 1
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
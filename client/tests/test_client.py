@@ -1,12 +1,29 @@
 import pytest
-from unittest.mock import patch, MagicMock
+from unittest.mock import AsyncMock, patch, MagicMock
 import sys
 import os
+import asyncio
+import json
+import threading
+import time
+import socket
+import subprocess
+import re
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
 
 # Add the parent directory to sys.path to import client
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from client import KeyboardController, on_keystroke
+from fastapi.testclient import TestClient
+
+from client import (
+    AckBatcher, ClipboardError, ClockOffset, DatagramSession, EventCursorStore, EventPoller, EventRecorder, ExecutedEventIndex, HybridTransport, InjectionInterrupted, SenderBacklogFull, InjectionRuntime, InjectorProcess, KeyPlanCompiler, KeyboardController, LocalDatagramProtocol, LocalDatagramSender, LocalSequencer, MemoryClipboard, PipelineMetrics, RecordingBackend, SharedRing, SnippetStore, SocketResync, XdotoolBackend,
+    build_arg_parser, compact_backlog, create_local_app, diff_text, mirror_plan, decode_injector_record, decode_local_acks, decode_local_events, encode_injector_message, encode_local_acks,
+    PASTE_KEYS, PLAN_CACHE_MAX_PAYLOAD, STREAM_CHUNK_CHARS, encode_local_events, execution_status, main, metrics, run_client, on_keystroke, process_polled_events, resolve_settings,
+    select_clipboard, select_injection_backend, snippet_digest
+)
 
 class TestKeyboardController:
     
@@ -30,22 +47,1730 @@ class TestKeyboardController:
         KeyboardController.press_key("Backspace")
         mock_press.assert_called_once_with("backspace")
 
+class TestInjectionBackends:
+
+    def setup_method(self):
+        self.previous_backend = KeyboardController.backend
+
+    def teardown_method(self):
+        KeyboardController.use_backend(self.previous_backend)
+
+    def test_recording_backend_measures_throughput_without_display(self):
+        backend = RecordingBackend()
+        KeyboardController.use_backend(backend)
+
+        KeyboardController.type_text("x" * 5000)
+        KeyboardController.press_key("Enter")
+
+        assert backend.actions == [('write', "x" * 5000), ('press', 'enter')]
+        assert backend.chars == 5001
+        assert backend.chars_per_second() > 0
+
+    def test_recording_backend_honours_pacing(self):
+        backend = RecordingBackend(interval=0.01)
+        started = time.monotonic()
+        backend.write("abcde")
+        assert time.monotonic() - started >= 0.05
+
+    @patch('client.subprocess.run')
+    def test_xdotool_sends_whole_string_in_one_call(self, mock_run):
+        backend = XdotoolBackend(interval=0.005, executable='xdotool')
+        KeyboardController.use_backend(backend)
+
+        KeyboardController.type_text("hello world")
+        KeyboardController.press_key("Backspace")
+
+        assert mock_run.call_args_list[0].args[0] == ['xdotool', 'type', '--delay', '5', '--', 'hello world']
+        assert mock_run.call_args_list[1].args[0] == ['xdotool', 'key', '--delay', '5', '--', 'BackSpace']
+
+    def test_select_by_name_and_interval(self):
+        backend = select_injection_backend('recording', interval=0.02)
+        assert isinstance(backend, RecordingBackend)
+        assert backend.interval == 0.02
+
+    def test_select_unknown_backend_raises(self):
+        with pytest.raises(ValueError):
+            select_injection_backend('carrier-pigeon')
+
+    @patch('client.UinputBackend.is_available', return_value=False)
+    @patch('client.PyAutoGuiBackend.is_available', return_value=False)
+    @patch('client.XdotoolBackend.is_available', return_value=True)
+    def test_auto_prefers_xdotool_on_x11(self, *_):
+        with patch.dict(os.environ, {'XDG_SESSION_TYPE': 'x11'}):
+            assert isinstance(select_injection_backend('auto', interval=0), XdotoolBackend)
+
+    @patch('client.UinputBackend.is_available', return_value=False)
+    @patch('client.PyAutoGuiBackend.is_available', return_value=False)
+    @patch('client.XdotoolBackend.is_available', return_value=False)
+    def test_auto_falls_back_to_recording(self, *_):
+        assert isinstance(select_injection_backend('auto', interval=0), RecordingBackend)
+
+class TestKeyPlanCompiler:
+
+    def test_text_splits_into_runs_and_named_keys(self):
+        compiler = KeyPlanCompiler(lambda key: True)
+        assert compiler.compile('block', 'one\r\ntwo\tthree\x00') == (
+            ('write', 'one'), ('press', 'enter'), ('write', 'two'), ('press', 'tab'), ('write', 'three')
+        )
+
+    def test_letters_compile_to_presses_and_hotkeys(self):
+        compiler = KeyPlanCompiler(lambda key: key in ('enter', 'delete', 'ctrl', 'shift', 't', '+'))
+        assert compiler.compile('letter', 'a') == (('write', 'a'),)
+        assert compiler.compile('letter', 'Enter') == (('press', 'enter'),)
+        assert compiler.compile('letter', 'Delete') == (('press', 'delete'),)
+        assert compiler.compile('letter', 'Ctrl+Shift+T') == (('hotkey', ('ctrl', 'shift', 't')),)
+        assert compiler.compile('letter', 'Control++') == (('hotkey', ('ctrl', '+')),)
+        assert compiler.compile('letter', 'Hyper+T') == ()
+
+    def test_repeated_payloads_hit_the_cache(self):
+        compiler = KeyPlanCompiler(lambda key: True)
+        for _ in range(3):
+            compiler.compile('letter', 'Backspace')
+        compiler.compile('block', 'x' * (PLAN_CACHE_MAX_PAYLOAD + 1))
+        info = compiler.cache_info()
+        assert (info.hits, info.misses, info.currsize) == (2, 1, 1)
+
+    def test_controller_replays_plans_on_the_backend(self):
+        previous_backend = KeyboardController.backend
+        backend = RecordingBackend()
+        KeyboardController.use_backend(backend)
+        try:
+            KeyboardController.press_key('Ctrl+C')
+            KeyboardController.type_text('hi\n')
+        finally:
+            KeyboardController.use_backend(previous_backend)
+        assert backend.actions == [('hotkey', ('ctrl', 'c')), ('write', 'hi'), ('press', 'enter')]
+
+class TestClipboardPaste:
+
+    def setup_method(self):
+        self.previous = (KeyboardController.backend, KeyboardController.clipboard, KeyboardController.paste_threshold)
+        self.backend = RecordingBackend()
+        KeyboardController.use_backend(self.backend)
+        KeyboardController.paste_settle = 0
+
+    def teardown_method(self):
+        backend, clipboard, threshold = self.previous
+        KeyboardController.use_backend(backend)
+        KeyboardController.use_clipboard(clipboard, threshold)
+        del KeyboardController.paste_settle
+
+    @staticmethod
+    def run_block(text, must_type=False):
+        async def scenario():
+            runtime = InjectionRuntime()
+            runtime.start()
+            await runtime.submit('test', 'block', text, lambda error: None, must_type=must_type)
+            await runtime.drain()
+            await runtime.stop()
+
+        asyncio.run(scenario())
+
+    def test_large_block_is_pasted_and_clipboard_restored(self):
+        clipboard = MemoryClipboard('previous')
+        KeyboardController.use_clipboard(clipboard, threshold=100)
+        pasted = metrics.text_paths['paste']
+
+        self.run_block('x' * 150)
+
+        assert self.backend.actions == [('hotkey', PASTE_KEYS)]
+        assert clipboard.history == ['x' * 150, 'previous']
+        assert clipboard.text == 'previous'
+        assert metrics.text_paths['paste'] == pasted + 1
+
+    def test_short_and_must_type_text_is_typed(self):
+        clipboard = MemoryClipboard()
+        KeyboardController.use_clipboard(clipboard, threshold=100)
+        typed = metrics.text_paths['type']
+
+        self.run_block('short')
+        self.run_block('y' * 150, must_type=True)
+
+        assert self.backend.typed_text == 'short' + 'y' * 150
+        assert clipboard.history == []
+        assert metrics.text_paths['type'] == typed + 1
+
+    def test_batched_and_compacted_keystrokes_are_never_pasted(self):
+        clipboard = MemoryClipboard()
+        KeyboardController.use_clipboard(clipboard, threshold=20)
+        letters = [{'id': index + 1, 'type': 'letter', 'payload': 'k'} for index in range(30)]
+        words = [{'type': 'word', 'payload': 'w' * 40}, {'type': 'word', 'payload': 'v' * 40}]
+
+        async def scenario():
+            runtime = InjectionRuntime()
+            runtime.start()
+            for letter in 'abcdefghijklmnopqrstuvwxyz':
+                await runtime.submit('phone', 'letter', letter, wait=False)
+            await runtime.drain()
+            with patch('client.executed_events', ExecutedEventIndex()):
+                await process_polled_events(runtime, letters + words)
+            await runtime.drain()
+            await runtime.stop()
+
+        asyncio.run(scenario())
+        assert self.backend.typed_text == 'abcdefghijklmnopqrstuvwxyz' + 'k' * 30 + 'w' * 40 + 'v' * 40
+        assert clipboard.history == []
+
+    def test_broken_clipboard_falls_back_to_typing(self):
+        KeyboardController.use_clipboard(MemoryClipboard(broken=True), threshold=100)
+        fallbacks = metrics.text_paths['paste_fallback']
+
+        self.run_block('z' * 150)
+
+        assert self.backend.typed_text == 'z' * 150
+        assert not any(action == 'hotkey' for action, _ in self.backend.actions)
+        assert metrics.text_paths['paste_fallback'] == fallbacks + 1
+
+    def test_clipboard_failing_on_restore_still_pastes(self):
+        clipboard = MemoryClipboard('previous')
+        clipboard.set = MagicMock(side_effect=[None, ClipboardError('gone')])
+        KeyboardController.use_clipboard(clipboard, threshold=10)
+
+        KeyboardController.type_text('p' * 20)
+
+        assert self.backend.actions == [('hotkey', PASTE_KEYS)]
+        assert clipboard.set.call_count == 2
+
+    def test_select_clipboard(self):
+        assert select_clipboard('off') is None
+        assert isinstance(select_clipboard('memory'), MemoryClipboard)
+        with pytest.raises(ValueError):
+            select_clipboard('carrier-pigeon')
+
 class TestSocketEvents:
     
     @patch('client.KeyboardController.press_key')
     def test_on_keystroke_letter(self, mock_press_key):
         data = {'type': 'letter', 'payload': 'x'}
-        on_keystroke(data)
+        asyncio.run(on_keystroke(data))
         mock_press_key.assert_called_once_with('x')
 
     @patch('client.KeyboardController.type_text')
     def test_on_keystroke_word(self, mock_type_text):
         data = {'type': 'word', 'payload': 'hello '}
-        on_keystroke(data)
+        asyncio.run(on_keystroke(data))
         mock_type_text.assert_called_once_with('hello ')
 
     @patch('client.KeyboardController.type_text')
     def test_on_keystroke_block(self, mock_type_text):
         data = {'type': 'block', 'payload': 'This is a full sentence.'}
-        on_keystroke(data)
+        asyncio.run(on_keystroke(data))
         mock_type_text.assert_called_once_with('This is a full sentence.')
+
+class TestInjectionRuntime:
+
+    @staticmethod
+    def run_events(events, acks, sender='test'):
+        async def scenario():
+            runtime = InjectionRuntime()
+            runtime.start()
+            for event_id, (msg_type, payload) in enumerate(events, start=1):
+                await runtime.submit(sender, msg_type, payload,
+                                     lambda error, event_id=event_id: acks.append((event_id, error)))
+            await runtime.drain()
+            await runtime.stop()
+
+        asyncio.run(scenario())
+
+    @patch('client.KeyboardController.press_key')
+    @patch('client.KeyboardController.type_text')
+    def test_merges_text_and_keeps_order_around_special_keys(self, mock_type_text, mock_press_key):
+        calls = []
+        mock_type_text.side_effect = lambda text: calls.append(('type', text))
+        mock_press_key.side_effect = lambda key: calls.append(('press', key))
+        acks = []
+        self.run_events([
+            ('letter', 'a'), ('letter', 'b'), ('letter', 'Enter'),
+            ('letter', 'c'), ('word', 'de '), ('block', 'fg')
+        ], acks)
+
+        assert calls == [('type', 'ab'), ('press', 'Enter'), ('type', 'cde fg')]
+        assert acks == [(1, None), (2, None), (3, None), (4, None), (5, None), (6, None)]
+
+    @patch('client.KeyboardController.press_key')
+    @patch('client.KeyboardController.type_text')
+    def test_long_text_after_a_letter_is_streamed_not_merged(self, mock_type_text, mock_press_key):
+        progress = []
+
+        async def scenario():
+            runtime = InjectionRuntime()
+            runtime.start()
+            await runtime.submit('test', 'letter', 'a', lambda error: None)
+            await runtime.submit('test', 'block', 'x' * 150, lambda error: None,
+                                 on_progress=lambda typed, total: progress.append(typed))
+            await runtime.drain()
+            await runtime.stop()
+
+        asyncio.run(scenario())
+        mock_press_key.assert_called_once_with('a')
+        assert [call.args[0] for call in mock_type_text.call_args_list] == ['x' * 64, 'x' * 64, 'x' * 22]
+        assert progress == [64, 128]
+
+    @patch('client.KeyboardController.type_text', side_effect=RuntimeError('boom'))
+    def test_failed_batch_acks_every_event(self, mock_type_text):
+        acks = []
+        self.run_events([('letter', 'x'), ('letter', 'y')], acks)
+
+        assert [event_id for event_id, _ in acks] == [1, 2]
+        assert all(isinstance(error, RuntimeError) for _, error in acks)
+
+    @patch('client.KeyboardController.press_key')
+    @patch('client.KeyboardController.type_text')
+    def test_recorder_writes_submitted_events_as_json_lines(self, mock_type_text, mock_press_key, tmp_path):
+        path = tmp_path / 'sessions' / 'session.jsonl'
+
+        async def scenario():
+            runtime = InjectionRuntime()
+            runtime.recorder = EventRecorder(str(path))
+            runtime.start()
+            await runtime.submit('phone', 'letter', 'a', lambda error: None)
+            await runtime.submit('phone', 'letter', 'Enter', lambda error: None)
+            await runtime.drain()
+            await runtime.stop()
+            runtime.recorder.close()
+            return runtime.recorder.count
+
+        assert asyncio.run(scenario()) == 2
+        records = [json.loads(line) for line in path.read_text().splitlines()]
+        assert [(r['sender'], r['type'], r['payload']) for r in records] == [('phone', 'letter', 'a'), ('phone', 'letter', 'Enter')]
+        assert 0 <= records[0]['t'] <= records[1]['t']
+
+    @staticmethod
+    def edit_field(text, caret, plan):
+        """Apply a mirror plan to a simulated text field."""
+        for action, value in plan:
+            if action == 'write':
+                text, caret = text[:caret] + value + text[caret:], caret + len(value)
+            elif value in ('left', 'right'):
+                caret += 1 if value == 'right' else -1
+            elif value == 'backspace':
+                text, caret = text[:caret - 1] + text[caret:], caret - 1
+            elif value == 'delete':
+                text = text[:caret] + text[caret + 1:]
+            elif value == 'enter':
+                text, caret = text[:caret] + '\n' + text[caret:], caret + 1
+        return text, caret
+
+    def test_mirror_diff_is_minimal_and_reaches_the_new_text(self):
+        assert diff_text('the quick fox', 'the quick brown fox') == [(10, 0, 'brown ')]
+        assert diff_text('kitten', 'sitting') == [(0, 1, 's'), (4, 1, 'i'), (6, 0, 'g')]
+        assert diff_text('same', 'same') == []
+
+        for old, new, caret in [('hello world', 'hello, world!', 11), ('abc\ndef', 'abXc\ndf', 0), ('', 'new', 0),
+                                ('remove me', '', 4)]:
+            plan, end = mirror_plan(old, new, caret)
+            assert self.edit_field(old, caret, plan) == (new, end)
+
+        plan, _ = mirror_plan('one two three', 'one two thre', 13)
+        assert plan == (('press', 'backspace'),)
+
+    def test_mirror_drops_stale_snapshots_and_types_only_the_latest(self):
+        field = {'text': 'hello world', 'caret': 11}
+        plans = []
+        acks = []
+
+        def run_plan(plan):
+            plans.append(plan)
+            field['text'], field['caret'] = self.edit_field(field['text'], field['caret'], plan)
+
+        async def scenario():
+            runtime = InjectionRuntime()
+            runtime.start()
+            for version, msg_type, text in [(1, 'mirror-base', 'hello world'), (2, 'mirror', 'hello there world'),
+                                            (4, 'mirror', 'hello, world!'), (3, 'mirror', 'hello brave world')]:
+                await runtime.submit('phone', msg_type, text, lambda error, v=version: acks.append((v, error)),
+                                     version=version)
+            await runtime.drain()
+            await runtime.stop()
+            return runtime.mirrors.text('phone')
+
+        with patch('client.KeyboardController.run_plan', side_effect=run_plan):
+            assert asyncio.run(scenario()) == 'hello, world!'
+
+        assert len(plans) == 1
+        assert field['text'] == 'hello, world!'
+        assert sorted(acks) == [(1, None), (2, None), (3, None), (4, None)]
+
+    def test_mirror_versions_start_over_when_the_server_epoch_changes(self):
+        field = {'text': '', 'caret': 0}
+
+        def run_plan(plan):
+            field['text'], field['caret'] = self.edit_field(field['text'], field['caret'], plan)
+
+        async def scenario():
+            runtime = InjectionRuntime()
+            runtime.start()
+            for epoch, version, msg_type, text in [('e1', 40, 'mirror-base', 'draft'), ('e1', 41, 'mirror', 'draft one'),
+                                                   ('e2', 1, 'mirror', 'draft two'), ('e2', 2, 'mirror', 'draft 2')]:
+                await runtime.submit('internet', msg_type, text, version=version, epoch=epoch)
+                await runtime.drain()
+            await runtime.stop()
+            return runtime.mirrors.text('internet')
+
+        field['text'], field['caret'] = 'draft', 5
+        with patch('client.KeyboardController.run_plan', side_effect=run_plan):
+            assert asyncio.run(scenario()) == 'draft 2'
+        assert field['text'] == 'draft 2'
+
+    @patch('client.KeyboardController.type_text')
+    def test_large_block_streams_in_chunks_with_progress(self, mock_type_text):
+        progress = []
+        acks = []
+
+        async def scenario():
+            runtime = InjectionRuntime()
+            runtime.start()
+            await runtime.submit('test', 'block', 'x' * 150, acks.append,
+                                 on_progress=lambda typed, total: progress.append((typed, total)))
+            await runtime.drain()
+            await runtime.stop()
+
+        asyncio.run(scenario())
+        assert [len(call.args[0]) for call in mock_type_text.call_args_list] == [64, 64, 22]
+        assert progress == [(64, 150), (128, 150)]
+        assert acks == [None]
+
+    def test_escape_interrupts_a_streaming_block(self):
+        typed = []
+        acks = {}
+
+        async def scenario():
+            runtime = InjectionRuntime()
+            runtime.start()
+
+            async def escape_after_first_chunk(done, total):
+                if done == STREAM_CHUNK_CHARS:
+                    await runtime.submit('test', 'letter', 'Escape', lambda error: acks.setdefault('escape', error))
+
+            await runtime.submit('test', 'block', 'y' * 300, lambda error: acks.setdefault('block', error),
+                                 on_progress=escape_after_first_chunk)
+            await runtime.drain()
+            await runtime.stop()
+
+        with patch('client.KeyboardController.type_text', side_effect=lambda text: typed.append(text)), \
+                patch('client.KeyboardController.press_key', side_effect=lambda key: typed.append(key)):
+            asyncio.run(scenario())
+
+        assert typed == ['y' * 64, 'Escape']
+        assert acks['escape'] is None
+        assert isinstance(acks['block'], InjectionInterrupted)
+        assert execution_status(acks['block']) == {
+            'ok': False, 'error': 'cancelled after 64 of 300 characters', 'typed': 64, 'total': 300, 'cancelled': True
+        }
+
+    @patch('client.KeyboardController.press_key')
+    @patch('client.KeyboardController.type_text')
+    def test_escape_keeps_its_order_when_nothing_of_its_sender_streams(self, mock_type_text, mock_press_key):
+        calls = []
+        mock_type_text.side_effect = lambda text: calls.append(('type', text))
+        mock_press_key.side_effect = lambda key: calls.append(('press', key))
+        acks = []
+        self.run_events([('letter', 'a'), ('letter', 'b'), ('letter', 'c'), ('letter', 'Escape')], acks)
+
+        assert calls == [('type', 'abc'), ('press', 'Escape')]
+        assert [event_id for event_id, _ in acks] == [1, 2, 3, 4]
+
+    @patch('client.sio')
+    @patch('client.KeyboardController.press_key')
+    @patch('client.KeyboardController.type_text')
+    def test_dropped_socket_event_is_fetched_again_in_order(self, mock_type_text, mock_press_key, mock_sio, tmp_path):
+        typed = []
+        mock_type_text.side_effect = typed.append
+        mock_press_key.side_effect = typed.append
+        store = EventCursorStore(str(tmp_path / 'cursors.log'))
+        mock_sio.server_url, mock_sio.room_code, mock_sio.cursors, mock_sio.failover = 'http://server', 'room', store, None
+        mock_sio.emit = AsyncMock()
+        events = [{'id': event_id, 'type': 'letter', 'payload': letter, 'epoch': 'e1'}
+                  for event_id, letter in enumerate('xyzw', 1)]
+        polls = []
+        resync = SocketResync()
+
+        async def fetch(session, server_url, room_code, since_id, wait_seconds=0):
+            polls.append(since_id)
+            fresh = [event for event in events if event['id'] > since_id]
+            return {'epoch': 'e1', 'events': fresh, 'nextSince': fresh[-1]['id'] if fresh else since_id}
+
+        def socket_event(event):
+            return {'type': 'letter', 'payload': event['payload'], 'roomCode': 'room', 'eventId': event['id'],
+                    'epoch': 'e1'}
+
+        async def scenario():
+            runtime = InjectionRuntime(max_unpaused=2)
+            runtime.start()
+            with patch('client.injection_runtime', runtime):
+                for event in events:
+                    await on_keystroke(socket_event(event))
+                await asyncio.wait_for(resync._task, 5)
+                await on_keystroke(socket_event(events[3]))
+                await runtime.drain()
+            await runtime.stop()
+
+        with patch('client.executed_events', ExecutedEventIndex()), patch('client.fetch_events', fetch), \
+                patch('client.socket_resync', resync), patch('client.ack_batcher', AckBatcher(mock_sio.emit)):
+            asyncio.run(scenario())
+        assert ''.join(typed) == 'xyzw'
+        assert polls[0] == 2
+        assert store.get('http://server', 'room') == ('e1', 4)
+
+    @patch('client.KeyboardController.type_text')
+    def test_cancel_jumps_the_queue_and_drops_queued_text(self, mock_type_text):
+        acks = []
+
+        async def scenario():
+            runtime = InjectionRuntime()
+            runtime.start()
+            await runtime.submit('test', 'word', 'one ', lambda error: acks.append(('one', error)))
+            await runtime.submit('test', 'word', 'two ', lambda error: acks.append(('two', error)))
+            await runtime.submit('test', 'cancel', 'stop', lambda error: acks.append(('cancel', error)))
+            await runtime.drain()
+            await runtime.stop()
+
+        asyncio.run(scenario())
+        mock_type_text.assert_not_called()
+        assert [name for name, _ in acks] == ['one', 'two', 'cancel']
+        assert execution_status(acks[1][1])['typed'] == 0
+        assert acks[2][1] is None
+
+    @patch('client.sio')
+    @patch('client.KeyboardController.press_key')
+    def test_on_keystroke_sends_execution_ack(self, mock_press_key, mock_sio):
+        mock_sio.emit = AsyncMock()
+        asyncio.run(on_keystroke({'type': 'letter', 'payload': 'q', 'roomCode': '1234', 'eventId': 7, 'clientEventId': 3}))
+        mock_sio.emit.assert_awaited_once_with('execution-ack', {
+            'roomCode': '1234', 'eventId': 7, 'clientEventId': 3, 'ok': True
+        })
+
+
+class StubSocketServer:
+    """
+    Local Socket.IO stand-in for the Node server that records what receivers emit.
+    """
+
+    def __init__(self, features=None):
+        import socketio
+        import uvicorn
+
+        self.received = []
+        self.sio = socketio.AsyncServer(async_mode='asgi')
+        stub = self
+
+        @self.sio.event
+        async def connect(sid, environ):
+            if features is not None:
+                await stub.sio.emit('server-features', features, to=sid)
+
+        @self.sio.on('*')
+        async def record(event, sid, data):
+            stub.received.append((event, data))
+
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.url = f"http://127.0.0.1:{sock.getsockname()[1]}"
+        self.server = uvicorn.Server(uvicorn.Config(socketio.ASGIApp(self.sio), log_level='error'))
+        self.thread = threading.Thread(target=self.server.run, kwargs={'sockets': [sock]}, daemon=True)
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+
+    def wait_for(self, predicate, timeout=5):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if predicate(self.received):
+                return True
+            time.sleep(0.01)
+        return False
+
+    def close(self):
+        self.server.should_exit = True
+        self.thread.join(5)
+
+
+class TestInjectorProcess:
+
+    def test_shared_ring_wraps_and_reports_full(self):
+        ring = SharedRing(slots=4, record_size=32)
+        reader = SharedRing(ring.name, slots=4, record_size=32)
+        try:
+            for round_ in range(3):
+                records = [encode_injector_message(i, 1, data=f'{round_}-{i}'.encode())[0] for i in range(4)]
+                assert all(ring.put(record) for record in records)
+                assert not ring.put(records[0])
+                got = [decode_injector_record(reader.get()) for _ in range(4)]
+                assert [data for _, _, _, _, data in got] == [f'{round_}-{i}'.encode() for i in range(4)]
+                assert reader.get() is None
+        finally:
+            reader.close()
+            ring.close()
+
+    def test_shared_ring_waits_for_records_that_have_not_landed(self):
+        ring = SharedRing(slots=4, record_size=32)
+        reader = SharedRing(ring.name, slots=4, record_size=32)
+        try:
+            record = encode_injector_message(1, 1, data=b'first')[0]
+            assert ring.put(record)
+            # Head published before the slot is written, as a weakly ordered CPU may show it.
+            SharedRing.COUNTERS.pack_into(ring._shm.buf, 0, 2, 0)
+            assert decode_injector_record(reader.get())[4] == b'first'
+            assert reader.get() is None and len(reader) == 1
+            # Stamp visible but the record bytes still stale.
+            offset = SharedRing.DATA_OFFSET + ring.slot_size
+            SharedRing.STAMP.pack_into(ring._shm.buf, offset, 2, zlib.crc32(record.ljust(32, b'\0')))
+            assert reader.get() is None and len(reader) == 1
+        finally:
+            reader.close()
+            ring.close()
+
+    def test_long_messages_span_several_records(self):
+        text = 'é' * 300
+        records = encode_injector_message(7, 1, data=text.encode('utf-8'), flags=1, record_size=64)
+        decoded = [decode_injector_record(record) for record in records]
+        assert len(records) == 12
+        assert all(flags == 3 for _, _, flags, _, _ in decoded[:-1]) and decoded[-1][2] == 1
+        assert b''.join(data for *_, data in decoded).decode('utf-8') == text
+
+    def test_injects_in_another_process_and_restarts_after_a_crash(self):
+        acks = []
+
+        async def scenario():
+            injector = InjectorProcess(backend='recording', clipboard='memory', paste_threshold=100)
+            assert await injector.start()
+            runtime = InjectionRuntime(injector=injector)
+            runtime.start()
+            try:
+                await runtime.submit('test', 'letter', 'Enter', acks.append)
+                await runtime.submit('test', 'block', 'x' * 150, acks.append)
+                await runtime.drain()
+                first_pid = injector.process.pid
+                injector.process.kill()
+                await asyncio.to_thread(injector.process.join)
+                await runtime.submit('test', 'word', 'again ', acks.append)
+                await runtime.drain()
+                return first_pid, injector.process.pid, injector.restarts
+            finally:
+                await runtime.stop()
+                await injector.stop()
+
+        pasted = metrics.text_paths['paste']
+        first_pid, second_pid, restarts = asyncio.run(scenario())
+        assert acks == [None, None, None]
+        assert metrics.text_paths['paste'] == pasted + 1
+        assert first_pid != second_pid and first_pid != os.getpid()
+        assert restarts == 1
+
+class TestAckBatcher:
+
+    def run_acks(self, features, count=5):
+        import socketio
+
+        stub = StubSocketServer(features)
+
+        async def scenario():
+            receiver = socketio.AsyncClient()
+            batcher = AckBatcher(receiver.emit, window=0.05)
+            receiver.on('server-features', batcher.configure)
+            try:
+                await receiver.connect(stub.url)
+                if features is not None:
+                    deadline = time.monotonic() + 5
+                    while not batcher.enabled and time.monotonic() < deadline:
+                        await asyncio.sleep(0.01)
+                for event_id in range(1, count + 1):
+                    await batcher.add({'roomCode': '1234', 'eventId': event_id, 'clientEventId': event_id, 'ok': True})
+                await asyncio.to_thread(stub.wait_for, lambda received: sum(
+                    len(data['acks']) if event == 'execution-ack-batch' else 1 for event, data in received
+                ) >= count)
+            finally:
+                await receiver.disconnect()
+
+        try:
+            asyncio.run(scenario())
+            return list(stub.received)
+        finally:
+            stub.close()
+
+    def test_acks_are_batched_when_server_supports_it(self):
+        received = self.run_acks({'executionAckBatch': True})
+        assert [event for event, _ in received] == ['execution-ack-batch']
+        assert received[0][1]['roomCode'] == '1234'
+        assert [ack['eventId'] for ack in received[0][1]['acks']] == [1, 2, 3, 4, 5]
+        assert 'roomCode' not in received[0][1]['acks'][0]
+
+    def test_falls_back_to_per_event_acks(self):
+        received = self.run_acks(None)
+        assert [event for event, _ in received] == ['execution-ack'] * 5
+        assert [data['eventId'] for _, data in received] == [1, 2, 3, 4, 5]
+
+    def test_full_batch_is_sent_without_waiting_for_the_window(self):
+        sent = []
+
+        async def send(event, data):
+            sent.append((event, data))
+
+        async def scenario():
+            batcher = AckBatcher(send, window=60, max_batch=3)
+            await batcher.configure({'executionAckBatch': True})
+            for event_id in range(1, 5):
+                await batcher.add({'roomCode': 'r', 'eventId': event_id, 'clientEventId': None, 'ok': True})
+
+            assert [[ack['eventId'] for ack in data['acks']] for _, data in sent] == [[1, 2, 3]]
+            assert batcher.pending() == 1
+            batcher.reset()
+            assert batcher.pending() == 0
+
+        asyncio.run(scenario())
+
+
+class TestLocalMode:
+
+    def test_receive_loop_and_health_stay_responsive_while_injecting(self):
+        release = threading.Event()
+        typed = []
+
+        def slow_handle_keystroke(msg_type, payload):
+            release.wait(5)
+            typed.append(payload)
+
+        with patch('client.handle_keystroke', side_effect=slow_handle_keystroke):
+            with TestClient(create_local_app()) as test_client:
+                with test_client.websocket_connect('/ws') as ws:
+                    ws.send_json({'type': 'block', 'payload': 'long text', 'clientEventId': 1})
+                    ws.send_json({'type': 'letter', 'payload': 'a', 'clientEventId': 2})
+
+                    assert ws.receive_json()['kind'] == 'delivery-ack'
+                    assert ws.receive_json()['kind'] == 'delivery-ack'
+                    assert test_client.get('/health').json()['ok'] is True
+
+                    release.set()
+                    first = ws.receive_json()
+                    second = ws.receive_json()
+
+        assert typed == ['long text', 'a']
+        assert (first['kind'], first['clientEventId'], first['ok']) == ('execution-ack', 1, True)
+        assert (second['kind'], second['clientEventId'], second['ok']) == ('execution-ack', 2, True)
+
+    @patch('client.handle_keystroke', side_effect=RuntimeError('no display'))
+    def test_execution_failure_is_acked(self, mock_handle_keystroke):
+        with TestClient(create_local_app()) as test_client:
+            with test_client.websocket_connect('/ws') as ws:
+                ws.send_json({'type': 'letter', 'payload': 'a', 'clientEventId': 9})
+                assert ws.receive_json()['kind'] == 'delivery-ack'
+                ack = ws.receive_json()
+
+        assert ack['ok'] is False
+        assert ack['error'] == 'no display'
+
+    def test_binary_codec_round_trip(self):
+        events = [
+            {'type': 'letter', 'payload': 'é', 'clientEventId': 1, 'sentAt': 1700000000123.25},
+            {'type': 'block', 'payload': 'x' * 70000, 'clientEventId': 2, 'mustType': True}
+        ]
+        assert decode_local_events(encode_local_events(events)) == events
+
+        acks = [
+            {'kind': 'delivery-ack', 'eventId': 4, 'clientEventId': 1, 'ok': True},
+            {'kind': 'execution-ack', 'eventId': 4, 'clientEventId': 1, 'ok': False, 'error': 'no display'},
+            {'kind': 'progress', 'eventId': 5, 'clientEventId': 2, 'ok': True, 'typed': 64, 'total': 300},
+            {'kind': 'execution-ack', 'eventId': 5, 'clientEventId': 2, 'ok': False, 'typed': 64, 'total': 300,
+             'cancelled': True, 'error': 'cancelled after 64 of 300 characters'},
+            {'kind': 'execution-ack', 'eventId': 6, 'clientEventId': 3, 'ok': True, 'snippet': 'ab' * 16},
+            {'kind': 'execution-ack', 'eventId': 7, 'clientEventId': 4, 'ok': False, 'snippetMiss': True,
+             'error': 'unknown snippet ' + 'cd' * 16}
+        ]
+        assert decode_local_acks(encode_local_acks(acks)) == acks
+
+    @patch('client.KeyboardController.type_text')
+    def test_binary_frames_carry_several_events(self, mock_type_text):
+        events = [{'type': 'letter', 'payload': c, 'clientEventId': i} for i, c in enumerate('abc', start=1)]
+        with TestClient(create_local_app()) as test_client:
+            with test_client.websocket_connect('/ws', subprotocols=['rk.bin.v1']) as ws:
+                assert ws.accepted_subprotocol == 'rk.bin.v1'
+                ws.send_bytes(encode_local_events(events))
+                deliveries = decode_local_acks(ws.receive_bytes())
+                executed = []
+                while len(executed) < 3:
+                    executed.extend(decode_local_acks(ws.receive_bytes()))
+
+        assert [(a['kind'], a['clientEventId']) for a in deliveries] == [('delivery-ack', i) for i in (1, 2, 3)]
+        assert [(a['kind'], a['clientEventId'], a['ok']) for a in executed] == [
+            ('execution-ack', i, True) for i in (1, 2, 3)
+        ]
+        assert ''.join(call.args[0] for call in mock_type_text.call_args_list) == 'abc'
+
+    def test_truncated_binary_frame_keeps_the_connection(self):
+        stamped = encode_local_events([{'type': 'letter', 'payload': 'z', 'clientEventId': 3, 'sentAt': 1.0}])
+        # Header plus half of the sentAt field.
+        truncated = encode_local_events([{'type': 'letter', 'payload': 'b', 'clientEventId': 2}]) + stamped[:13]
+        assert decode_local_events(truncated) == [{'type': 'letter', 'payload': 'b', 'clientEventId': 2}]
+
+        typed = []
+        with patch('client.KeyboardController.type_text', side_effect=typed.append), \
+                patch('client.KeyboardController.press_key', side_effect=typed.append), \
+                TestClient(create_local_app()) as test_client:
+            with test_client.websocket_connect('/ws', subprotocols=['rk.bin.v1']) as ws:
+                ws.send_bytes(truncated)
+                ws.send_bytes(encode_local_events([{'type': 'letter', 'payload': 'c', 'clientEventId': 4}]))
+                acks = []
+                while sum(ack['kind'] == 'execution-ack' for ack in acks) < 2:
+                    acks.extend(decode_local_acks(ws.receive_bytes()))
+
+        assert [ack['clientEventId'] for ack in acks if ack['kind'] == 'execution-ack'] == [2, 4]
+        assert ''.join(typed) == 'bc'
+
+    @patch('client.handle_keystroke')
+    def test_json_frame_may_hold_a_list_of_events(self, mock_handle_keystroke):
+        with TestClient(create_local_app()) as test_client:
+            with test_client.websocket_connect('/ws') as ws:
+                ws.send_json([
+                    {'type': 'word', 'payload': 'hi ', 'clientEventId': 1},
+                    {'type': 'letter', 'payload': 'x', 'clientEventId': 2}
+                ])
+                frames = [ws.receive_json() for _ in range(4)]
+
+        assert [f['kind'] for f in frames[:2]] == ['delivery-ack', 'delivery-ack']
+        assert [f['clientEventId'] for f in frames[2:]] == [1, 2]
+
+    def test_page_is_precompressed_and_revalidated_by_etag(self):
+        with TestClient(create_local_app()) as test_client:
+            page = test_client.get('/', headers={'Accept-Encoding': 'gzip'})
+            assert page.headers['content-encoding'] == 'gzip'
+            assert page.headers['cache-control'] == 'no-cache'
+            assert 'rk-service-worker' not in page.text
+            etag = page.headers['etag']
+
+            cached = test_client.get('/', headers={'Accept-Encoding': 'gzip', 'If-None-Match': f'W/{etag}'})
+            assert cached.status_code == 304
+            assert cached.content == b''
+            identity = test_client.get('/', headers={'Accept-Encoding': 'identity', 'If-None-Match': etag})
+            assert identity.status_code == 200
+            assert 'content-encoding' not in identity.headers
+
+            script_url = re.search(r'<script src="(/assets/local\.[0-9a-f]+\.js)">', page.text).group(1)
+            script = test_client.get(script_url)
+            assert script.headers['cache-control'] == 'public, max-age=31536000, immutable'
+            assert 'new WebSocket' in script.text
+            assert test_client.get('/assets/local.0000.js').status_code == 404
+            assert test_client.get('/sw.js').status_code == 404
+
+    def test_service_worker_is_offered_only_when_enabled(self):
+        with TestClient(create_local_app(service_worker=True)) as test_client:
+            page = test_client.get('/')
+            worker = test_client.get('/sw.js')
+
+        assert '<meta name="rk-service-worker" content="/sw.js">' in page.text
+        assert worker.headers['cache-control'] == 'no-cache'
+        assert "'/ws'" not in worker.text and '"/"' in worker.text
+
+
+class LossyTransport:
+    """Wraps a datagram transport: drops every `drop_every`th datagram and swaps neighbours now and then."""
+
+    def __init__(self, transport, drop_every=7, hold_every=5):
+        self.transport = transport
+        self.drop_every = drop_every
+        self.hold_every = hold_every
+        self.count = 0
+        self.held = None
+
+    def sendto(self, data, addr=None):
+        self.count += 1
+        if self.count % self.drop_every == 0:
+            return
+        if self.held is None and self.count % self.hold_every == 1:
+            self.held = (data, addr)
+            return
+        self.transport.sendto(data, addr)
+        if self.held is not None:
+            self.transport.sendto(*self.held)
+            self.held = None
+
+    def __getattr__(self, name):
+        return getattr(self.transport, name)
+
+
+class TestLocalDatagrams:
+
+    def test_session_releases_in_order_and_spots_repeats(self):
+        session = DatagramSession('udp-1', 7, ('127.0.0.1', 9), window=4)
+        assert session.accept(2, ['b']) == []
+        assert session.missing() == [1]
+        assert session.accept(6, ['f']) == []
+        assert session.accept(1, ['a']) == [(1, ['a']), (2, ['b'])]
+        assert session.accept(2, ['b']) is None
+        assert session.received == 2
+
+    @patch('client.UDP_EXECUTION_WAIT_SECONDS', 0.2)
+    @patch('client.KeyboardController.type_text')
+    def test_loss_and_reordering_keep_order_and_run_each_event_once(self, mock_type_text):
+        typed = []
+        mock_type_text.side_effect = lambda text: typed.append(text)
+        words = [f'w{i} ' for i in range(150)]
+
+        async def scenario():
+            runtime = InjectionRuntime()
+            runtime.start()
+            transport, receiver = await asyncio.get_running_loop().create_datagram_endpoint(
+                lambda: LocalDatagramProtocol(runtime), local_addr=('127.0.0.1', 0)
+            )
+            receiver.transport = LossyTransport(transport, drop_every=5, hold_every=3)
+            sender = await LocalDatagramSender.connect('127.0.0.1', transport.get_extra_info('sockname')[1])
+            sender.transport = LossyTransport(sender.transport)
+            for word in words:
+                sender.send([{'type': 'word', 'payload': word}])
+            await asyncio.wait_for(sender.wait_executed(), 30)
+            sender.close()
+            receiver.close()
+            await runtime.drain()
+            await runtime.stop()
+            return sender
+
+        sender = asyncio.run(scenario())
+        assert ''.join(typed) == ''.join(words)
+        assert sorted(sender.executed) == list(range(1, 151))
+        assert all(ack['ok'] for ack in sender.executed.values())
+        deliveries = {}
+        for ack in sender.acks:
+            if ack['kind'] == 'delivery-ack':
+                deliveries.setdefault(ack['clientEventId'], set()).add(ack['eventId'])
+        assert all(len(event_ids) == 1 for event_ids in deliveries.values())
+
+    @patch('client.UDP_SESSION_IDLE_SECONDS', 0.3)
+    @patch('client.KeyboardController.type_text')
+    def test_idle_sessions_close_and_live_senders_keep_theirs(self, mock_type_text):
+        async def scenario():
+            runtime = InjectionRuntime()
+            runtime.start()
+            transport, receiver = await asyncio.get_running_loop().create_datagram_endpoint(
+                lambda: LocalDatagramProtocol(runtime), local_addr=('127.0.0.1', 0)
+            )
+            port = transport.get_extra_info('sockname')[1]
+            live = await LocalDatagramSender.connect('127.0.0.1', port)
+            live.send([{'type': 'word', 'payload': 'one '}])
+            await asyncio.wait_for(live.wait_executed(), 5)
+            gone = await LocalDatagramSender.connect('127.0.0.1', port)
+            gone.send([{'type': 'word', 'payload': 'two '}])
+            await asyncio.wait_for(gone.wait_executed(), 5)
+            gone.close()
+            assert len(receiver.sessions) == 2
+            await asyncio.sleep(1.2)
+            remaining = [session.sender for session in receiver.sessions.values()]
+            live.send([{'type': 'word', 'payload': 'three '}])
+            await asyncio.wait_for(live.wait_executed(), 5)
+            live.close()
+            receiver.close()
+            await runtime.stop()
+            return remaining, runtime.sequencer.depths()
+
+        remaining, depths = asyncio.run(scenario())
+        assert remaining == ['udp-1']
+        assert 'udp-2' not in depths
+        assert [call.args[0] for call in mock_type_text.call_args_list] == ['one ', 'two ', 'three ']
+
+    def test_session_waiting_to_submit_is_not_expired(self):
+        release = threading.Event()
+        typed = []
+
+        def type_text(text):
+            release.wait(5)
+            typed.append(text)
+
+        async def scenario():
+            runtime = InjectionRuntime(max_per_sender=1)
+            runtime.start()
+            transport, receiver = await asyncio.get_running_loop().create_datagram_endpoint(
+                lambda: LocalDatagramProtocol(runtime), local_addr=('127.0.0.1', 0)
+            )
+            sender = await LocalDatagramSender.connect('127.0.0.1', transport.get_extra_info('sockname')[1])
+            for word in ('one ', 'two ', 'three '):
+                sender.send([{'type': 'word', 'payload': word}])
+            session = None
+            while session is None or not (session.submitting and session.queue.empty()):
+                await asyncio.sleep(0.01)
+                session = next(iter(receiver.sessions.values()), None)
+            # 'one ' is being typed, 'two ' is queued and the pump waits to submit 'three '.
+            receiver.expire(time.monotonic() + 3600)
+            kept = list(receiver.sessions.values()) == [session]
+            release.set()
+            await asyncio.wait_for(sender.wait_executed(), 5)
+            receiver.expire(time.monotonic() + 3600)
+            sender.close()
+            receiver.close()
+            await runtime.stop()
+            return kept, receiver.sessions
+
+        with patch('client.KeyboardController.type_text', side_effect=type_text):
+            kept, sessions = asyncio.run(scenario())
+        assert kept and sessions == {}
+        assert typed == ['one ', 'two ', 'three ']
+
+
+class TestLocalSequencer:
+
+    @staticmethod
+    async def drain(sequencer, count):
+        return [await asyncio.wait_for(sequencer.get(), 2) for _ in range(count)]
+
+    def test_round_robin_keeps_each_sender_in_order(self):
+        async def scenario():
+            sequencer = LocalSequencer()
+            sequencer.register('a')
+            sequencer.register('b')
+            for index in range(5):
+                await sequencer.put('a', f'a{index}')
+            await sequencer.put('b', 'b0')
+            await sequencer.put('b', 'b1')
+            return [item for _, item in await self.drain(sequencer, 7)]
+
+        assert asyncio.run(scenario()) == ['a0', 'b0', 'a1', 'b1', 'a2', 'a3', 'a4']
+
+    def test_full_sender_queue_only_blocks_that_sender(self):
+        async def scenario():
+            sequencer = LocalSequencer(max_per_sender=2)
+            sequencer.register('noisy')
+            sequencer.register('quiet')
+            await sequencer.put('noisy', 1)
+            await sequencer.put('noisy', 2)
+            blocked = asyncio.create_task(sequencer.put('noisy', 3))
+            await asyncio.sleep(0.01)
+            assert not blocked.done()
+            await asyncio.wait_for(sequencer.put('quiet', 'q'), 1)
+            assert sequencer.depths() == {'noisy': 2, 'quiet': 1}
+
+            await sequencer.get()
+            await asyncio.wait_for(blocked, 1)
+            return sequencer.depths()
+
+        assert asyncio.run(scenario()) == {'noisy': 2, 'quiet': 1}
+
+    def test_rate_limit_spaces_out_a_sender(self):
+        async def scenario():
+            sequencer = LocalSequencer(rate=20, burst=1)
+            sequencer.register('a')
+            for index in range(3):
+                await sequencer.put('a', index)
+            started = time.monotonic()
+            await self.drain(sequencer, 3)
+            return time.monotonic() - started
+
+        assert asyncio.run(scenario()) >= 0.09
+
+    def test_focus_lock_holds_other_senders(self):
+        async def scenario():
+            sequencer = LocalSequencer()
+            sequencer.register('owner')
+            sequencer.register('other')
+            assert sequencer.acquire_focus('owner')
+            assert not sequencer.acquire_focus('other')
+            await sequencer.put('other', 'x')
+            await sequencer.put('owner', 'o')
+            assert await sequencer.get() == ('owner', 'o')
+
+            waiting = asyncio.create_task(sequencer.get())
+            await asyncio.sleep(0.01)
+            assert not waiting.done()
+            sequencer.unregister('owner')
+            return await asyncio.wait_for(waiting, 1), sequencer.focus_owner
+
+        assert asyncio.run(scenario()) == (('other', 'x'), None)
+
+    @patch('client.handle_keystroke')
+    def test_senders_and_focus_over_websocket(self, mock_handle_keystroke):
+        with TestClient(create_local_app()) as test_client:
+            with test_client.websocket_connect('/ws') as first, test_client.websocket_connect('/ws') as second:
+                first.send_json({'type': 'focus-lock'})
+                assert first.receive_json() == {'kind': 'focus', 'ok': True}
+                second.send_json({'type': 'focus-lock'})
+                assert second.receive_json() == {'kind': 'focus', 'ok': False}
+
+                health = test_client.get('/health').json()
+                assert health['focusOwner'] == 'sender-1'
+                assert health['senders'] == {'sender-1': 0, 'sender-2': 0}
+
+                second.send_json({'type': 'letter', 'payload': 'b', 'clientEventId': 1})
+                assert second.receive_json()['kind'] == 'delivery-ack'
+                first.send_json({'type': 'focus-release'})
+                assert first.receive_json() == {'kind': 'focus', 'ok': False}
+                assert second.receive_json()['kind'] == 'execution-ack'
+
+        mock_handle_keystroke.assert_called_once_with('letter', 'b')
+
+
+class StubEventServer:
+    """
+    Minimal stand-in for the Node server's polling API, with optional long-poll.
+    """
+
+    def __init__(self, long_poll=True, epoch=None):
+        self.long_poll = long_poll
+        self.epoch = epoch
+        self.events = []
+        self.client_ports = set()
+        self.requests = 0
+        self.changed = threading.Condition()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                query = parse_qs(urlparse(self.path).query)
+                since = int(query.get('since', ['0'])[0])
+                wait_ms = int(query.get('wait', ['0'])[0]) if stub.long_poll else 0
+                stub.client_ports.add(self.client_address[1])
+                stub.requests += 1
+
+                with stub.changed:
+                    stub.changed.wait_for(lambda: any(e['id'] > since for e in stub.events), timeout=wait_ms / 1000)
+                    events = [e for e in stub.events if e['id'] > since]
+                body = {'events': events, 'nextSince': events[-1]['id'] if events else since}
+                if stub.long_poll:
+                    body['longPoll'] = True
+                if stub.epoch is not None:
+                    body['epoch'] = stub.epoch
+                data = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def push(self, msg_type, payload):
+        with self.changed:
+            self.events.append({'id': len(self.events) + 1, 'type': msg_type, 'payload': payload})
+            self.changed.notify_all()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class StubHybridServer:
+    """
+    Stand-in for the Node server with both the Socket.IO room and the polling
+    API. While `stalled`, heartbeats go unanswered and keystrokes only reach
+    the polling queue, like a socket held open by a proxy that stopped
+    forwarding.
+    """
+
+    def __init__(self):
+        import socketio
+        import uvicorn
+        from fastapi import FastAPI
+
+        self.events = []
+        self.stalled = False
+        self.loop = None
+        self.sio = socketio.AsyncServer(async_mode='asgi')
+        api = FastAPI()
+        stub = self
+
+        @self.sio.event
+        async def connect(sid, environ):
+            stub.loop = asyncio.get_running_loop()
+            await stub.sio.emit('server-features', {'heartbeat': True}, to=sid)
+
+        @self.sio.on('join-room')
+        async def join_room(sid, room_code, role):
+            await stub.sio.enter_room(sid, room_code)
+
+        @self.sio.on('heartbeat')
+        async def heartbeat(sid, data):
+            while stub.stalled:
+                await asyncio.sleep(0.05)
+            return {'ts': time.time()}
+
+        @api.get('/api/health')
+        async def health():
+            return {'ok': True}
+
+        @api.get('/api/rooms/{room_code}/events')
+        async def events(room_code: str, since: int = 0):
+            queued = [event for event in stub.events if event['id'] > since]
+            return {'events': queued, 'nextSince': queued[-1]['id'] if queued else since, 'epoch': 'e1'}
+
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.url = f"http://127.0.0.1:{sock.getsockname()[1]}"
+        app = socketio.ASGIApp(self.sio, other_asgi_app=api)
+        self.server = uvicorn.Server(uvicorn.Config(app, log_level='error'))
+        self.thread = threading.Thread(target=self.server.run, kwargs={'sockets': [sock]}, daemon=True)
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+
+    def push(self, msg_type, payload):
+        event = {'id': len(self.events) + 1, 'type': msg_type, 'payload': payload}
+        self.events.append(event)
+        if not self.stalled and self.loop is not None:
+            asyncio.run_coroutine_threadsafe(self.sio.emit('keystroke', {
+                'roomCode': '1234', 'type': msg_type, 'payload': payload, 'eventId': event['id'], 'epoch': 'e1'
+            }, room='1234'), self.loop)
+
+    def close(self):
+        self.server.should_exit = True
+        self.thread.join(5)
+
+
+class TestHybridTransport:
+
+    def test_fails_over_to_polling_and_back_to_websocket(self):
+        stub = StubHybridServer()
+        backend = RecordingBackend()
+        previous_backend = KeyboardController.backend
+        KeyboardController.use_backend(backend)
+        timings = {}
+
+        async def wait_until(predicate, timeout=5):
+            deadline = time.monotonic() + timeout
+            while not predicate():
+                assert time.monotonic() < deadline
+                await asyncio.sleep(0.01)
+
+        async def scenario():
+            runtime = InjectionRuntime()
+            runtime.start()
+            with patch('client.injection_runtime', runtime):
+                transport = HybridTransport(runtime, stub.url, '1234', heartbeat_interval=0.2,
+                                            heartbeat_timeout=0.3, backoff_min=0.2, backoff_max=0.4, poll_wait=0)
+                task = asyncio.create_task(transport.run())
+                await wait_until(lambda: transport.active == 'websocket')
+                await asyncio.sleep(0.1)
+                stub.push('letter', 'a')
+                await wait_until(lambda: backend.typed_text == 'a')
+
+                stub.stalled = True
+                started = time.monotonic()
+                stub.push('letter', 'b')
+                await wait_until(lambda: backend.typed_text == 'ab')
+                timings['failover'] = time.monotonic() - started
+                assert transport.active == 'polling'
+
+                stub.stalled = False
+                await wait_until(lambda: transport.active == 'websocket')
+                stub.push('letter', 'c')
+                await wait_until(lambda: backend.typed_text == 'abc')
+                await asyncio.sleep(0.3)
+
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+                await runtime.stop()
+            return transport
+
+        try:
+            transport = asyncio.run(scenario())
+        finally:
+            KeyboardController.use_backend(previous_backend)
+            stub.close()
+
+        # Bounded by heartbeat interval + timeout, plus one poll.
+        assert timings['failover'] < 0.2 + 0.3 + 0.5
+        assert transport.failovers == 1
+        assert backend.typed_text == 'abc'
+
+
+class TestEventPoller:
+
+    def setup_method(self):
+        self.loop = asyncio.new_event_loop()
+
+    def teardown_method(self):
+        self.loop.close()
+
+    def run(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def test_long_poll_returns_as_soon_as_an_event_is_queued(self):
+        stub = StubEventServer(long_poll=True)
+        poller = EventPoller(stub.url, '1234', wait_seconds=5)
+        try:
+            threading.Timer(0.1, stub.push, args=('letter', 'a')).start()
+            started = time.monotonic()
+            events = self.run(poller.poll())
+            elapsed = time.monotonic() - started
+
+            assert [e['payload'] for e in events] == ['a']
+            assert elapsed < 1
+            assert poller.since_id == 1
+            assert poller.idle_delay == 0
+        finally:
+            self.run(poller.close())
+            stub.close()
+
+    def test_reuses_one_keep_alive_connection(self):
+        stub = StubEventServer(long_poll=True)
+        poller = EventPoller(stub.url, '1234', wait_seconds=0.05)
+        try:
+            for _ in range(3):
+                self.run(poller.poll())
+            assert stub.requests == 3
+            assert len(stub.client_ports) == 1
+        finally:
+            self.run(poller.close())
+            stub.close()
+
+    def test_backs_off_when_idle_and_resets_when_events_flow(self):
+        stub = StubEventServer(long_poll=False)
+        poller = EventPoller(stub.url, '1234', min_interval=0.05, max_interval=0.2)
+        try:
+            delays = []
+            for _ in range(4):
+                self.run(poller.poll())
+                delays.append(poller.idle_delay)
+            assert delays == [0.05, 0.1, 0.2, 0.2]
+
+            stub.push('word', 'hi ')
+            assert [e['payload'] for e in self.run(poller.poll())] == ['hi ']
+            assert poller.idle_delay == 0
+        finally:
+            self.run(poller.close())
+            stub.close()
+
+    def test_rewinds_stale_cursor_when_server_epoch_changes(self):
+        stub = StubEventServer(long_poll=True, epoch='new')
+        stub.push('letter', 'a')
+        poller = EventPoller(stub.url, '1234', since_id=500, epoch='old', wait_seconds=5)
+        try:
+            started = time.monotonic()
+            assert self.run(poller.poll()) == []
+            assert time.monotonic() - started < 1
+            assert (poller.since_id, poller.epoch) == (0, 'new')
+            assert [e['payload'] for e in self.run(poller.poll())] == ['a']
+        finally:
+            self.run(poller.close())
+            stub.close()
+
+
+class TestEventCursors:
+
+    def test_cursor_survives_reopen_and_ignores_torn_line(self, tmp_path):
+        path = str(tmp_path / 'cursors.log')
+        store = EventCursorStore(path)
+        store.advance('http://server', '1234', 5, 'e1')
+        store.advance('http://server', '1234', 9, 'e1')
+        assert store.advance('http://server', '1234', 3, 'e1') is False
+        store.close()
+        with open(path, 'a', encoding='utf-8') as handle:
+            handle.write('{"key":"http://server#1234","id":')
+
+        reopened = EventCursorStore(path)
+        assert reopened.get('http://server', '1234') == ('e1', 9)
+        assert reopened.get('http://server', 'other') == (None, 0)
+        reopened.advance('http://server', '1234', 2, 'e2')
+        assert reopened.get('http://server', '1234') == ('e2', 2)
+        reopened.close()
+
+    def test_log_is_compacted(self, tmp_path):
+        path = str(tmp_path / 'cursors.log')
+        store = EventCursorStore(path, compact_after=10)
+        for event_id in range(1, 26):
+            store.advance('http://server', '1234', event_id)
+        store.close()
+
+        with open(path, encoding='utf-8') as handle:
+            assert len(handle.readlines()) < 10
+        assert EventCursorStore(path).get('http://server', '1234') == (None, 25)
+
+    def test_executed_index_is_bounded(self):
+        index = ExecutedEventIndex(capacity=3)
+        assert all(index.claim(key) for key in (1, 2, 3, 4))
+        assert index.claim(4) is False
+        assert 1 not in index and len(index) == 3
+
+    @patch('client.sio')
+    @patch('client.KeyboardController.press_key')
+    def test_duplicate_websocket_event_runs_once(self, mock_press_key, mock_sio):
+        mock_sio.cursors = None
+        mock_sio.emit = AsyncMock()
+        data = {'type': 'letter', 'payload': 'd', 'roomCode': 'dup', 'eventId': 41, 'epoch': 'e1'}
+
+        async def deliver():
+            await on_keystroke(data)
+            await on_keystroke(dict(data))
+            await on_keystroke(dict(data, epoch='e2'))
+
+        with patch('client.executed_events', ExecutedEventIndex()), \
+                patch('client.ack_batcher', AckBatcher(mock_sio.emit)):
+            asyncio.run(deliver())
+        assert mock_press_key.call_count == 2
+        acks = [call.args[1] for call in mock_sio.emit.call_args_list if call.args[0] == 'execution-ack']
+        assert [(ack['ok'], ack.get('duplicate')) for ack in acks] == [(True, None), (True, True), (True, None)]
+
+    @patch('client.KeyboardController.type_text')
+    def test_polled_events_advance_cursor_and_skip_duplicates(self, mock_type_text, tmp_path):
+        store = EventCursorStore(str(tmp_path / 'cursors.log'))
+        events = [{'id': 1, 'type': 'letter', 'payload': 'a'}, {'id': 2, 'type': 'letter', 'payload': 'b'}]
+
+        def record(event):
+            store.advance('http://server', '1234', event['id'])
+
+        async def deliver():
+            runtime = InjectionRuntime()
+            runtime.start()
+            await process_polled_events(runtime, events, record, room_code='1234')
+            await process_polled_events(runtime, events, record, room_code='1234')
+            await runtime.drain()
+            await runtime.stop()
+
+        with patch('client.executed_events', ExecutedEventIndex()):
+            asyncio.run(deliver())
+        assert ''.join(call.args[0] for call in mock_type_text.call_args_list) == 'ab'
+        assert store.get('http://server', '1234') == (None, 2)
+        store.close()
+
+
+    def test_backlog_compaction_folds_text_and_backspaces(self):
+        events = [
+            {'id': 1, 'type': 'letter', 'payload': 'h'},
+            {'id': 2, 'type': 'letter', 'payload': 'x'},
+            {'id': 3, 'type': 'letter', 'payload': 'Backspace'},
+            {'id': 4, 'type': 'word', 'payload': 'i '},
+            {'id': 5, 'type': 'letter', 'payload': 'Enter'},
+            {'id': 6, 'type': 'letter', 'payload': 'Backspace'},
+            {'id': 7, 'type': 'block', 'payload': 'ok'}
+        ]
+        actions = [(msg_type, payload, [event['id'] for event in covered])
+                   for msg_type, payload, covered in compact_backlog(events)]
+        assert actions == [
+            ('word', 'hi ', [1, 2, 3, 4]),
+            ('letter', 'Enter', [5]),
+            ('letter', 'Backspace', [6]),
+            ('block', 'ok', [7])
+        ]
+
+    def test_backspace_cancels_a_whole_crlf_line_break(self):
+        events = [
+            {'id': 1, 'type': 'block', 'payload': 'one\r\n'},
+            {'id': 2, 'type': 'letter', 'payload': 'Backspace'},
+            {'id': 3, 'type': 'word', 'payload': ' two'}
+        ]
+        assert [(msg_type, payload) for msg_type, payload, _ in compact_backlog(events)] == [('word', 'one two')]
+
+    def test_compacted_backlog_acks_every_event(self):
+        backend = RecordingBackend()
+        previous_backend = KeyboardController.backend
+        KeyboardController.use_backend(backend)
+        events = [{'id': n, 'type': 'letter', 'payload': c} for n, c in enumerate('abc', start=1)]
+        events.append({'id': 4, 'type': 'letter', 'payload': 'Backspace'})
+        executed = []
+
+        async def deliver():
+            runtime = InjectionRuntime()
+            runtime.start()
+            await process_polled_events(runtime, events, lambda event: executed.append(event['id']), room_code='1234')
+            await runtime.drain()
+            await runtime.stop()
+
+        try:
+            with patch('client.executed_events', ExecutedEventIndex()):
+                asyncio.run(deliver())
+        finally:
+            KeyboardController.use_backend(previous_backend)
+        assert backend.actions == [('write', 'ab')]
+        assert executed == [1, 2, 3, 4]
+
+
+class TestSnippets:
+
+    def test_store_survives_reopen_in_lru_order_and_ignores_torn_record(self, tmp_path):
+        path = str(tmp_path / 'snippets.bin')
+        texts = [f"{name} boilerplate\n" * 40 for name in ('alpha', 'bravo', 'gamma', 'delta')]
+        budget = sum(len(zlib.compress(text.encode('utf-8'))) for text in texts[:3]) + 16
+        store = SnippetStore(path, max_bytes=budget)
+        digests = [store.put(text) for text in texts[:3]]
+        assert store.get(digests[0]) == texts[0]
+        store.close()
+        assert os.stat(path).st_mode & 0o777 == 0o600
+        with open(path, 'ab') as handle:
+            handle.write(b'\x01' * 30)
+
+        reopened = SnippetStore(path, max_bytes=budget)
+        assert len(reopened) == 3
+        # alpha was used after bravo was stored, so bravo is evicted first.
+        digests.append(reopened.put(texts[3]))
+        assert [digest in reopened for digest in digests] == [True, False, True, True]
+        reopened.close()
+
+        replayed = SnippetStore(path, max_bytes=budget)
+        assert [digest in replayed for digest in digests] == [True, False, True, True]
+        assert replayed.get(digests[3]) == texts[3]
+
+    def test_log_is_compacted(self, tmp_path):
+        path = str(tmp_path / 'snippets.bin')
+        store = SnippetStore(path)
+        digest = store.put('template {{name}} ' * 30)
+        for _ in range(5000):
+            assert store.get(digest).startswith('template')
+        store.close()
+        assert os.path.getsize(path) < 64 * 1024
+        assert SnippetStore(path).resolve(f"{digest}?name=Ada").startswith('template Ada template Ada')
+
+    @patch('client.KeyboardController.try_paste', return_value=True)
+    def test_repeated_block_is_sent_by_digest(self, mock_try_paste, tmp_path):
+        text = 'Dear {{name}},\n' + 'Thank you for your message. ' * 20
+        acks = []
+        store_threads = set()
+
+        class ThreadRecordingStore(SnippetStore):
+            def _append(self, *args):
+                store_threads.add(threading.current_thread())
+                return super()._append(*args)
+
+        async def scenario():
+            runtime = InjectionRuntime()
+            runtime.snippets = ThreadRecordingStore(str(tmp_path / 'snippets.bin'))
+            await runtime.submit('phone', 'block', text, lambda error, **fields: acks.append(fields))
+            digest = acks[0]['snippet']
+            await runtime.submit('phone', 'snippet', f"{digest}?name=Ada%20L", lambda error: acks.append(error))
+            await runtime.submit('phone', 'snippet', 'f' * 32, acks.append)
+            runtime.snippets.close()
+
+        asyncio.run(scenario())
+        assert acks[0] == {'snippet': snippet_digest(text)}
+        assert acks[1] is None
+        assert [call.args[0] for call in mock_try_paste.call_args_list] == [text, text.replace('{{name}}', 'Ada L')]
+        assert execution_status(acks[2]) == {'ok': False, 'error': f"unknown snippet {'f' * 32}", 'snippetMiss': True}
+        # Disk writes happen on worker threads, never on the event loop's.
+        assert store_threads and threading.main_thread() not in store_threads
+
+
+class TestPipelineMetrics:
+
+    def test_stage_intervals_and_percentiles(self):
+        pipeline = PipelineMetrics()
+        for offset in range(1, 101):
+            trace = pipeline.start_trace()
+            base = trace['received']
+            trace.update({
+                'dequeued': base + 0.001,
+                'injection_start': base + 0.001,
+                'injection_end': base + 0.001 + offset / 1000,
+                'ack_sent': base + 0.002 + offset / 1000
+            })
+            pipeline.finish(trace)
+
+        injection = pipeline.histograms['injection']
+        assert injection.count == 100
+        assert injection.percentile(0.5) == pytest.approx(0.050)
+        assert injection.percentile(0.99) == pytest.approx(0.099)
+        assert pipeline.histograms['queue_wait'].percentile(0.95) == pytest.approx(0.001)
+        assert pipeline.executed == 100
+        assert pipeline.events_per_second() == pytest.approx(100 / 10)
+
+    def test_prometheus_rendering_includes_queue_depth(self):
+        pipeline = PipelineMetrics()
+        pipeline.track_queue('test', lambda: 4)
+        trace = pipeline.start_trace()
+        pipeline.mark(trace, 'injection_end')
+        pipeline.finish(trace, ok=False)
+
+        text = pipeline.render_prometheus()
+        assert 'rk_queue_depth{queue="test"} 4' in text
+        assert 'rk_events_executed_total{result="error"} 1' in text
+        assert 'rk_stage_latency_seconds_count{stage="total"} 1' in text
+        assert 'rk_stage_latency_quantile_seconds{stage="injection",quantile="0.99"}' in text
+
+    @patch('client.handle_keystroke')
+    def test_local_metrics_endpoint(self, mock_handle_keystroke):
+        metrics.reset()
+        with TestClient(create_local_app()) as test_client:
+            with test_client.websocket_connect('/ws') as ws:
+                ws.send_json({'type': 'letter', 'payload': 'a', 'clientEventId': 1})
+                ws.receive_json()
+                ws.receive_json()
+            response = test_client.get('/metrics')
+
+        assert response.status_code == 200
+        assert response.headers['content-type'].startswith('text/plain')
+        assert 'rk_events_executed_total{result="ok"} 1' in response.text
+        assert 'rk_stage_latency_seconds_count{stage="ack"} 1' in response.text
+        assert 'rk_queue_depth{queue="injection"} 0' in response.text
+
+
+    def test_clock_offset_prefers_the_shortest_round_trip(self):
+        clock = ClockOffset()
+        # The sender's clock is 5 s ahead; the slow exchange answered late on the way back.
+        clock.add(1000.0, 6010.0, 1020.0)
+        clock.add(2000.0, 7150.0, 2200.0)
+        assert clock.round_trip == 20.0
+        assert clock.offset == 5000.0
+
+        sent = clock.to_host(time.time() * 1000 + 5000 - 30)
+        assert time.perf_counter() - sent == pytest.approx(0.030, abs=0.01)
+        assert ClockOffset().to_host(123.0) is None
+
+    @patch('client.handle_keystroke')
+    def test_local_events_are_traced_from_the_sender_keypress(self, mock_handle_keystroke):
+        metrics.reset()
+        with TestClient(create_local_app()) as test_client:
+            with test_client.websocket_connect('/ws') as ws:
+                ws.send_json({'type': 'clock-sync'})
+                ping = ws.receive_json()
+                assert ping['kind'] == 'clock-ping'
+                # This phone's clock runs 5 s ahead of the host.
+                ws.send_json({'type': 'clock-pong', 't0': ping['t0'], 't1': ping['t0'] + 5000})
+                ws.send_json({'type': 'letter', 'payload': 'a', 'clientEventId': 1,
+                              'sentAt': time.time() * 1000 + 5000 - 40})
+                while ws.receive_json()['kind'] != 'execution-ack':
+                    pass
+            exported = test_client.get('/traces').json()
+
+        trace = metrics.traces[-1]
+        assert trace['args']['type'] == 'letter'
+        assert trace['received'] - trace['sent'] == pytest.approx(0.040, abs=0.03)
+        assert metrics.histograms['end_to_end'].count == 1
+        names = {event['name'] for event in exported['traceEvents'] if event['ph'] == 'b'}
+        assert {'letter', 'network', 'queue_wait', 'injection', 'ack'} <= names
+        assert all(event['cat'] == 'keystroke' and 'ts' in event for event in exported['traceEvents'])
+
+
+class TestStartup:
+
+    def setup_method(self):
+        self.previous_backend = KeyboardController.backend
+
+    def teardown_method(self):
+        KeyboardController.use_backend(self.previous_backend)
+
+    def test_import_loads_no_transport_or_injection_libraries(self):
+        heavy = ['socketio', 'aiohttp', 'fastapi', 'uvicorn', 'pyautogui']
+        script = (
+            "import sys; import client; "
+            f"print(','.join(m for m in {heavy!r} if m in sys.modules))"
+        )
+        result = subprocess.run(
+            [sys.executable, '-c', script], capture_output=True, text=True, check=True,
+            cwd=os.path.join(os.path.dirname(__file__), '..')
+        )
+        assert result.stdout.strip() == ''
+
+    def test_non_interactive_settings_use_defaults(self):
+        args = build_arg_parser().parse_args(['--non-interactive', '--room', 'ABC123'])
+        args = resolve_settings(args)
+        assert args.mode == 'internet'
+        assert args.server_url == 'http://localhost:3000'
+        assert args.transport == 'websocket'
+
+    def test_non_interactive_without_room_exits(self):
+        args = build_arg_parser().parse_args(['--non-interactive', '--mode', 'internet'])
+        with pytest.raises(SystemExit):
+            resolve_settings(args)
+
+    @patch('client.run_client', new_callable=AsyncMock)
+    def test_main_warms_backend_then_signals_ready(self, mock_run_client, tmp_path):
+        ready_file = tmp_path / 'ready'
+
+        def run_client(args, cursors, on_ready, snippets):
+            # Ready only once run_client says its sources are taking events.
+            if not mock_warm_up.called or ready_file.exists():
+                return False
+            on_ready()
+            return True
+
+        with patch('client.RecordingBackend.warm_up') as mock_warm_up:
+            mock_run_client.side_effect = run_client
+            code = main(['--non-interactive', '--mode', 'local', '--backend', 'recording', '--clipboard', 'memory',
+                         '--port', '9100', '--ready-file', str(ready_file), '--state-dir', str(tmp_path),
+                         '--snippet-cache', '1'])
+
+        assert code == 0
+        args = mock_run_client.await_args.args[0]
+        assert (args.mode, args.host, args.port) == ('local', '0.0.0.0', 9100)
+        assert ready_file.read_text().strip() == str(os.getpid())
+        assert isinstance(KeyboardController.clipboard, MemoryClipboard)
+        assert mock_run_client.await_args.args[3].path == str(tmp_path / 'snippets.bin')
+        KeyboardController.use_clipboard(None)
+
+    def test_bad_paste_threshold_env_is_a_usage_error(self, capsys):
+        with patch.dict(os.environ, {'RK_PASTE_THRESHOLD': 'lots'}):
+            with pytest.raises(SystemExit) as exit_info:
+                build_arg_parser().parse_args(['--non-interactive', '--room', 'ABC123'])
+            assert build_arg_parser().parse_args(['--paste-threshold', '50']).paste_threshold == 50
+        assert exit_info.value.code == 2
+        assert "invalid int value: 'lots'" in capsys.readouterr().err
+        with patch.dict(os.environ, {'RK_SNIPPET_CACHE_MB': 'big'}):
+            with pytest.raises(SystemExit):
+                build_arg_parser().parse_args([])
+        assert "invalid float value: 'big'" in capsys.readouterr().err
+
+    def test_ready_once_the_local_server_listens(self):
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        args = resolve_settings(build_arg_parser().parse_args([
+            '--non-interactive', '--mode', 'local', '--host', '127.0.0.1', '--port', str(port)
+        ]))
+        reachable = []
+
+        def on_ready():
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                reachable.append(True)
+
+        async def scenario():
+            client_task = asyncio.create_task(run_client(args, on_ready=on_ready))
+            for _ in range(200):
+                if reachable:
+                    break
+                await asyncio.sleep(0.025)
+            client_task.cancel()
+            try:
+                await client_task
+            except asyncio.CancelledError:
+                pass
+
+        asyncio.run(scenario())
+        assert reachable == [True]
+
+    def test_both_mode_serves_local_and_internet_senders_from_one_loop(self):
+        import aiohttp
+
+        stub = StubEventServer(long_poll=True)
+        stub.push('word', 'remote ')
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        args = resolve_settings(build_arg_parser().parse_args([
+            '--non-interactive', '--mode', 'both', '--transport', 'http-polling', '--room', '1234',
+            '--server-url', stub.url, '--host', '127.0.0.1', '--port', str(port)
+        ]))
+        typed = []
+
+        async def scenario():
+            client_task = asyncio.create_task(run_client(args))
+            async with aiohttp.ClientSession() as session:
+                for _ in range(200):
+                    try:
+                        ws = await session.ws_connect(f'http://127.0.0.1:{port}/ws')
+                        break
+                    except aiohttp.ClientError:
+                        await asyncio.sleep(0.025)
+                await ws.send_json({'type': 'word', 'payload': 'local ', 'clientEventId': 1})
+                frames = [await asyncio.wait_for(ws.receive_json(), 5) for _ in range(2)]
+                await ws.close()
+            for _ in range(200):
+                if 'remote ' in typed:
+                    break
+                await asyncio.sleep(0.025)
+            client_task.cancel()
+            try:
+                await client_task
+            except asyncio.CancelledError:
+                pass
+            return frames
+
+        try:
+            with patch('client.KeyboardController.type_text', side_effect=typed.append):
+                frames = asyncio.run(scenario())
+        finally:
+            stub.close()
+
+        assert [frame['kind'] for frame in frames] == ['delivery-ack', 'execution-ack']
+        assert sorted(typed) == ['local ', 'remote ']
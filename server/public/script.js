@@ -12,9 +12,12 @@ let socketReady = false;
 let currentTransport = localStorage.getItem('rk_transport_mode') || 'websocket';
 let nextClientEventId = Number.parseInt(localStorage.getItem('rk_next_client_event_id') || '1', 10);
 const pendingAcks = new Map();
+const snippets = loadSnippets();
 let deniedShortcuts = new Set();
 
 const ACK_TIMEOUT_MS = 6000;
+const SNIPPETS_REMEMBERED = 256;
+const SNIPPET_MIN_CHARS = 256;
 const DEFAULT_DENYLIST = 'Ctrl+W,Ctrl+R,Alt+F4,Meta+Q';
 
 function setStatus(text, isConnected) {
@@ -83,7 +86,7 @@ function ensureSocket() {
     });
 
     socket.on('execution-ack', (data = {}) => {
-        const { roomCode, clientEventId, eventId, ok, error } = data;
+        const { roomCode, clientEventId, eventId, ok, error, typed, total, cancelled, snippet, snippetMiss } = data;
         if (!clientEventId || roomCode !== getRoomCode()) {
             return;
         }
@@ -96,6 +99,21 @@ function ensureSocket() {
         clearTimeout(record.timer);
         pendingAcks.delete(clientEventId);
 
+        if (snippetMiss && record.block !== null) {
+            // The receiver no longer has this block: send it in full, which keeps it again.
+            forgetSnippet(snippetDigest(record.block));
+            sendEvent('block', record.block, record.options, record.block);
+            return;
+        }
+        if (snippet) {
+            rememberSnippet(snippet);
+        }
+
+        if (cancelled) {
+            setDeliveryStatus(`Stopped #${eventId || '?'} after ${typed}/${total} characters`, 'warn');
+            return;
+        }
+
         if (ok === false) {
             setDeliveryStatus(`Execution failed #${eventId || '?'}: ${error || 'unknown error'}`, 'error');
             return;
@@ -104,6 +122,31 @@ function ensureSocket() {
         setDeliveryStatus(`Executed #${eventId || '?'}`, 'ok');
     });
 
+    // The receiver pings to learn this device's clock offset.
+    socket.on('clock-ping', (data = {}) => {
+        if (data.roomCode !== getRoomCode()) {
+            return;
+        }
+        socket.emit('clock-pong', { roomCode: data.roomCode, t0: data.t0, t1: senderClock() });
+    });
+
+    socket.on('execution-progress', (data = {}) => {
+        const { roomCode, clientEventId, eventId, typed, total } = data;
+        if (!clientEventId || roomCode !== getRoomCode()) {
+            return;
+        }
+
+        const record = pendingAcks.get(clientEventId);
+        if (!record) {
+            return;
+        }
+
+        // Long blocks are typed in chunks; each chunk restarts the ACK timeout.
+        clearTimeout(record.timer);
+        record.timer = armAckTimer(clientEventId);
+        setDeliveryStatus(`Typing #${eventId || '?'}: ${typed}/${total} characters`, 'neutral');
+    });
+
     socket.on('disconnect', () => {
         socketReady = false;
         if (currentTransport === 'websocket') {
@@ -137,11 +180,11 @@ function switchTransport(nextMode) {
     updateTransportNote();
 }
 
-async function sendViaHttp(roomCode, type, payload) {
+async function sendViaHttp(roomCode, type, payload, options = {}) {
     const response = await fetch(`/api/rooms/${encodeURIComponent(roomCode)}/events`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ type, payload })
+        body: JSON.stringify({ type, payload, ...options })
     });
 
     if (!response.ok) {
@@ -149,7 +192,18 @@ async function sendViaHttp(roomCode, type, payload) {
     }
 }
 
-function sendViaWebSocket(roomCode, type, payload, clientEventId) {
+function armAckTimer(clientEventId) {
+    return setTimeout(() => {
+        if (!pendingAcks.has(clientEventId)) {
+            return;
+        }
+
+        pendingAcks.delete(clientEventId);
+        setDeliveryStatus(`No execution ACK yet for client event ${clientEventId}`, 'warn');
+    }, ACK_TIMEOUT_MS);
+}
+
+function sendViaWebSocket(roomCode, type, payload, clientEventId, options = {}, block = null) {
     ensureSocket();
     if (!socket) {
         throw new Error('WebSocket is not available on this deployment');
@@ -162,19 +216,16 @@ function sendViaWebSocket(roomCode, type, payload, clientEventId) {
         throw new Error('WebSocket not ready');
     }
 
-    const timer = setTimeout(() => {
-        if (!pendingAcks.has(clientEventId)) {
-            return;
-        }
-
-        pendingAcks.delete(clientEventId);
-        setDeliveryStatus(`No execution ACK yet for client event ${clientEventId}`, 'warn');
-    }, ACK_TIMEOUT_MS);
-
-    pendingAcks.set(clientEventId, { timer, phase: 'sent', eventId: null });
+    pendingAcks.set(clientEventId, {
+        timer: armAckTimer(clientEventId),
+        phase: 'sent',
+        eventId: null,
+        block,
+        options
+    });
 
     socket.emit('join-room', roomCode, 'sender');
-    socket.emit('keystroke', { roomCode, type, payload, clientEventId });
+    socket.emit('keystroke', { roomCode, type, payload, clientEventId, ...options });
     setDeliveryStatus(`Sent client event ${clientEventId}`, 'neutral');
 }
 
@@ -342,7 +393,91 @@ function nextEventId() {
     return current;
 }
 
-async function sendEvent(type, payload) {
+// Milliseconds since the epoch on this device's clock, with sub-millisecond precision.
+function senderClock() {
+    return performance.timeOrigin + performance.now();
+}
+
+// SHA-256 of the text's UTF-8 bytes, first 16 bytes in hex: the digest the
+// receiver keeps a block under. crypto.subtle is only available on https
+// and localhost origins, so it is computed here.
+const SHA256_K = new Uint32Array([
+    0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
+    0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
+    0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+    0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
+    0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+    0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+    0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
+    0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2
+]);
+
+function snippetDigest(text) {
+    const bytes = new TextEncoder().encode(text);
+    const padded = new Uint8Array((bytes.length + 72) & ~63);
+    padded.set(bytes);
+    padded[bytes.length] = 0x80;
+    const view = new DataView(padded.buffer);
+    view.setUint32(padded.length - 8, Math.floor(bytes.length / 0x20000000));
+    view.setUint32(padded.length - 4, (bytes.length * 8) >>> 0);
+    const hash = new Uint32Array([
+        0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a, 0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19
+    ]);
+    const w = new Uint32Array(64);
+    const ror = (x, n) => (x >>> n) | (x << (32 - n));
+    for (let offset = 0; offset < padded.length; offset += 64) {
+        for (let i = 0; i < 16; i++) {
+            w[i] = view.getUint32(offset + i * 4);
+        }
+        for (let i = 16; i < 64; i++) {
+            const s0 = ror(w[i - 15], 7) ^ ror(w[i - 15], 18) ^ (w[i - 15] >>> 3);
+            const s1 = ror(w[i - 2], 17) ^ ror(w[i - 2], 19) ^ (w[i - 2] >>> 10);
+            w[i] = w[i - 16] + s0 + w[i - 7] + s1;
+        }
+        let [a, b, c, d, e, f, g, h] = hash;
+        for (let i = 0; i < 64; i++) {
+            const t1 = (h + (ror(e, 6) ^ ror(e, 11) ^ ror(e, 25)) + ((e & f) ^ (~e & g)) + SHA256_K[i] + w[i]) >>> 0;
+            const t2 = ((ror(a, 2) ^ ror(a, 13) ^ ror(a, 22)) + ((a & b) ^ (a & c) ^ (b & c))) >>> 0;
+            h = g; g = f; f = e; e = (d + t1) >>> 0; d = c; c = b; b = a; a = (t1 + t2) >>> 0;
+        }
+        [a, b, c, d, e, f, g, h].forEach((value, i) => { hash[i] += value; });
+    }
+    return Array.from(hash.subarray(0, 4), (word) => word.toString(16).padStart(8, '0')).join('');
+}
+
+// Digests of blocks the receiver has kept; only digests are stored, never the text.
+function loadSnippets() {
+    let digests = [];
+    try {
+        digests = JSON.parse(localStorage.getItem('rk_snippets') || '[]');
+    } catch (_) {
+        // Unreadable: start over.
+    }
+    const loaded = new Set(Array.isArray(digests) ? digests.filter((digest) => typeof digest === 'string') : []);
+    localStorage.setItem('rk_snippets', JSON.stringify([...loaded]));
+    return loaded;
+}
+
+function rememberSnippet(digest) {
+    snippets.delete(digest);
+    snippets.add(digest);
+    while (snippets.size > SNIPPETS_REMEMBERED) {
+        snippets.delete(snippets.values().next().value);
+    }
+    localStorage.setItem('rk_snippets', JSON.stringify([...snippets]));
+}
+
+function forgetSnippet(digest) {
+    if (snippets.delete(digest)) {
+        localStorage.setItem('rk_snippets', JSON.stringify([...snippets]));
+    }
+}
+
+// `options` adds fields to the event, such as { mustType: true }. `block` is
+// the full text behind a block or snippet event, kept until it is acked.
+async function sendEvent(type, payload, options = {}, block = null) {
+    // Stamped before anything else so the receiver's traces start at the keypress.
+    options = { ...options, sentAt: senderClock() };
     const safePayload = sanitizeOutgoing(type, payload);
     if (safePayload === null || safePayload === undefined || safePayload === '') {
         return;
@@ -360,10 +495,10 @@ async function sendEvent(type, payload) {
     try {
         if (currentTransport === 'websocket') {
             const clientEventId = nextEventId();
-            sendViaWebSocket(roomCode, type, safePayload, clientEventId);
+            sendViaWebSocket(roomCode, type, safePayload, clientEventId, options, block);
             setStatus('Connected (WebSocket)', true);
         } else {
-            await sendViaHttp(roomCode, type, safePayload);
+            await sendViaHttp(roomCode, type, safePayload, options);
             setStatus('Sent (HTTP polling)', true);
             setDeliveryStatus('Delivered to server (HTTP polling). Execution ACK unavailable.', 'neutral');
         }
@@ -434,6 +569,7 @@ typewriterInput.addEventListener('keydown', (e) => {
     e.preventDefault();
 
     if (denied) {
+        stopTyping();
         setDeliveryStatus(`Blocked shortcut: ${denied}`, 'warn');
         return;
     }
@@ -510,13 +646,26 @@ function sendBlock() {
     const textarea = document.getElementById('button-input');
     const text = textarea.value;
     if (text) {
-        sendEvent('block', text);
+        const options = document.getElementById('must-type-toggle').checked ? { mustType: true } : {};
+        // Only the socket carries execution ACKs, so only it can learn or use digests.
+        const digest = currentTransport === 'websocket' && text.length >= SNIPPET_MIN_CHARS ? snippetDigest(text) : null;
+        if (digest && snippets.has(digest)) {
+            sendEvent('snippet', digest, options, text);
+        } else {
+            sendEvent('block', text, options, text);
+        }
         textarea.value = '';
     }
 }
 
+// Stops a block that is being typed and drops this sender's queued text.
+function stopTyping() {
+    sendEvent('cancel', 'stop');
+}
+
 window.manualSendWord = manualSendWord;
 window.sendBlock = sendBlock;
+window.stopTyping = stopTyping;
 window.switchTab = switchTab;
 
 roomCodeEl.value = localStorage.getItem('rk_room_code') || '';
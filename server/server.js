@@ -2,11 +2,17 @@ const express = require('express');
 const http = require('http');
 const { Server } = require('socket.io');
 const path = require('path');
+const crypto = require('crypto');
 
 const app = express();
 const server = http.createServer(app);
 const EVENT_RETENTION_MS = 30 * 60 * 1000;
 const MAX_EVENTS_PER_ROOM = 1000;
+const MAX_LONG_POLL_WAIT_MS = 30 * 1000;
+// Event ids restart at 1 whenever the process restarts; receivers use the
+// epoch to tell a fresh id sequence from one they have already executed.
+const SERVER_EPOCH = crypto.randomBytes(6).toString('hex');
+const SERVER_FEATURES = { executionAckBatch: true, heartbeat: true, clockSync: true };
 const roomEvents = new Map();
 
 function getRoomStore(roomCode) {
@@ -14,6 +20,7 @@ function getRoomStore(roomCode) {
         roomEvents.set(roomCode, {
             events: [],
             nextId: 1,
+            waiters: new Set(),
             lastTouched: Date.now()
         });
     }
@@ -25,13 +32,13 @@ function getRoomStore(roomCode) {
 function pruneExpiredRooms() {
     const now = Date.now();
     for (const [roomCode, store] of roomEvents.entries()) {
-        if (now - store.lastTouched > EVENT_RETENTION_MS) {
+        if (now - store.lastTouched > EVENT_RETENTION_MS && store.waiters.size === 0) {
             roomEvents.delete(roomCode);
         }
     }
 }
 
-function queueEvent(roomCode, type, payload) {
+function queueEvent(roomCode, type, payload, mustType, sentAt, senderId) {
     const store = getRoomStore(roomCode);
     const event = {
         id: store.nextId++,
@@ -39,13 +46,34 @@ function queueEvent(roomCode, type, payload) {
         payload,
         ts: Date.now()
     };
+    // Receivers paste large text unless the sender asked for it to be typed.
+    if (mustType) {
+        event.mustType = true;
+    }
+    // The sender's own clock at send time; receivers that know the sender's
+    // clock offset (see clock-ping) trace latency from the keypress.
+    if (Number.isFinite(sentAt)) {
+        event.sentAt = sentAt;
+        if (senderId) {
+            event.senderId = senderId;
+        }
+    }
     store.events.push(event);
     if (store.events.length > MAX_EVENTS_PER_ROOM) {
         store.events = store.events.slice(-MAX_EVENTS_PER_ROOM);
     }
+    for (const wake of store.waiters) {
+        wake();
+    }
     return event;
 }
 
+function eventsSince(store, since) {
+    const events = store.events.filter((event) => event.id > since);
+    const nextSince = events.length > 0 ? events[events.length - 1].id : since;
+    return { events, nextSince, epoch: SERVER_EPOCH };
+}
+
 const io = new Server(server, {
     cors: {
         origin: "*",
@@ -64,27 +92,86 @@ app.get('/api/health', (_, res) => {
 
 app.post('/api/rooms/:roomCode/events', (req, res) => {
     const { roomCode } = req.params;
-    const { type, payload } = req.body || {};
+    const { type, payload, mustType, sentAt } = req.body || {};
     if (!roomCode || !type || payload === undefined || payload === null) {
         return res.status(400).json({ error: 'roomCode, type and payload are required' });
     }
     pruneExpiredRooms();
-    const event = queueEvent(roomCode, type, payload);
+    const event = queueEvent(roomCode, type, payload, mustType, sentAt);
     return res.status(202).json({ accepted: true, eventId: event.id });
 });
 
 app.get('/api/rooms/:roomCode/events', (req, res) => {
     const { roomCode } = req.params;
-    const since = Number.parseInt(req.query.since || '0', 10);
+    const parsedSince = Number.parseInt(req.query.since || '0', 10);
+    const since = Number.isNaN(parsedSince) ? 0 : parsedSince;
+    const parsedWait = Number.parseInt(req.query.wait || '0', 10);
+    const waitMs = Number.isNaN(parsedWait) ? 0 : Math.min(Math.max(parsedWait, 0), MAX_LONG_POLL_WAIT_MS);
     const store = getRoomStore(roomCode);
     pruneExpiredRooms();
-    const events = store.events.filter((event) => event.id > (Number.isNaN(since) ? 0 : since));
-    const nextSince = events.length > 0 ? events[events.length - 1].id : (Number.isNaN(since) ? 0 : since);
-    return res.json({ events, nextSince });
+
+    const result = eventsSince(store, since);
+    if (result.events.length > 0 || waitMs === 0) {
+        return res.json({ ...result, longPoll: waitMs > 0 });
+    }
+
+    // Long-poll: hold the request until an event is queued or the wait expires.
+    let timer = null;
+    const finish = () => {
+        store.waiters.delete(finish);
+        clearTimeout(timer);
+        if (!res.headersSent) {
+            store.lastTouched = Date.now();
+            res.json({ ...eventsSince(store, since), longPoll: true });
+        }
+    };
+    timer = setTimeout(finish, waitMs);
+    store.waiters.add(finish);
+    req.on('close', () => {
+        store.waiters.delete(finish);
+        clearTimeout(timer);
+    });
+    return undefined;
 });
 
+function relayExecutionAck(roomCode, ack, executedAt) {
+    const { eventId, clientEventId, ok, error, typed, total, cancelled, snippet, snippetMiss, duplicate } = ack || {};
+    if (!roomCode || !eventId) {
+        return;
+    }
+
+    const relayed = {
+        roomCode,
+        eventId,
+        clientEventId,
+        ok: ok !== false,
+        error: error || null,
+        executedAt
+    };
+    // Long text events that stopped early report how far they got.
+    if (Number.isInteger(total)) {
+        relayed.typed = typed;
+        relayed.total = total;
+        relayed.cancelled = cancelled === true;
+    }
+    // Receivers keep large blocks by digest; senders then send just the digest
+    // as a 'snippet' event, and resend the text if the receiver reports a miss.
+    if (typeof snippet === 'string' && snippet) {
+        relayed.snippet = snippet;
+    }
+    if (snippetMiss === true) {
+        relayed.snippetMiss = true;
+    }
+    // An event delivered twice runs once; the repeat is acked as a duplicate.
+    if (duplicate === true) {
+        relayed.duplicate = true;
+    }
+    io.to(roomCode).emit('execution-ack', relayed);
+}
+
 io.on('connection', (socket) => {
     console.log(`User connected: ${socket.id}`);
+    socket.emit('server-features', SERVER_FEATURES);
 
     // Handle joining a room
     socket.on('join-room', (roomCode, role) => {
@@ -97,11 +184,11 @@ io.on('connection', (socket) => {
 
     // Handle keystroke events
     socket.on('keystroke', (data) => {
-        const { roomCode, type, payload, clientEventId } = data || {};
+        const { roomCode, type, payload, clientEventId, mustType, sentAt } = data || {};
         if (!roomCode || !type || payload === undefined || payload === null) {
             return;
         }
-        const event = queueEvent(roomCode, type, payload);
+        const event = queueEvent(roomCode, type, payload, mustType, sentAt, socket.id);
         socket.emit('delivery-ack', {
             roomCode,
             clientEventId,
@@ -114,24 +201,62 @@ io.on('connection', (socket) => {
             type,
             payload,
             clientEventId,
-            eventId: event.id
+            ...(event.mustType ? { mustType: true } : {}),
+            ...(event.sentAt !== undefined ? { sentAt: event.sentAt, senderId: socket.id } : {}),
+            eventId: event.id,
+            epoch: SERVER_EPOCH
         });
     });
 
     socket.on('execution-ack', (data) => {
-        const { roomCode, eventId, clientEventId, ok, error } = data || {};
+        const { roomCode } = data || {};
+        relayExecutionAck(roomCode, data, Date.now());
+    });
+
+    // Receivers on the auto transport use the ack to spot a stalled socket.
+    socket.on('heartbeat', (_data, ack) => {
+        if (typeof ack === 'function') {
+            ack({ ts: Date.now() });
+        }
+    });
+
+    // Receivers estimate each sender's clock offset: the ping goes to the
+    // room's senders, and each pong comes back tagged with who answered.
+    socket.on('clock-ping', (data) => {
+        const { roomCode, t0 } = data || {};
+        if (!roomCode || !Number.isFinite(t0)) {
+            return;
+        }
+        socket.to(roomCode).emit('clock-ping', { roomCode, t0 });
+    });
+
+    socket.on('clock-pong', (data) => {
+        const { roomCode, t0, t1 } = data || {};
+        if (!roomCode || !Number.isFinite(t0) || !Number.isFinite(t1)) {
+            return;
+        }
+        socket.to(roomCode).emit('clock-pong', { roomCode, t0, t1, senderId: socket.id });
+    });
+
+    // Receivers report progress while typing long text events in chunks.
+    socket.on('execution-progress', (data) => {
+        const { roomCode, eventId, clientEventId, typed, total } = data || {};
         if (!roomCode || !eventId) {
             return;
         }
+        socket.to(roomCode).emit('execution-progress', { roomCode, eventId, clientEventId, typed, total });
+    });
 
-        io.to(roomCode).emit('execution-ack', {
-            roomCode,
-            eventId,
-            clientEventId,
-            ok: ok !== false,
-            error: error || null,
-            executedAt: Date.now()
-        });
+    // Receivers that saw executionAckBatch send one frame per ack window.
+    socket.on('execution-ack-batch', (data) => {
+        const { roomCode, acks } = data || {};
+        if (!roomCode || !Array.isArray(acks)) {
+            return;
+        }
+        const executedAt = Date.now();
+        for (const ack of acks) {
+            relayExecutionAck(roomCode, ack, executedAt);
+        }
     });
 
     socket.on('disconnect', () => {
@@ -147,4 +272,4 @@ if (require.main === module) {
     });
 }
 
-module.exports = { app, server, io };
+module.exports = { app, server, io, SERVER_EPOCH };
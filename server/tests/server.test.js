@@ -3,7 +3,7 @@ const { Server } = require('socket.io');
 const Client = require('socket.io-client');
 const express = require('express');
 const request = require('supertest');
-const { app } = require('../server');
+const { app, SERVER_EPOCH } = require('../server');
 
 describe('Socket.io Server', () => {
     let io, serverSocket, clientSocket1, clientSocket2;
@@ -116,5 +116,61 @@ describe('HTTP polling endpoints', () => {
         expect(getResponse.body.events[0].type).toBe('letter');
         expect(getResponse.body.events[0].payload).toBe('z');
         expect(getResponse.body.nextSince).toBeGreaterThan(0);
+        expect(getResponse.body.epoch).toBe(SERVER_EPOCH);
+    });
+
+    test('should keep the must-type mark on queued events', async () => {
+        const roomCode = '2468';
+
+        await request(app)
+            .post(`/api/rooms/${roomCode}/events`)
+            .send({ type: 'block', payload: 'typed', mustType: true });
+        await request(app)
+            .post(`/api/rooms/${roomCode}/events`)
+            .send({ type: 'block', payload: 'pasted' });
+
+        const response = await request(app).get(`/api/rooms/${roomCode}/events?since=0`);
+        expect(response.body.events.map((event) => event.mustType)).toEqual([true, undefined]);
+    });
+
+    test('should keep the sender timestamp on queued events', async () => {
+        const roomCode = '1357';
+
+        await request(app)
+            .post(`/api/rooms/${roomCode}/events`)
+            .send({ type: 'letter', payload: 'a', sentAt: 1700000000123.5 });
+        await request(app)
+            .post(`/api/rooms/${roomCode}/events`)
+            .send({ type: 'letter', payload: 'b', sentAt: 'soon' });
+
+        const response = await request(app).get(`/api/rooms/${roomCode}/events?since=0`);
+        expect(response.body.events.map((event) => event.sentAt)).toEqual([1700000000123.5, undefined]);
+    });
+
+    test('should hold a long-poll request until an event arrives', async () => {
+        const roomCode = '3456';
+        const startedAt = Date.now();
+
+        const pending = request(app).get(`/api/rooms/${roomCode}/events?since=0&wait=5000`);
+        setTimeout(() => {
+            request(app)
+                .post(`/api/rooms/${roomCode}/events`)
+                .send({ type: 'letter', payload: 'q' })
+                .end(() => {});
+        }, 100);
+
+        const response = await pending;
+        expect(response.status).toBe(200);
+        expect(response.body.longPoll).toBe(true);
+        expect(response.body.events.map((event) => event.payload)).toEqual(['q']);
+        expect(Date.now() - startedAt).toBeLessThan(5000);
+    });
+
+    test('should answer an idle long-poll request when the wait expires', async () => {
+        const response = await request(app).get('/api/rooms/7890/events?since=0&wait=50');
+        expect(response.status).toBe(200);
+        expect(response.body.events).toEqual([]);
+        expect(response.body.nextSince).toBe(0);
+        expect(response.body.longPoll).toBe(true);
     });
 });